@@ -1,17 +1,27 @@
+import os
+import hashlib
 from configparser import ConfigParser
+from datetime import timedelta
+from functools import lru_cache
 from pathlib import Path
 from logging import Logger
+from typing import Iterable
 from prefect import task
 
 from src import etl_queries as etl 
 from src.msd.custom_types import MsdSong, MsdArtist
-from src.spotify import SongFetcher, ArtistFetcher
-from src.spotify.custom_types import SpotifyArtist, SpotifySong
+from src.spotify import SongFetcher, ArtistFetcher, AlbumFetcher, AudioFeaturesFetcher
+from src.spotify.custom_types import SpotifyArtist, SpotifySong, SpotifyAlbum
 from src.mapping.custom_types import MappedArtist, MappedSong
 from src.aws.redshift import RedshiftClient
 from src.aws.s3 import S3Client
 from src.data_quality import DataQualityOperator
-from src.data_quality.tests import Test
+from src.data_quality.tests import Test, scoped
+from src.utils.cache import fingerprint
+from src.tuning.physical_design import TableDesign, load_designs, tuned_ddl, ctas_select, encoding_statements
+from src.utils.dataset import Dataset, DatasetWriter, read_dataset, verify_dataset, write_columns, chunked
+from src.utils.keyset import KeyRange, KeysetCursor, plan_key_ranges, iter_pages
+from src.utils.metrics import stage_metrics, measure_stage, add_to_active_stages
 
 
 prep_schema     = etl.SchemaQueries()
@@ -22,19 +32,47 @@ stg_mapped      = etl.StagingMappedQueries()
 analytics       = etl.AnalyticsQueries()
 search          = etl.SearchInputQueries()
 
-p = Path(__file__).with_name('config.cfg')
-config = ConfigParser()
-config.read(p)
+config_path = Path(__file__).with_name('config.cfg')
+
+# Staging tables the search inputs are read from
+search_input_tables = {'songs': 'staging.msd_songs', 'artists': 'staging.msd_artists'}
+
+# Task decorators need a value at import time. The flow applies the configured one, see cache_expiration()
+default_cache_expiration = timedelta(days=7)
+
+
+@lru_cache(maxsize=None)
+def get_config() -> ConfigParser:
+    """Read config.cfg on first use instead of at import time, so that importing the 
+    tasks stays cheap and doesn't require the file."""
+    config = ConfigParser()
+    config.read(config_path)
+    return config
+
+
+def cache_expiration() -> timedelta:
+    """Expiration of the cached Spotify results, [CACHE] EXPIRATION_DAYS of the config"""
+    return timedelta(days=get_config().getint('CACHE', 'EXPIRATION_DAYS', fallback=7))
+
+
+@lru_cache(maxsize=None)
+def physical_designs() -> dict[str, TableDesign]:
+    """Physical designs proposed by flows/tune_tables.py, read from [TUNING] DESIGN_PATH of the config.
+    Tables without a design are created with the DDL of etl_queries."""
+    return load_designs(os.path.expanduser(get_config().get('TUNING', 'DESIGN_PATH', fallback='')))
+
+
+def tuned(table: str, query: str) -> str:
+    """Query creating a table, with the distribution, sort key and encodings of its design if it has one"""
+    design = physical_designs().get(table)
+    return tuned_ddl(query, design) if design else query
 
-bucket              = config['S3']['BUCKET']
-redshift_user       = config['REDSHIFT']['USERNAME']
-region_name         = config['S3']['REGION_NAME']
-iam_role            = config['IAM']['IAM_ROLE_ARN']
-data_dir            = config['DATA']['DATA_DIR']
 
 @task
+@measure_stage
 def refresh_staging_schema(redshift: RedshiftClient, logger: Logger):
-    """Task to drop and then recreate the staging schema
+    """Task to create the staging schema if it doesn't exist yet. Staging tables are
+    dropped and recreated one by one when their input changes.
 
     Parameters
     ----------
@@ -43,19 +81,23 @@ def refresh_staging_schema(redshift: RedshiftClient, logger: Logger):
     logger : Logger
     """
     logger.info("Preparing staging schema...")
-    redshift.execute_query(prep_schema.drop_schema_staging)
-    redshift.execute_query(prep_schema.create_schema_staging.format(user=redshift_user))
+    redshift.execute_query(prep_schema.create_schema_staging.format(user=get_config()['REDSHIFT']['USERNAME']), label='create_schema_staging')
 
 
 @task
+@measure_stage
 def copy_s3_to_staging(
         redshift: RedshiftClient, 
         create_table_query: str, 
         table_name: str, 
         source_path: str, 
-        logger: Logger
+        logger: Logger,
+        s3: S3Client = None,
+        use_cache: bool = True,
+        data_format: str = 'json'
     ):
-    """Task to copy data from the staging tables
+    """Task to copy data from the staging tables. If an S3 client is given, the load is 
+    skipped when the table was already loaded from the same S3 objects (same ETags).
 
     Parameters
     ----------
@@ -67,30 +109,166 @@ def copy_s3_to_staging(
     source_path : str
         Path to the S3 object to be loaded to redshift
     logger : Logger
+    s3 : S3Client, optional
+        S3 client used to list the ETags of the source objects, by default None (no caching)
+    use_cache : bool, optional
+        If False, always reload the table, by default True
+    data_format : str, optional
+        'json' or 'csv', format of the source objects, by default 'json'
     """
-
-    logger.info(f"Creating {table_name} table...")
-    redshift.execute_query(create_table_query)
-    redshift.execute_query(loading.copy_s3_to_redshift.format(
+    create_table_query = tuned(table_name, create_table_query)
+    copy_template = loading.copy_csv_s3_to_redshift if data_format == 'csv' else loading.copy_s3_to_redshift
+    copy_query = copy_template.format(
         table           = table_name,
-        iam_role        = iam_role,
+        iam_role        = get_config()['IAM']['IAM_ROLE_ARN'],
         source_path     = source_path,
-        region_name     = region_name
-        )
+        region_name     = get_config()['S3']['REGION_NAME']
+    )
+
+    if s3 is not None:
+        table_fingerprint = fingerprint(create_table_query, copy_query, s3.list_etags(source_path))
+        
+        if use_cache and redshift.get_table_fingerprint(table_name) == table_fingerprint:
+            logger.info(f"{table_name} is up to date, skipping.")
+            return
+    else:
+        table_fingerprint = None
+
+    # A failed statement raises, so that a partial load is never recorded as up to date
+    logger.info(f"Creating {table_name} table...")
+    redshift.execute_query(loading.drop_table.format(table=table_name), label=f"drop {table_name}", raise_on_error=True)
+    redshift.execute_query(create_table_query, label=f"create {table_name}", raise_on_error=True)
+    redshift.execute_query(copy_query, label = f"copy {table_name}", raise_on_error=True)
+
+    if table_fingerprint is not None:
+        redshift.set_table_fingerprint(table_name, table_fingerprint)
+
+
+def write_dataset(
+        chunks: Iterable[list[MappedSong | MappedArtist | SpotifySong | SpotifyArtist | SpotifyAlbum]],
+        output_path: str,
+        s3: S3Client = None,
+        remote_file_path: str = None,
+        logger: Logger = None
+    ) -> Dataset:
+    """Write the records of one partition to a local file chunk by chunk, and upload it to S3 
+    if a client is given. An empty file is written for empty partitions, so that parts left 
+    by a previous run are overwritten instead of being loaded again by COPY.
+    """
+    with DatasetWriter(output_path, remote_file_path) as writer:
+        for records in chunks:
+            writer.write(records)
+
+    if s3 is not None and remote_file_path is not None:
+        upload_files.fn(s3, output_path, remote_file_path, logger)
+
+    return writer.dataset
+
+
+def search_selection(spotify_fetcher: SongFetcher | ArtistFetcher) -> dict:
+    """Settings of a fetcher deciding which search hits are kept, part of the fingerprints
+    of the search results"""
+    return {key: getattr(spotify_fetcher, key, None) for key in ['min_score', 'top_k']}
+
+
+def output_exists(parameters: dict) -> bool:
+    """Whether the output file of a cached task is still there, otherwise the task is run again"""
+    return parameters.get('output_path') is not None and os.path.isfile(parameters['output_path'])
+
+
+def search_cache_key(context, parameters: dict) -> str:
+    """Cache key of search_spotify(): the search queries and parameters, the hits kept by the
+    fetcher, plus the fingerprint of the staging table the search input is read from. No key 
+    (no caching) if the staging table has no fingerprint, or the output file is missing.
+    """
+    input_fingerprint = parameters['redshift'].get_table_fingerprint(search_input_tables[parameters['object_name']])
+
+    if input_fingerprint is None or not output_exists(parameters):
+        return None
+
+    return fingerprint(
+        'search_spotify', search.songs, search.artists, input_fingerprint, parameters['key_range'].dict(),
+        search_selection(parameters['spotify_fetcher']),
+        *[parameters.get(key) for key in ['object_name', 'max_rows', 'output_path', 'remote_file_path']]
     )
 
 
-@task 
+def fetch_cache_key(context, parameters: dict) -> str:
+    """Cache key of fetch_spotify(): the checksum of the search results and the output paths.
+    No key if the output file is missing or the search results don't match their handle, 
+    which can come from the cache of search_spotify()"""
+    if not output_exists(parameters) or not verify_dataset(parameters['spotify_search_results']):
+        return None
+
+    return fingerprint(
+        'fetch_spotify', 
+        parameters['spotify_search_results'].checksum,
+        *[parameters.get(key) for key in ['object_name', 'output_path', 'remote_file_path']]
+    )
+
+
+def fetched_songs_cache_key(context, parameters: dict) -> str:
+    """Cache key of the tasks enriching the fetched songs (albums, audio features): 
+    the task, the checksums of the fetched songs and the output paths. No key if the output 
+    file is missing or the fetched songs don't match their handles"""
+    if not output_exists(parameters) or not all(verify_dataset(dataset) for dataset in parameters['spotify_songs']):
+        return None
+
+    return fingerprint(
+        context.task.name, 
+        [dataset.checksum for dataset in parameters['spotify_songs']],
+        *[parameters.get(key) for key in ['output_path', 'remote_file_path']]
+    )
+
+
+@task
+@measure_stage
+def plan_search_input(redshift: RedshiftClient, object_name: str, num_ranges: int, logger: Logger) -> list[KeyRange]:
+    """Task to split the MSD IDs of the search input into ranges of about the same size, 
+    one per search partition. The same staging table always gives the same ranges.
+
+    Parameters
+    ----------
+    redshift : RedshiftClient
+    object_name : str
+        'songs' or 'artists'
+    num_ranges : int
+        Number of search partitions
+    logger : Logger
+
+    Returns
+    -------
+    list[KeyRange]
+    """
+    table = search_input_tables[object_name]
+    key_ranges = plan_key_ranges(redshift, search.key_ranges.format(table=table, num_ranges=num_ranges), num_ranges)
+    logger.info(f"Split the {sum(key_range.keys for key_range in key_ranges)} IDs of {table} into {num_ranges} ranges")
+    return key_ranges
+
+
+@task(retries=2, retry_delay_seconds=30, tags=['spotify'], 
+      cache_key_fn=search_cache_key, cache_expiration=default_cache_expiration)
+@measure_stage
 def search_spotify(
         redshift: RedshiftClient, 
         spotify_fetcher: SongFetcher | ArtistFetcher, 
         object_name: str, 
-        limit_clause: str ="limit 10", 
+        key_range: KeyRange,
+        max_rows: int = None,
         output_path: str = "./tmp", 
-        logger: Logger = None
-    ) -> list[MappedSong | MappedArtist]:
+        logger: Logger = None,
+        s3: S3Client = None,
+        remote_file_path: str = None,
+        page_size: int = 1000
+    ) -> Dataset:
     """Query songs / artists info from the staging tables, and search for those 
-    songs / artists on Spotify.
+    songs / artists on Spotify. 
+    
+    This task only processes one range of MSD IDs, planned by plan_search_input(), so that 
+    ranges can be mapped over, run in parallel and retried independently. The range is read 
+    page by page with keyset pagination, and the search results of every page are appended
+    to the output file. A cursor saved next to the output file records the last ID searched, 
+    so a retried or restarted task continues from there. The cursor is deleted once the range is done. Only a handle to the file is returned.
 
     Parameters
     ----------
@@ -101,43 +279,63 @@ def search_spotify(
         One of the two fetchers to fetch either songs or artists
     object_name : str
         Name of the object being searched, for logging & branching purpos
-    limit_clause : str, optional
-        the LIMIT clause to be inserted to the search query, by default "limit 10"
+    key_range : KeyRange
+        Range of MSD IDs to search
+    max_rows : int, optional
+        Search at most this many songs / artists of the range, by default all of them
     output_path : str, optional
-        Local folder to write searched data to, by default "./tmp"
+        Local file to write the searched data of this range to, by default "./tmp"
     logger : Logger
+    s3 : S3Client, optional
+        If given, upload the output file to S3
+    remote_file_path : str, optional
+        File path on S3 to upload the output file to. No need to include the bucket name.
+    page_size : int, optional
+        Number of search inputs read, searched and written at a time, by default 1000
 
     TODO: Should do branching using the fetcher's type instead of string like this?
-    TODO: Find a better way to generate search queries with LIMIT
     
     Returns
     -------
-    list[MappedSong | MappedArtist]
-        List of MappedSong or MappedArtist objects
+    Dataset
+        Handle to the file of MappedSong or MappedArtist records
     """
-    logger.info(f"Searching for {object_name} on Spotify...")
+    logger.info(f"Searching for {object_name} on Spotify (range {key_range.index}: {key_range.lower!r} - {key_range.upper!r})...")
 
     if object_name == 'songs':
-        songs = redshift.execute_query(search.songs.format(limit_clause=limit_clause))
-        search_inputs = [
-            MsdSong(id=song[0], name=song[1], artist_id=song[2], artist_name=song[3]) 
-            for song in songs
-        ]
-    
+        query = search.songs
+        to_search_input = lambda song: MsdSong(
+            id=song[0], name=song[1], artist_id=song[2], artist_name=song[3], release=song[4], year=song[5])
     elif object_name == 'artists':
-        artists = redshift.execute_query(search.artists.format(limit_clause=limit_clause))
-        search_inputs = [
-            MsdArtist(id=artist[0], name=artist[1]) 
-            for artist in artists
-        ]
-
-    search_results = spotify_fetcher.search_many(search_inputs)
-    spotify_fetcher.output_json(search_results, output_path, new_line_delimited=True)
-    
-    return search_results
+        query = search.artists
+        to_search_input = lambda artist: MsdArtist(id=artist[0], name=artist[1])
+
+    # Resume only from a cursor of the same range, query, input and selection of the hits
+    input_fingerprint = redshift.get_table_fingerprint(search_input_tables[object_name])
+    cursor = KeysetCursor(
+        f"{output_path}.cursor" if input_fingerprint is not None else None,
+        fingerprint(query, key_range.dict(), max_rows, input_fingerprint, search_selection(spotify_fetcher))
+    )
+    if cursor.position > (os.path.getsize(output_path) if os.path.exists(output_path) else 0):
+        cursor.reset()
+    elif cursor.last_key is not None:
+        logger.info(f"Resuming after {cursor.last_key!r}, {cursor.rows} {object_name} already searched")
+
+    with DatasetWriter(output_path, remote_file_path, resume_position=cursor.position) as writer:
+        for page in iter_pages(redshift, query, key_range, page_size, max_rows, cursor, label=f"search_input_{object_name}"):
+            writer.write(spotify_fetcher.search_many([to_search_input(row) for row in page]))
+            cursor.position = writer.flush()
+
+    cursor.remove()
+
+    if s3 is not None and remote_file_path is not None:
+        upload_files.fn(s3, output_path, remote_file_path, logger)
+
+    return writer.dataset
         
 
 @task
+@measure_stage
 def upload_files(s3: S3Client, local_file_path: str, 
                 remote_file_path: str, logger: Logger):
     """Task to upload local files to S3
@@ -153,24 +351,31 @@ def upload_files(s3: S3Client, local_file_path: str,
     logger : Logger
     """
     logger.info(f"Uploading to S3: {local_file_path}")
-    s3.upload_file(local_file_path, bucket, remote_file_path)
+    s3.upload_file(local_file_path, get_config()['S3']['BUCKET'], remote_file_path)
 
 
 
-@task
+@task(retries=2, retry_delay_seconds=30, tags=['spotify'], 
+      cache_key_fn=fetch_cache_key, cache_expiration=default_cache_expiration)
+@measure_stage
 def fetch_spotify(
-        spotify_search_results: list[SpotifySong | SpotifyArtist], 
+        spotify_search_results: Dataset, 
         spotify_fetcher: SongFetcher | ArtistFetcher, 
         object_name: str, 
         output_path: str, 
-        logger: Logger
-    ):
-    """Fetch songs/artists from spotify and output file to a local folder
+        logger: Logger,
+        s3: S3Client = None,
+        remote_file_path: str = None,
+        chunk_size: int = 1000
+    ) -> Dataset:
+    """Fetch songs/artists from spotify and output file to a local folder. 
+    Meant to be mapped over the partitions returned by search_spotify(). Search results
+    are streamed from their file, so memory use doesn't grow with the partition size.
 
     Parameters
     ----------
-    spotify_search_results : list[SpotifySong  |  SpotifyArtist]
-        Search result retuned by search_spotify() task
+    spotify_search_results : Dataset
+        Handle to the search results of one partition, retuned by search_spotify() task
     spotify_fetcher : SongFetcher | ArtistFetcher
         Spotify fetcher to fetch songs/artists details
     object_name : str
@@ -178,17 +383,338 @@ def fetch_spotify(
     output_path : str
         Local path to write the fetched results to
     logger : Logger
+    s3 : S3Client, optional
+        If given, upload the output file to S3
+    remote_file_path : str, optional
+        File path on S3 to upload the output file to. No need to include the bucket name.
+    chunk_size : int, optional
+        Number of search results fetched before the details are written, by default 1000
+
+    Returns
+    -------
+    Dataset
+        Handle to the file of SpotifySong or SpotifyArtist records
     """
     logger.info(f"Fetching {object_name} From spotify...")
 
-    fetch_result = spotify_fetcher.fetch_many(spotify_search_results)
-    spotify_fetcher.output_json(fetch_result, output_path, new_line_delimited=True)
+    model = MappedSong if object_name == 'songs' else MappedArtist
+    search_results = read_dataset(spotify_search_results, model)
+
+    return write_dataset(
+        (spotify_fetcher.fetch_many(chunk) for chunk in chunked(search_results, chunk_size)),
+        output_path, s3, remote_file_path, logger
+    )
+
+
+@task(retries=2, retry_delay_seconds=30, tags=['spotify'], 
+      cache_key_fn=fetched_songs_cache_key, cache_expiration=default_cache_expiration)
+@measure_stage
+def fetch_spotify_albums(
+        spotify_songs: list[Dataset], 
+        album_fetcher: AlbumFetcher, 
+        output_path: str, 
+        logger: Logger,
+        s3: S3Client = None,
+        remote_file_path: str = None
+    ) -> Dataset:
+    """Fetch the albums of all the fetched songs from Spotify and output them to a local file.
+    Runs once over all the song partitions, so that every album is requested only once.
+
+    Parameters
+    ----------
+    spotify_songs : list[Dataset]
+        Handles to the fetched songs, returned by the fetch_spotify() tasks
+    album_fetcher : AlbumFetcher
+    output_path : str
+        Local path to write the fetched albums to
+    logger : Logger
+    s3 : S3Client, optional
+        If given, upload the output file to S3
+    remote_file_path : str, optional
+        File path on S3 to upload the output file to. No need to include the bucket name.
+
+    Returns
+    -------
+    Dataset
+        Handle to the file of SpotifyAlbum records
+    """
+    logger.info("Fetching albums from spotify...")
+
+    songs = (song for dataset in spotify_songs for song in read_dataset(dataset, SpotifySong))
+    return write_dataset([album_fetcher.fetch_many(songs)], output_path, s3, remote_file_path, logger)
+
+
+@task(retries=2, retry_delay_seconds=30, tags=['spotify'], 
+      cache_key_fn=fetched_songs_cache_key, cache_expiration=default_cache_expiration)
+@measure_stage
+def fetch_spotify_audio_features(
+        spotify_songs: list[Dataset], 
+        audio_features_fetcher: AudioFeaturesFetcher, 
+        output_path: str, 
+        logger: Logger,
+        s3: S3Client = None,
+        remote_file_path: str = None
+    ) -> Dataset:
+    """Fetch the audio features of all the fetched songs from Spotify and output them to a 
+    local CSV file, one column per feature, ready for COPY ... CSV.
+
+    Parameters
+    ----------
+    spotify_songs : list[Dataset]
+        Handles to the fetched songs, returned by the fetch_spotify() tasks
+    audio_features_fetcher : AudioFeaturesFetcher
+    output_path : str
+        Local path to write the audio features to
+    logger : Logger
+    s3 : S3Client, optional
+        If given, upload the output file to S3
+    remote_file_path : str, optional
+        File path on S3 to upload the output file to. No need to include the bucket name.
+
+    Returns
+    -------
+    Dataset
+        Handle to the CSV file of audio features
+    """
+    logger.info("Fetching audio features from spotify...")
+
+    song_ids = (song['id'] for dataset in spotify_songs for song in read_dataset(dataset))
+    dataset = write_columns(audio_features_fetcher.fetch_many(song_ids), output_path, remote_file_path)
+
+    if s3 is not None and remote_file_path is not None:
+        upload_files.fn(s3, output_path, remote_file_path, logger)
+
+    return dataset
+
+
+@task
+@measure_stage
+def load_to_staging(
+        redshift: RedshiftClient,
+        s3: S3Client,
+        partitions: list[Dataset],
+        create_table_query: str,
+        table_name: str,
+        source_path: str,
+        logger: Logger,
+        use_cache: bool = True
+    ):
+    """Task to load records to a staging table. Small loads (up to DIRECT_INSERT_MAX_ROWS 
+    records) are inserted directly into Redshift, without uploading the partitions. Larger 
+    ones are uploaded to their remote paths and loaded with COPY from the S3 prefix, see 
+    upload_partitions(). Loads are skipped if the table already contains the same input.
+
+    Parameters
+    ----------
+    redshift : RedshiftClient
+    s3 : S3Client
+    partitions : list[Dataset]
+        Handles to the files of each partition, returned by the search_spotify() or fetch_spotify() task,
+        with the remote path under `source_path` they are uploaded to
+    create_table_query : str
+        A query to create the staging table
+    table_name : str
+        Name of the staging table
+    source_path : str
+        S3 prefix containing all the partition files, for the COPY command
+    logger : Logger
+    use_cache : bool, optional
+        If False, always reload the table, by default True
+    """
+    num_records = sum(partition.rows for partition in partitions)
+    add_to_active_stages(records=num_records)
+    create_table_query = tuned(table_name, create_table_query)
+
+    if num_records <= get_config().getint('REDSHIFT', 'DIRECT_INSERT_MAX_ROWS', fallback=1000):
+        table_fingerprint = fingerprint(create_table_query, [partition.checksum for partition in partitions])
+
+        if use_cache and redshift.get_table_fingerprint(table_name) == table_fingerprint:
+            logger.info(f"{table_name} is up to date, skipping.")
+            return
+
+        logger.info(f"Inserting {num_records} records directly into {table_name}...")
+        redshift.execute_query(loading.drop_table.format(table=table_name), label=f"drop {table_name}", raise_on_error=True)
+        redshift.execute_query(create_table_query, label=f"create {table_name}", raise_on_error=True)
+        data = [record for partition in partitions for record in read_dataset(partition)]
+        redshift.insert_records(table_name, data)
+        redshift.set_table_fingerprint(table_name, table_fingerprint)
+    
+    else:
+        upload_partitions(s3, partitions, source_path, logger)
+        data_format = 'csv' if partitions[0].format == 'csv' else 'json'
+        copy_s3_to_staging.fn(redshift, create_table_query, table_name, source_path, logger, s3, use_cache, data_format)
+
+
+def upload_partitions(s3: S3Client, partitions: list[Dataset], source_path: str, logger: Logger):
+    """Upload the files of the partitions that are not on S3 yet, and delete the other files 
+    under the S3 prefix, for example the partitions of a run with a larger NUM_PARTITIONS, 
+    so that COPY only loads the current partitions. Files whose ETag is the MD5 of the local 
+    file (single part uploads) are not uploaded again.
+
+    Parameters
+    ----------
+    s3 : S3Client
+    partitions : list[Dataset]
+        Handles to the files, with their remote path
+    source_path : str
+        S3 prefix the partitions are uploaded to, for example s3://bucket/mapped/songs/
+    logger : Logger
+    """
+    bucket_name = source_path.removeprefix("s3://").partition("/")[0]
+    etags = s3.list_etags(source_path)
+
+    for partition in partitions:
+        if not verify_dataset(partition):
+            raise ValueError(f"{partition.path} is missing or changed since it was written, run again without the cache")
+
+        file_hash = hashlib.md5()
+        with open(partition.path, 'rb') as f:
+            while block := f.read(2**20):
+                file_hash.update(block)
+
+        if etags.get(partition.remote_path) != f'"{file_hash.hexdigest()}"':
+            s3.upload_file(partition.path, bucket_name, partition.remote_path)
+
+    remote_paths = {partition.remote_path for partition in partitions}
+    stale = [key for key in etags if key not in remote_paths]
+    if len(stale) > 0:
+        logger.info(f"Deleting {len(stale)} files of previous runs from {source_path}...")
+        s3.delete_files(bucket_name, stale)
 
 
 # Analytics tables
 
+def build_tables(
+        redshift: RedshiftClient, 
+        schema_name: str, 
+        tables: dict[str, str], 
+        upstream_tables: list[str], 
+        logger: Logger, 
+        use_cache: bool = True,
+        in_place: bool = False
+    ):
+    """Drop and recreate a schema, then build its tables. The build is skipped if all the 
+    tables were already built with the same queries from the same upstream tables.
+
+    Fingerprints are recorded as "<queries>.<upstream tables>", so that tables whose 
+    queries didn't change can be refilled in place.
+
+    Parameters
+    ----------
+    redshift : RedshiftClient
+        Redshift client to run queries
+    schema_name : str
+        One of msd, spotify, mapped, analytics
+    tables : dict[str, str]
+        Mapping of table name to the CTAS query creating it
+    upstream_tables : list[str]
+        Tables the queries read from
+    logger : Logger
+    use_cache : bool, optional
+        If False, always rebuild the tables, by default True
+    in_place : bool, optional
+        If True, tables built with the same queries are emptied and refilled instead of
+        dropped with their schema, which keeps the materialized views built on them, 
+        by default False
+    """
+    tables = {table: tuned(table, query) for table, query in tables.items()}
+    queries_fingerprint = fingerprint(list(tables.values()))
+    upstream_fingerprints = [redshift.get_table_fingerprint(table) for table in upstream_tables]
+
+    if all(upstream_fingerprints):
+        tables_fingerprint = f"{queries_fingerprint}.{fingerprint(upstream_fingerprints)}"
+    else:
+        tables_fingerprint = None
+
+    recorded = [redshift.get_table_fingerprint(table) or '' for table in tables]
+
+    if use_cache and tables_fingerprint is not None and all(value == tables_fingerprint for value in recorded):
+        logger.info(f"Tables in the {schema_name} schema are up to date, skipping.")
+        return
+
+    if in_place and all(value.split('.')[0] == queries_fingerprint for value in recorded):
+        refill_tables(redshift, tables, tables_fingerprint, logger)
+        return
+
+    rebuild_schema(redshift, schema_name, tables, tables_fingerprint, logger)
+
+
+def refill_tables(
+        redshift: RedshiftClient, 
+        tables: dict[str, str], 
+        tables_fingerprint: str, 
+        logger: Logger
+    ):
+    """Empty existing tables and insert the rows of their CTAS query again, then record
+    their fingerprint. The tables keep their columns, encodings and the materialized views
+    built on them, which Redshift can refresh incrementally from the deleted and inserted rows.
+
+    Parameters
+    ----------
+    redshift : RedshiftClient
+    tables : dict[str, str]
+        Mapping of table name to the CTAS query that created it
+    tables_fingerprint : str
+        Fingerprint recorded on the tables, None to record nothing
+    logger : Logger
+    """
+    for table, query in tables.items():
+        logger.info(f"Refilling {table} in place...")
+        redshift.execute_query(analytics.delete_all_rows.format(table=table), 
+                               label=f"delete_rows_{table.replace('.', '_')}", raise_on_error=True)
+        redshift.execute_query(analytics.insert_select.format(table=table, select=ctas_select(query)), 
+                               label=f"refill_table_{table.replace('.', '_')}", raise_on_error=True)
+
+    if tables_fingerprint is not None:
+        for table in tables:
+            redshift.set_table_fingerprint(table, tables_fingerprint)
+
+
+def rebuild_schema(
+        redshift: RedshiftClient, 
+        schema_name: str, 
+        tables: dict[str, str], 
+        tables_fingerprint: str, 
+        logger: Logger, 
+        is_view: bool = False
+    ):
+    """Drop and recreate a schema, create its tables and record their fingerprint. The 
+    statements raise on failure, and the fingerprint is only recorded once all the tables 
+    were created, so that a failed build is retried by the next run.
+
+    Parameters
+    ----------
+    redshift : RedshiftClient
+    schema_name : str
+    tables : dict[str, str]
+        Mapping of table name to the query creating it
+    tables_fingerprint : str
+        Fingerprint to record on every table, None to record nothing
+    logger : Logger
+    is_view : bool, optional
+        True if the queries create materialized views, by default False
+    """
+    redshift.execute_query(getattr(prep_schema, f"drop_schema_{schema_name}"), label=f"drop_schema_{schema_name}", raise_on_error=True)
+    redshift.execute_query(getattr(prep_schema, f"create_schema_{schema_name}").format(user=get_config()['REDSHIFT']['USERNAME']), 
+                           label=f"create_schema_{schema_name}", raise_on_error=True)
+
+    for table, query in tables.items():
+        logger.info(f"Creating {table} {'materialized view' if is_view else 'table'}...")
+        redshift.execute_query(query, label=f"create_table_{table.replace('.', '_')}", raise_on_error=True)
+
+        # CREATE TABLE AS can't declare column encodings
+        if table in physical_designs() and not is_view:
+            for statement in encoding_statements(physical_designs()[table]):
+                redshift.execute_query(statement, label=f"encode_{table.replace('.', '_')}", raise_on_error=True)
+
+    if tables_fingerprint is not None:
+        for table in tables:
+            redshift.set_table_fingerprint(table, tables_fingerprint, is_view=is_view)
+
+
 @task
-def create_msd_tables(redshift: RedshiftClient, logger: Logger):
+@measure_stage
+def create_msd_tables(redshift: RedshiftClient, logger: Logger, use_cache: bool = True, in_place: bool = False):
     """Task to create cleaned songs & artists tables in the msd schema
 
     Parameters
@@ -196,39 +722,49 @@ def create_msd_tables(redshift: RedshiftClient, logger: Logger):
     redshift : RedshiftClient
         Redshift client to run queries
     logger : Logger
+    use_cache : bool, optional
+        If False, rebuild the tables even if their inputs haven't changed, by default True
+    in_place : bool, optional
+        If True, refill the tables instead of dropping them, see build_tables(), by default False
     """
-    
-    redshift.execute_query(prep_schema.drop_schema_msd)
-    redshift.execute_query(prep_schema.create_schema_msd.format(user=redshift_user))
-    
-    logger.info("Creating msd.songs table...")
-    redshift.execute_query(analytics.create_table_msd_songs)
-    
-    logger.info("Creating msd.artists table...")
-    redshift.execute_query(analytics.create_table_msd_artists)
+    build_tables(
+        redshift, 'msd', 
+        {'msd.songs': analytics.create_table_msd_songs, 'msd.artists': analytics.create_table_msd_artists},
+        ['staging.msd_songs', 'staging.msd_artists'],
+        logger, use_cache, in_place
+    )
 
 @task
-def create_spotify_tables(redshift, logger):
-    """Task to create cleaned songs & artists tables in the spotify schema
+@measure_stage
+def create_spotify_tables(redshift: RedshiftClient, logger: Logger, use_cache: bool = True, in_place: bool = False):
+    """Task to create cleaned songs, artists, albums & audio features tables in the spotify schema
 
     Parameters
     ----------
     redshift : RedshiftClient
         Redshift client to run queries
     logger : Logger
+    use_cache : bool, optional
+        If False, rebuild the tables even if their inputs haven't changed, by default True
+    in_place : bool, optional
+        If True, refill the tables instead of dropping them, see build_tables(), by default False
     """
-    redshift.execute_query(prep_schema.drop_schema_spotify)
-    redshift.execute_query(prep_schema.create_schema_spotify.format(user=redshift_user))
-    
-    logger.info("Creating spotify.songs table...")
-    redshift.execute_query(analytics.create_table_spotify_songs)
-    
-    logger.info("Creating spotify.artists table...")
-    redshift.execute_query(analytics.create_table_spotify_artists)
+    build_tables(
+        redshift, 'spotify', 
+        {
+            'spotify.songs'             : analytics.create_table_spotify_songs, 
+            'spotify.artists'           : analytics.create_table_spotify_artists,
+            'spotify.albums'            : analytics.create_table_spotify_albums,
+            'spotify.audio_features'    : analytics.create_table_spotify_audio_features
+        },
+        ['staging.spotify_songs', 'staging.spotify_artists', 'staging.spotify_albums', 'staging.spotify_audio_features'],
+        logger, use_cache, in_place
+    )
 
 
 @task
-def create_mapped_tables(redshift, logger):
+@measure_stage
+def create_mapped_tables(redshift: RedshiftClient, logger: Logger, use_cache: bool = True, in_place: bool = False):
     """Task to create cleaned songs & artists tables in the mapped schema
 
     Parameters
@@ -236,40 +772,226 @@ def create_mapped_tables(redshift, logger):
     redshift : RedshiftClient
         Redshift client to run queries
     logger : Logger
+    use_cache : bool, optional
+        If False, rebuild the tables even if their inputs haven't changed, by default True
+    in_place : bool, optional
+        If True, refill the tables instead of dropping them, see build_tables(), by default False
     """
-    redshift.execute_query(prep_schema.drop_schema_mapped)
-    redshift.execute_query(prep_schema.create_schema_mapped.format(user=redshift_user))
+    build_tables(
+        redshift, 'mapped', 
+        {'mapped.songs': analytics.create_table_mapped_songs, 'mapped.artists': analytics.create_table_mapped_artists},
+        ['staging.mapped_songs', 'staging.mapped_artists'],
+        logger, use_cache, in_place
+    )
 
-    logger.info("Creating mapped.songs table...")
-    redshift.execute_query(analytics.create_table_mapped_songs)
 
-    logger.info("Creating mapped.songs table...")
-    redshift.execute_query(analytics.create_table_mapped_artists)
+# Ways to maintain the analytics tables, see create_analytics_tables()
+analytics_materializations = ['full', 'table', 'view']
+
+analytics_definitions = {
+    'analytics.songs': {
+        'table' : analytics.create_table_analytics_songs,
+        'view'  : analytics.create_view_analytics_songs,
+        'delta' : [
+            analytics.drop_table_analytics_songs_delta, analytics.create_table_analytics_songs_delta,
+            analytics.delete_removed_analytics_songs, analytics.insert_new_analytics_songs
+        ],
+        'delta_scope' : analytics.delta_scope_analytics_songs,
+    },
+    'analytics.artists': {
+        'table' : analytics.create_table_analytics_artists,
+        'view'  : analytics.create_view_analytics_artists,
+        'delta' : [
+            analytics.drop_table_analytics_artists_delta, analytics.create_table_analytics_artists_delta,
+            analytics.delete_removed_analytics_artists, analytics.insert_new_analytics_artists
+        ],
+        'delta_scope' : analytics.delta_scope_analytics_artists,
+    },
+}
+
+# Tables the attributes of the analytics rows come from, and tables of the mapped pairs
+analytics_attribute_tables = [
+    'msd.songs', 'msd.artists', 'spotify.songs', 'spotify.artists', 'spotify.albums', 'spotify.audio_features'
+]
+analytics_pair_tables = ['mapped.songs', 'mapped.artists']
+analytics_upstream_tables = analytics_attribute_tables + analytics_pair_tables
 
 
 @task
-def create_analytics_tables(redshift, logger):
-    """Task to create cleaned songs & artists tables in the analytics schema
+@measure_stage
+def create_analytics_tables(
+        redshift: RedshiftClient, 
+        logger: Logger, 
+        use_cache: bool = True, 
+        materialization: str = 'full'
+    ) -> dict[str, str]:
+    """Task to create songs & artists tables in the analytics schema. Materializations:
+
+    - full: tables rebuilt with CTAS whenever one of their inputs changed
+    - table: tables where only the delta of the mapped (MSD ID, Spotify ID) pairs is applied
+      when only the mapped tables changed. Rows of pairs that are still mapped are kept as 
+      they are, so the tables are rebuilt when the msd or spotify tables changed
+    - view: materialized views with auto refresh, refreshed when their inputs changed. 
+      Redshift refreshes them incrementally when the view allows it. The upstream tables 
+      must then be refilled in place, see build_tables(), or the views are dropped with them
+
+    With 'table' and 'view', the schema is only rebuilt when the definitions changed,
+    the objects are missing, or the cache is off. Fingerprints are recorded as 
+    "<definitions>.<attribute tables>.<pair tables>", and only once all the statements succeeded.
 
     Parameters
     ----------
     redshift : RedshiftClient
         Redshift client to run queries
     logger : Logger
+    use_cache : bool, optional
+        If False, rebuild the tables even if their inputs haven't changed, by default True
+    materialization : str, optional
+        One of `analytics_materializations`, by default 'full'
+
+    Returns
+    -------
+    dict[str, str]
+        Data test scope of every table the delta was applied to (the rows sharing a key 
+        with the inserted pairs), empty if the tables were built or refreshed as a whole.
+        See `run_data_quality_tests`
     """
-    redshift.execute_query(prep_schema.drop_schema_analytics)
-    redshift.execute_query(prep_schema.create_schema_analytics.format(user=redshift_user))
+    if materialization == 'full':
+        build_tables(
+            redshift, 'analytics', 
+            {table: definition['table'] for table, definition in analytics_definitions.items()},
+            analytics_upstream_tables, logger, use_cache
+        )
+        return {}
+
+    is_view = materialization == 'view'
+    definitions = {
+        table: {**definition, materialization: tuned(table, definition[materialization])} 
+        for table, definition in analytics_definitions.items()
+    }
+    definitions_fingerprint = fingerprint(
+        materialization, [list(definition.values()) for definition in definitions.values()]
+    )
+    attribute_fingerprints = [redshift.get_table_fingerprint(table) for table in analytics_attribute_tables]
+    pair_fingerprints = [redshift.get_table_fingerprint(table) for table in analytics_pair_tables]
+    attribute_fingerprint = fingerprint(attribute_fingerprints) if all(attribute_fingerprints) else ''
+    pair_fingerprint = fingerprint(pair_fingerprints) if all(pair_fingerprints) else ''
 
-    logger.info("Creating analytics.songs table...")
-    redshift.execute_query(analytics.create_table_analytics_songs)
-    
-    logger.info("Creating analytics.songs table...")
-    redshift.execute_query(analytics.create_table_analytics_artists)
+    # The parts of the inputs are empty if they have no fingerprint
+    tables_fingerprint = f"{definitions_fingerprint}.{attribute_fingerprint}.{pair_fingerprint}"
+    recorded = [(redshift.get_table_fingerprint(table) or '').split('.') for table in analytics_definitions]
+    tables = {table: definition[materialization] for table, definition in definitions.items()}
+
+    if not use_cache or not all(value[0] == definitions_fingerprint for value in recorded):
+        rebuild_schema(redshift, 'analytics', tables, tables_fingerprint, logger, is_view)
+        return {}
+
+    if attribute_fingerprint and pair_fingerprint and all('.'.join(value) == tables_fingerprint for value in recorded):
+        logger.info("Tables in the analytics schema are up to date, skipping.")
+        return {}
+
+    if not is_view and not (attribute_fingerprint and all(value[1:2] == [attribute_fingerprint] for value in recorded)):
+        logger.info("The msd or spotify tables changed, rebuilding the analytics tables...")
+        rebuild_schema(redshift, 'analytics', tables, tables_fingerprint, logger)
+        return {}
+
+    scopes = {}
+
+    for table, definition in analytics_definitions.items():
+        if is_view:
+            logger.info(f"Refreshing {table} materialized view...")
+            redshift.execute_query(analytics.refresh_view.format(view=table), 
+                                   label=f"refresh_view_{table.replace('.', '_')}", raise_on_error=True)
+        else:
+            logger.info(f"Applying the changes of the mapped pairs to {table}...")
+            for query in definition['delta']:
+                redshift.execute_query(query, label=f"apply_delta_{table.replace('.', '_')}", raise_on_error=True)
+            scopes[table] = definition['delta_scope']
+
+    for table in analytics_definitions:
+        redshift.set_table_fingerprint(table, tables_fingerprint, is_view=is_view)
+
+    return scopes
+
+
+@task
+@measure_stage
+def unload_to_s3(
+        redshift: RedshiftClient, 
+        table_name: str, 
+        destination_path: str, 
+        logger: Logger,
+        partition_by: list[str] = None
+    ):
+    """Task to export a table to S3 as partitioned Parquet files, with a manifest
+
+    Parameters
+    ----------
+    redshift : RedshiftClient
+        Redshift client to run the UNLOAD query
+    table_name : str
+        Name of the table to export
+    destination_path : str
+        S3 prefix to write the Parquet files to
+    logger : Logger
+    partition_by : list[str], optional
+        Columns to partition the exported files by, by default None
+    """
+    logger.info(f"Unloading {table_name} to {destination_path}...")
+    redshift.unload_to_s3(
+        query               = loading.unload_select_table.format(table=table_name),
+        destination_path    = destination_path,
+        iam_role            = get_config()['IAM']['IAM_ROLE_ARN'],
+        region_name         = get_config()['S3']['REGION_NAME'],
+        partition_by        = partition_by
+    )
 
 
 @task
-def run_data_quality_tests(redshift: RedshiftClient, tests: list[Test], logger: Logger):
-    """Task to iterate through a list of data tests, run and report the results to
+def write_query_report(redshift: RedshiftClient, output_path: str, logger: Logger):
+    """Task to write the per-query measurements of the run to a JSON file, and log
+    the statements that took the most time
+
+    Parameters
+    ----------
+    redshift : RedshiftClient
+        Redshift client whose metrics registry will be reported
+    output_path : str
+        Local path to write the report to
+    logger : Logger
+    """
+    redshift.metrics.write_report(output_path, logger)
+
+    for label, stats in list(redshift.metrics.summary().items())[:10]:
+        logger.info(f"{stats['total_seconds']:.1f}s in {stats['calls']} call(s), {stats['rows']} rows: {label}")
+
+
+@task
+def write_stage_report(output_path: str, artifact_key: str, logger: Logger):
+    """Task to write the per-stage measurements of the run (time, records, bytes, API calls)
+    to a JSON file, and publish them as a Prefect table artifact
+
+    Parameters
+    ----------
+    output_path : str
+        Local path to write the report to
+    artifact_key : str
+        Key of the Prefect artifact
+    logger : Logger
+    """
+    stage_metrics.write_report(output_path, logger)
+    stage_metrics.create_artifact(artifact_key, logger)
+
+
+@task
+@measure_stage
+def run_data_quality_tests(
+        redshift: RedshiftClient, 
+        tests: list[Test], 
+        logger: Logger, 
+        scopes: dict[str, str] = None
+    ):
+    """Task to run a list of data tests, one scan per tested table, and report the results
 
     Parameters
     ----------
@@ -278,6 +1000,13 @@ def run_data_quality_tests(redshift: RedshiftClient, tests: list[Test], logger:
     tests : list[Test]
         List of Test objects to run
     logger : Logger
-    """    
+    scopes : dict[str, str], optional
+        SQL predicate restricting the scan checks of a table to the rows loaded in the 
+        current run, for example the ones returned by `create_analytics_tables`, by default 
+        None (test the full tables)
+    """
+    for table, scope in (scopes or {}).items():
+        tests = scoped(tests, scope, [table])
+
     data_quality = DataQualityOperator(client=redshift, logger=logger)
-    data_quality.run_multi_tests(tests)
\ No newline at end of file
+    data_quality.run_batched_tests(tests)
@@ -0,0 +1,49 @@
+import os
+from configparser import ConfigParser
+from pathlib import Path
+from argparse import ArgumentParser
+
+from src.msd import compact_msd
+from src.utils.custom_logger import init_logger
+from src.utils.metrics import stage_metrics
+
+
+def main(input_dir=None, output_path=None):
+    """Merge the per-track H5 files of the MSD into one consolidated store, once. Set 
+    MSD_INPUT_DIR to the store afterwards: extract_msd_data.py then reads the songs of 
+    each folder from it, instead of opening one file per track.
+
+    Parameters
+    ----------
+    input_dir : str, optional
+        Folder of the H5 files, or the MSD archive (.tar.gz), by default MSD_INPUT_DIR 
+        of the config file
+    output_path : str, optional
+        H5 file of the store, by default MSD_STORE_PATH of the config file
+    """
+
+    # Set up
+    p = Path(__file__).with_name('config.cfg')
+    config = ConfigParser()
+    config.read(p)
+
+    data_dir = config['DATA']['DATA_DIR']
+    input_dir = os.path.expanduser(input_dir or config['DATA']['MSD_INPUT_DIR'])
+    output_path = os.path.expanduser(output_path or config.get('DATA', 'MSD_STORE_PATH', fallback=f"{data_dir}/msd_store.h5"))
+
+    logger = init_logger(Path(__file__).name)
+
+    with stage_metrics.measure("compact"):
+        compact_msd(input_dir, output_path, logger=logger)
+
+    stage_metrics.write_report(f"{data_dir}/reports/compact_msd_stages.json", logger)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input_dir', default=None, help="Folder of the H5 files or .tar.gz archive, overrides MSD_INPUT_DIR")
+    parser.add_argument('-o', '--output_path', default=None, help="H5 file of the store, overrides MSD_STORE_PATH")
+
+    args = parser.parse_args()
+    main(args.input_dir, args.output_path)
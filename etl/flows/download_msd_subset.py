@@ -1,6 +1,14 @@
 from src.file_operator import FileOperator
 from configparser import ConfigParser
 from pathlib import Path
+from argparse import ArgumentParser
+
+parser = ArgumentParser()
+parser.add_argument(
+    '-k', '--keep-archive', action='store_true', 
+    help="Don't unpack the archive, extract_msd_data.py can read it directly (set MSD_INPUT_DIR to it)"
+)
+args = parser.parse_args()
 
 p = Path(__file__).with_name('config.cfg')
 
@@ -9,10 +17,14 @@ config.read(p)
 data_dir = config['DATA']['DATA_DIR']
 file_op = FileOperator()
 
+# An interrupted download is continued from its chunks when the script is run again
 if not Path(f"{data_dir}/millionsongsubset.tar.gz").exists():
     file_op.download_file(
         "http://labrosa.ee.columbia.edu/~dpwe/tmp/millionsongsubset.tar.gz", 
-        f"{data_dir}/millionsongsubset.tar.gz"
+        f"{data_dir}/millionsongsubset.tar.gz",
+        checksum    = config.get('DATA', 'MSD_SUBSET_SHA256', fallback='') or None,
+        num_workers = config.getint('DATA', 'DOWNLOAD_WORKERS', fallback=4)
     )
 
-file_op.extract_file(f"{data_dir}/millionsongsubset.tar.gz", data_dir)
\ No newline at end of file
+if not args.keep_archive:
+    file_op.extract_file(f"{data_dir}/millionsongsubset.tar.gz", data_dir)
@@ -1,22 +1,39 @@
+import os
 import string
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from pathlib import Path
 from argparse import ArgumentParser
+import tables
 
-from src.msd import SongExtractor, ArtistExtractor
+from src.msd import SongExtractor, ArtistExtractor, iter_h5_images, track_folder
 from src.aws.s3 import S3Client
+from src.local import LocalS3Client
 from src.utils.custom_logger import init_logger
+from src.utils.metrics import stage_metrics
+from src.utils.progress import PrometheusTextfileExporter, add_global_hook
 
 
-def main(search_dirs="A"):
+def main(search_dirs="A", backend="aws", input_dir=None):
     """Go through the song directories, extract H5 files for data and upload to S3.
-    
+    Records are written to part files of at most [DATA] PART_MAX_MB / PART_MAX_RECORDS, 
+    each one uploaded in the background as soon as it is written. Files of the searched
+    folders left on S3 by previous runs (other parts, files written before the parts) are
+    deleted, so that COPY only loads the files of this run.
 
     Parameters
     ----------
     search_dirs : str, optional
         The search_dirs argument is actually a string of capitalized characters, 
         for example "ABC". Default to "A"
+    backend : str, optional
+        "aws" to upload to S3, "local" to copy the files to the local storage 
+        used by `music_etl.py --backend local`. Default to "aws"
+    input_dir : str, optional
+        Folder of the H5 files, the MSD archive (.tar.gz) to read them from without 
+        unpacking it, or the store written by compact_msd.py, by default MSD_INPUT_DIR 
+        of the config file
     """    
 
     # Set up
@@ -26,18 +43,30 @@ def main(search_dirs="A"):
 
     bucket = config['S3']['BUCKET']
     data_dir = config['DATA']['DATA_DIR']
-    input_dir = config['DATA']['MSD_INPUT_DIR']
+    part_max_mb = config.get('DATA', 'PART_MAX_MB', fallback='')
+    part_max_records = config.get('DATA', 'PART_MAX_RECORDS', fallback='')
+    part_max_bytes = int(float(part_max_mb) * 2**20) if part_max_mb else None
+    part_max_records = int(part_max_records) if part_max_records else None
+    upload_workers = config.getint('DATA', 'UPLOAD_WORKERS', fallback=4)
+    input_dir = os.path.expanduser(input_dir or config['DATA']['MSD_INPUT_DIR'])
     output_dir = f"{data_dir}/msd/"
 
     logger = init_logger(Path(__file__).name)
 
+    prometheus_textfile = config.get('METRICS', 'PROMETHEUS_TEXTFILE', fallback='')
+    if prometheus_textfile:
+        add_global_hook(PrometheusTextfileExporter(prometheus_textfile))
+
     # Prepare client
-    client = S3Client(
-        region_name='us-west-2', 
-        aws_access_key_id=config['AWS']['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key=config['AWS']['AWS_SECRET_ACCESS_KEY'],
-        aws_session_token=config['AWS']['AWS_SESSION_TOKEN'],
-    )
+    if backend == 'local':
+        client = LocalS3Client(config.get('LOCAL', 'ROOT_DIR', fallback=f"{data_dir}/local"), logger)
+    else:
+        client = S3Client(
+            region_name='us-west-2', 
+            aws_access_key_id=config['AWS']['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=config['AWS']['AWS_SECRET_ACCESS_KEY'],
+            aws_session_token=config['AWS']['AWS_SESSION_TOKEN'],
+        )
 
 
     song_extractor = SongExtractor()
@@ -50,30 +79,101 @@ def main(search_dirs="A"):
         for char2 in string.ascii_uppercase:
             patterns.append(f"{char1}/{char2}")
 
-    
-    # Walk through the search patterns, search for H5 files, 
-    # and combine their data into a single JSON file.
+    def extract_folders():
+        """Songs & artists of each folder (search pattern). If the input is the MSD archive 
+        instead of a folder, the H5 files of the search patterns are streamed out of it in 
+        one pass, which stops after the last pattern, and the files of a folder are extracted 
+        once the archive moves on to the next folder. If it is a store written by 
+        compact_msd.py, the songs of each folder are read from it."""
+        if os.path.isfile(input_dir) and tables.is_hdf5_file(input_dir):
+            # Consolidated store written by compact_msd.py
+            for pattern in patterns:
+                logger.info(f"Processing {input_dir}:{pattern}")
+
+                with stage_metrics.measure("extract"):
+                    songs = song_extractor.extract_store(input_dir, pattern)
+                    artists = artists_extractor.extract_store(input_dir, pattern)
+                yield pattern, songs, artists
+
+        elif os.path.isfile(input_dir):
+            images = iter_h5_images(input_dir, folders=patterns)
+            seen = set()
+
+            for pattern, folder_images in groupby(images, key=lambda image: track_folder(image[0])):
+                if pattern in seen:
+                    raise ValueError(f"The files of {pattern} are not next to each other in {input_dir}")
+                seen.add(pattern)
+
+                logger.info(f"Processing {input_dir}:{pattern}")
+                with stage_metrics.measure("extract"):
+                    folder_images = list(folder_images)
+                    songs = song_extractor.extract_many_images(folder_images)
+                    artists = artists_extractor.extract_many_images(folder_images)
+                yield pattern, songs, artists
+        else:
+            for pattern in patterns:
+                search_path = f"{input_dir}/{pattern}/**/*.h5"
+                logger.info(f"Processing {search_path}")
+
+                with stage_metrics.measure("extract"):
+                    songs = song_extractor.extract_many_files(search_path)
+                    artists = artists_extractor.extract_many_files(search_path)
+                yield pattern, songs, artists
+
+    # Walk through the search patterns, search for H5 files, and combine their data 
+    # into JSON part files. Every part is uploaded by a background thread as soon as 
+    # it is written, while the next parts are extracted.
 
-    for pattern in patterns:
-        search_path         = f"{input_dir}/{pattern}/**/*.h5"
+    uploader = ThreadPoolExecutor(max_workers=upload_workers)
+    uploads, uploaded_parts = [], []
+
+    def upload(part):
+        # Measured in the upload thread: the stages opened in the main thread are context 
+        # variables, which the threads of the pool don't see
+        with stage_metrics.measure("upload"):
+            client.upload_file(part.path, bucket, part.remote_path)
+
+    def upload_part(part):
+        uploaded_parts.append(part)
+        uploads.append(uploader.submit(upload, part))
+
+    for pattern, songs, artists in extract_folders():
         songs_output_dir   = f"{output_dir}/songs/{pattern}.json"
         artists_output_dir = f"{output_dir}/artists/{pattern}.json"
         songs_remote_path   = f"msd/songs/{pattern}.json"
         artists_remote_path = f"msd/artists/{pattern}.json"
 
-        logger.info(f"Processing {search_path}")
-
-        songs = song_extractor.extract_many_files(search_path)
-        artists = artists_extractor.extract_many_files(search_path)
-
         if songs == []:
             continue
         else:
-            song_extractor.output_json(songs, songs_output_dir)
-            client.upload_file(songs_output_dir, bucket, songs_remote_path)
-
-            artists_extractor.output_json(artists, artists_output_dir)
-            client.upload_file(artists_output_dir, bucket, artists_remote_path)
+            with stage_metrics.measure("write_json"):
+                song_extractor.output_json(
+                    songs, songs_output_dir, max_bytes=part_max_bytes, max_records=part_max_records,
+                    on_part=upload_part, remote_path=songs_remote_path
+                )
+                artists_extractor.output_json(
+                    artists, artists_output_dir, max_bytes=part_max_bytes, max_records=part_max_records,
+                    on_part=upload_part, remote_path=artists_remote_path
+                )
+
+    # Raise the error of a failed upload, if any
+    uploader.shutdown(wait=True)
+    for future in uploads:
+        future.result()
+
+    # Files of the searched folders that this run didn't write: parts of a previous run
+    # that wrote more of them, or files written before the parts, for example msd/songs/A/B.json
+    written = {part.remote_path for part in uploaded_parts}
+    for prefix in ["msd/songs/", "msd/artists/"]:
+        stale = [
+            key for key in client.list_etags(f"s3://{bucket}/{prefix}")
+            if key.removeprefix(prefix).split('.')[0] in patterns and key not in written
+        ]
+        with stage_metrics.measure("delete_stale"):
+            client.delete_files(bucket, stale)
+
+    stage_metrics.write_report(f"{data_dir}/reports/extract_msd_data_stages.json", logger)
+    stage_metrics.create_artifact("extract-msd-data-stages", logger)
 
 
 if __name__ == "__main__":
@@ -81,13 +181,15 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-s", "--search_dirs", default="A")
     parser.add_argument('-m', '--mode', default='dev', choices=['dev', 'prod'], required=True)
+    parser.add_argument('-b', '--backend', default='aws', choices=['aws', 'local'])
+    parser.add_argument('-i', '--input_dir', default=None, help="Folder of the H5 files, .tar.gz archive or compacted store, overrides MSD_INPUT_DIR")
 
     args = parser.parse_args()
 
     if args.mode == 'dev':
         # If run in dev mode, use search_dirs
-        main(args.search_dirs)
+        main(args.search_dirs, args.backend, args.input_dir)
     
     elif args.mode == 'prod':
         # If run in prod mode, go through all folders
-        main(string.ascii_uppercase)
\ No newline at end of file
+        main(string.ascii_uppercase, args.backend, args.input_dir)
\ No newline at end of file
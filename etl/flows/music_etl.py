@@ -1,37 +1,49 @@
-from configparser import ConfigParser
-from pathlib import Path
+import os
+import math
+from datetime import timedelta
 from argparse import ArgumentParser
 
-from prefect import flow, get_run_logger
-from prefect.task_runners import SequentialTaskRunner
+from prefect import flow, get_run_logger, allow_failure, unmapped
+from prefect.task_runners import SequentialTaskRunner, ConcurrentTaskRunner
 
 from src import etl_queries as queries
 from src.aws.s3 import S3Client
 from src.aws.redshift import RedshiftClient
-from src.spotify import SpotifyClient, SongFetcher, ArtistFetcher
+from src.spotify import SpotifyClient, SongFetcher, ArtistFetcher, AlbumFetcher, AudioFeaturesFetcher, EntityStore
 from src.data_quality import all_tests
+from src.data_quality.tests import scanning
+from src.utils.progress import PrometheusTextfileExporter, add_global_hook
 
 from flows import common_tasks as etl
 
 @flow(
-    task_runner=SequentialTaskRunner(),
+    task_runner=ConcurrentTaskRunner(),
     name='music_etl', 
     description="""
         Load source msd data from S3, search for songs and artists in Spotify, and then combine in final analytics tables.
     """
     )
-def music_etl(mode: str = "dev"):
+def music_etl(mode: str = "dev", use_cache: bool = True, backend: str = "aws"):
 
     logger = get_run_logger()
 
-    p = Path(__file__).with_name('config.cfg')
-    config = ConfigParser()
-    config.read(p)
+    config = etl.get_config()
+
+    num_partitions      = int(config['SPOTIFY'].get('NUM_PARTITIONS', 8))
 
     if mode == 'dev':
-        limit_clause = "limit 20"
+        # Spread the 20 dev songs / artists over the partitions
+        max_rows = math.ceil(20 / num_partitions)
     elif mode == 'prod':
-        limit_clause = ""
+        max_rows = None
+
+    analytics_materialization = config.get('ANALYTICS', 'MATERIALIZATION', fallback='full')
+    if analytics_materialization not in etl.analytics_materializations:
+        raise ValueError(f"[ANALYTICS] MATERIALIZATION must be one of {etl.analytics_materializations}")
+
+    prometheus_textfile = config.get('METRICS', 'PROMETHEUS_TEXTFILE', fallback='')
+    if prometheus_textfile:
+        add_global_hook(PrometheusTextfileExporter(prometheus_textfile))
 
     region_name         = config['S3']['REGION_NAME']
     data_dir            = config['DATA']['DATA_DIR']
@@ -40,90 +52,176 @@ def music_etl(mode: str = "dev"):
     s3_msd_artists      = config['S3']['S3_MSD_ARTISTS']
     s3_spotify_songs    = config['S3']['S3_SPOTIFY_SONGS']
     s3_spotify_artists  = config['S3']['S3_SPOTIFY_ARTISTS']
+    s3_spotify_albums   = config['S3']['S3_SPOTIFY_ALBUMS']
+    s3_spotify_audio_features = config['S3']['S3_SPOTIFY_AUDIO_FEATURES']
     s3_mapped_songs     = config['S3']['S3_MAPPED_SONGS']
     s3_mapped_artists   = config['S3']['S3_MAPPED_ARTISTS']
+    s3_analytics_songs  = config['S3']['S3_ANALYTICS_SONGS']
+    s3_analytics_artists = config['S3']['S3_ANALYTICS_ARTISTS']
 
     stg_msd         = queries.StagingMsdQueries()
     stg_spotify     = queries.StagingSpotifyQueries()
     stg_mapped      = queries.StagingMappedQueries()
 
-    redshift = RedshiftClient(
-        host        = config['REDSHIFT']['HOST'],
-        port        = int(config['REDSHIFT']['PORT']),
-        database    = config['REDSHIFT']['DATABASE'],
-        user        = config['REDSHIFT']['USERNAME'],
-        password    = config['REDSHIFT']['PASSWORD'],
-        logger      = logger
-    )
-
-    s3 = S3Client(
-        region_name             = region_name,
-        aws_access_key_id       = config['AWS']['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key   = config['AWS']['AWS_SECRET_ACCESS_KEY'],
-        aws_session_token       = config['AWS']['AWS_SESSION_TOKEN'],
-        logger                  = logger
+    if backend == 'local':
+        # Embedded database, filesystem storage and synthetic Spotify data, no cloud resources needed
+        from src.local import LocalS3Client, LocalRedshiftClient, SyntheticSpotifyClient
+
+        local_root_dir = config.get('LOCAL', 'ROOT_DIR', fallback=f"{data_dir}/local")
+
+        redshift = LocalRedshiftClient(
+            root_dir    = local_root_dir,
+            logger      = logger,
+            slow_query_seconds = float(config['REDSHIFT'].get('SLOW_QUERY_SECONDS', 60))
+        )
+        s3 = LocalS3Client(root_dir=local_root_dir, logger=logger)
+        spotify = SyntheticSpotifyClient(
+            seed            = config.getint('LOCAL', 'SPOTIFY_SEED', fallback=0),
+            latency_seconds = config.getfloat('LOCAL', 'SPOTIFY_LATENCY_SECONDS', fallback=0.0),
+            logger          = logger
+        )
+
+    else:
+        redshift = RedshiftClient(
+            host        = config['REDSHIFT']['HOST'],
+            port        = int(config['REDSHIFT']['PORT']),
+            database    = config['REDSHIFT']['DATABASE'],
+            user        = config['REDSHIFT']['USERNAME'],
+            password    = config['REDSHIFT']['PASSWORD'],
+            logger      = logger,
+            slow_query_seconds = float(config['REDSHIFT'].get('SLOW_QUERY_SECONDS', 60))
+        )
+
+        s3 = S3Client(
+            region_name             = region_name,
+            aws_access_key_id       = config['AWS']['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key   = config['AWS']['AWS_SECRET_ACCESS_KEY'],
+            aws_session_token       = config['AWS']['AWS_SESSION_TOKEN'],
+            logger                  = logger
+        )
+
+        spotify = SpotifyClient(
+            client_id       = config['SPOTIFY']['CLIENT_ID'], 
+            client_secret   = config['SPOTIFY']['CLIENT_SECRET'],
+            logger          = logger
+        )
+    
+    # Songs and artists fetched by previous runs are read from the entity store, 
+    # only the missing or stale ones are requested
+    entity_store_path   = config.get('SPOTIFY', 'ENTITY_STORE_PATH', fallback='')
+    entity_store        = EntityStore(os.path.expanduser(entity_store_path), logger) if entity_store_path else None
+    entity_max_age      = timedelta(days=config.getfloat('SPOTIFY', 'ENTITY_MAX_AGE_DAYS', fallback=30))
+
+    artists_fetcher = ArtistFetcher(spotify, logger, store=entity_store, max_age=entity_max_age)
+    albums_fetcher  = AlbumFetcher(spotify, logger, store=entity_store, max_age=entity_max_age)
+    audio_features_fetcher = AudioFeaturesFetcher(spotify, logger, store=entity_store, max_age=entity_max_age)
+    # Search hits are scored against the MSD songs, only the best ones are fetched
+    songs_fetcher = SongFetcher(
+        spotify, logger,
+        min_score   = config.getfloat('SPOTIFY', 'MIN_MATCH_SCORE', fallback=None),
+        top_k       = config.getint('SPOTIFY', 'MAX_MATCHES', fallback=None),
+        store       = entity_store,
+        max_age     = entity_max_age
     )
 
-    spotify = SpotifyClient(
-        client_id       = config['SPOTIFY']['CLIENT_ID'], 
-        client_secret   = config['SPOTIFY']['CLIENT_SECRET'],
-        logger          = logger
-    )
-    
-    artists_fetcher = ArtistFetcher(spotify, logger)
-    songs_fetcher = SongFetcher(spotify, logger)
 
+    # Stages whose inputs haven't changed since the last run are skipped
+    if use_cache:
+        search_spotify  = etl.search_spotify.with_options(cache_expiration=etl.cache_expiration())
+        fetch_spotify   = etl.fetch_spotify.with_options(cache_expiration=etl.cache_expiration())
+        fetch_albums    = etl.fetch_spotify_albums.with_options(cache_expiration=etl.cache_expiration())
+        fetch_audio_features = etl.fetch_spotify_audio_features.with_options(cache_expiration=etl.cache_expiration())
+    else:
+        search_spotify  = etl.search_spotify.with_options(cache_key_fn=lambda *_: None)
+        fetch_spotify   = etl.fetch_spotify.with_options(cache_key_fn=lambda *_: None)
+        fetch_albums    = etl.fetch_spotify_albums.with_options(cache_key_fn=lambda *_: None)
+        fetch_audio_features = etl.fetch_spotify_audio_features.with_options(cache_key_fn=lambda *_: None)
 
     refresh_staging_schema  = etl.refresh_staging_schema.submit(redshift, logger)
 
     # create staging MSD tables
     stage_msd_songs     = etl.copy_s3_to_staging.submit(redshift, stg_msd.create_table_songs, 'staging.msd_songs', s3_msd_songs, 
-                                                logger, wait_for = [refresh_staging_schema])
+                                                logger, s3, use_cache, wait_for = [refresh_staging_schema])
 
     stage_msd_artists   = etl.copy_s3_to_staging.submit(redshift, stg_msd.create_table_artists, 'staging.msd_artists', s3_msd_artists, 
-                                                logger, wait_for = [refresh_staging_schema])
+                                                logger, s3, use_cache, wait_for = [refresh_staging_schema])
 
 
-    # Search MSD songs on spotify & create staging tables
-    mapped_songs        = etl.search_spotify.submit(redshift, songs_fetcher, 'songs', limit_clause, f"{data_dir}/mapped/songs.json", 
-                                                logger, wait_for = [stage_msd_songs])
-    
-    mapped_artists      = etl.search_spotify.submit(redshift, artists_fetcher, 'artists', limit_clause, f"{data_dir}/mapped/artists.json", 
-                                                logger, wait_for = [stage_msd_artists])
+    # Search MSD songs on spotify & create staging tables. 
+    # The search input is split in ranges of MSD IDs that are searched, fetched and uploaded independently
+    partitions          = list(range(num_partitions))
+    song_parts          = [f"songs/part-{i:04d}.json" for i in partitions]
+    artist_parts        = [f"artists/part-{i:04d}.json" for i in partitions]
 
+    plan_songs          = etl.plan_search_input.submit(redshift, 'songs', num_partitions, logger, wait_for = [stage_msd_songs])
+    plan_artists        = etl.plan_search_input.submit(redshift, 'artists', num_partitions, logger, wait_for = [stage_msd_artists])
 
-    upload_mapped_songs     = etl.upload_files.submit(s3, f"{data_dir}/mapped/songs.json", "mapped/songs.json", logger, wait_for = [mapped_songs])
-    upload_mapped_artists   = etl.upload_files.submit(s3, f"{data_dir}/mapped/artists.json","mapped/artists.json", logger, wait_for = [mapped_artists])
+    mapped_songs        = search_spotify.map(unmapped(redshift), unmapped(songs_fetcher), 'songs', plan_songs.result(), 
+                                                unmapped(max_rows), [f"{data_dir}/mapped/{part}" for part in song_parts], 
+                                                unmapped(logger), remote_file_path=[f"mapped/{part}" for part in song_parts])
+    
+    mapped_artists      = search_spotify.map(unmapped(redshift), unmapped(artists_fetcher), 'artists', plan_artists.result(), 
+                                                unmapped(max_rows), [f"{data_dir}/mapped/{part}" for part in artist_parts], 
+                                                unmapped(logger), remote_file_path=[f"mapped/{part}" for part in artist_parts])
 
 
-    stage_mapped_songs      = etl.copy_s3_to_staging.submit(redshift, stg_mapped.create_table_songs,'staging.mapped_songs', s3_mapped_songs, 
-                                                logger, wait_for = [upload_mapped_songs])
+    # Small loads are inserted directly, larger ones are copied from the uploaded partitions
+    stage_mapped_songs      = etl.load_to_staging.submit(redshift, s3, mapped_songs, stg_mapped.create_table_songs, 'staging.mapped_songs', 
+                                                s3_mapped_songs, logger, use_cache)
 
-    stage_mapped_artists    = etl.copy_s3_to_staging.submit(redshift, stg_mapped.create_table_artists,'staging.mapped_artists', s3_mapped_artists, 
-                                                logger, wait_for = [upload_mapped_artists])
+    stage_mapped_artists    = etl.load_to_staging.submit(redshift, s3, mapped_artists, stg_mapped.create_table_artists, 'staging.mapped_artists', 
+                                                s3_mapped_artists, logger, use_cache)
 
     
-    # Use search result to fetch details from Spotify
-    fetch_spotify_songs     = etl.fetch_spotify.submit(mapped_songs, songs_fetcher, 'songs', f"{data_dir}/spotify/songs.json", logger)
-    fetch_spotify_artists   = etl.fetch_spotify.submit(mapped_artists, artists_fetcher, 'artists', f"{data_dir}/spotify/artists.json", logger)
+    # Use search result to fetch details from Spotify, partition by partition
+    fetch_spotify_songs     = fetch_spotify.map(mapped_songs, unmapped(songs_fetcher), 'songs', 
+                                                [f"{data_dir}/spotify/{part}" for part in song_parts], unmapped(logger), 
+                                                remote_file_path=[f"spotify/{part}" for part in song_parts])
+
+    fetch_spotify_artists   = fetch_spotify.map(mapped_artists, unmapped(artists_fetcher), 'artists', 
+                                                [f"{data_dir}/spotify/{part}" for part in artist_parts], unmapped(logger), 
+                                                remote_file_path=[f"spotify/{part}" for part in artist_parts])
     
-    upload_spotify_songs    = etl.upload_files.submit(s3, f"{data_dir}/spotify/songs.json", "spotify/songs.json", logger, wait_for = [fetch_spotify_songs])
-    upload_spotify_artists  = etl.upload_files.submit(s3, f"{data_dir}/spotify/artists.json", "spotify/artists.json", logger, wait_for = [fetch_spotify_artists])
+    stage_spotify_songs     = etl.load_to_staging.submit(redshift, s3, fetch_spotify_songs, stg_spotify.create_table_songs, "staging.spotify_songs", 
+                                                s3_spotify_songs, logger, use_cache)
+
+    stage_spotify_artists   = etl.load_to_staging.submit(redshift, s3, fetch_spotify_artists, stg_spotify.create_table_artists, "staging.spotify_artists", 
+                                                s3_spotify_artists, logger, use_cache)
+
+    # Albums of all the fetched songs, deduplicated and requested in batches
+    fetch_spotify_albums    = fetch_albums.submit(fetch_spotify_songs, albums_fetcher, f"{data_dir}/spotify/albums/part-0000.json", 
+                                                logger, remote_file_path="spotify/albums/part-0000.json")
 
-    stage_spotify_songs     = etl.copy_s3_to_staging.submit(redshift, stg_spotify.create_table_songs, "staging.spotify_songs", s3_spotify_songs, 
-                                                        logger, wait_for = [upload_spotify_songs])
+    stage_spotify_albums    = etl.load_to_staging.submit(redshift, s3, [fetch_spotify_albums], stg_spotify.create_table_albums, "staging.spotify_albums", 
+                                                s3_spotify_albums, logger, use_cache)
 
-    stage_spotify_artists   = etl.copy_s3_to_staging.submit(redshift, stg_spotify.create_table_artists, "staging.spotify_artists", s3_spotify_artists, 
-                                                        logger, wait_for = [upload_spotify_artists])
+    # Audio features of all the fetched songs, requested in batches and written as CSV columns
+    fetch_spotify_audio_features = fetch_audio_features.submit(fetch_spotify_songs, audio_features_fetcher, 
+                                                f"{data_dir}/spotify/audio_features/part-0000.csv", logger, 
+                                                remote_file_path="spotify/audio_features/part-0000.csv")
+
+    stage_spotify_audio_features = etl.load_to_staging.submit(redshift, s3, [fetch_spotify_audio_features], 
+                                                stg_spotify.create_table_audio_features, "staging.spotify_audio_features", 
+                                                s3_spotify_audio_features, logger, use_cache)
     
     
     # Create analytics tables
 
-    create_msd_tables              = etl.create_msd_tables.submit(redshift, logger, wait_for=[stage_msd_songs, stage_msd_artists])
-    create_spotify_tables          = etl.create_spotify_tables.submit(redshift, logger, wait_for=[stage_spotify_songs, stage_spotify_artists])
-    create_mapped_tables           = etl.create_mapped_tables.submit(redshift, logger, wait_for=[stage_mapped_songs, stage_mapped_artists])
+    # Materialized views are dropped with the tables they read, so these are refilled in place instead
+    refill_in_place                = analytics_materialization == 'view'
+    create_msd_tables              = etl.create_msd_tables.submit(redshift, logger, use_cache, refill_in_place, 
+                                        wait_for=[stage_msd_songs, stage_msd_artists])
+    create_spotify_tables          = etl.create_spotify_tables.submit(redshift, logger, use_cache, refill_in_place,
+                                        wait_for=[
+                                            stage_spotify_songs, 
+                                            stage_spotify_artists, 
+                                            stage_spotify_albums, 
+                                            stage_spotify_audio_features
+                                        ])
+    create_mapped_tables           = etl.create_mapped_tables.submit(redshift, logger, use_cache, refill_in_place, 
+                                        wait_for=[stage_mapped_songs, stage_mapped_artists])
 
-    create_analytics_tables        = etl.create_analytics_tables.submit(redshift, logger, 
+    create_analytics_tables        = etl.create_analytics_tables.submit(redshift, logger, use_cache, analytics_materialization,
                                         wait_for=[
                                             create_msd_tables, 
                                             create_spotify_tables, 
@@ -131,13 +229,40 @@ def music_etl(mode: str = "dev"):
                                         ])
 
 
-    etl.run_data_quality_tests.submit(redshift, all_tests, logger, wait_for=[create_analytics_tables])
+    # Export analytics tables to S3 as Parquet for downstream consumers
+    unload_analytics_songs      = etl.unload_to_s3.submit(redshift, 'analytics.songs', s3_analytics_songs, logger, 
+                                    partition_by=['year'], wait_for=[create_analytics_tables])
+    unload_analytics_artists    = etl.unload_to_s3.submit(redshift, 'analytics.artists', s3_analytics_artists, logger, 
+                                    wait_for=[create_analytics_tables])
+
+    # Rows of materialized views are not counted under their name in the catalog
+    quality_tests               = scanning(all_tests, list(etl.analytics_definitions)) if analytics_materialization == 'view' else all_tests
+    # With the 'table' materialization, the analytics checks only scan the rows of the applied delta
+    data_quality_tests          = etl.run_data_quality_tests.submit(redshift, quality_tests, logger, 
+                                    scopes=create_analytics_tables)
+
+    final_tasks                 = [allow_failure(unload_analytics_songs), 
+                                   allow_failure(unload_analytics_artists), 
+                                   allow_failure(data_quality_tests)]
+
+    etl.write_query_report.submit(redshift, f"{data_dir}/reports/redshift_queries.json", logger, wait_for=final_tasks)
+    etl.write_stage_report.submit(f"{data_dir}/reports/music_etl_stages.json", "music-etl-stages", logger, wait_for=final_tasks)
 
 if __name__ == "__main__":
 
     parser = ArgumentParser()
     parser.add_argument('-m', '--mode', default='dev', choices=['dev', 'prod'], required=True)
+    parser.add_argument('-s', '--sequential', action='store_true', 
+                        help="Run tasks one after another instead of concurrently, for debugging")
+    parser.add_argument('--no-cache', action='store_true', 
+                        help="Recompute every stage even if its inputs haven't changed")
+    parser.add_argument('-b', '--backend', default='aws', choices=['aws', 'local'],
+                        help="Run against Redshift, S3 & Spotify, or fully offline on the local machine")
     args = parser.parse_args()
 
-    music_etl(mode=args.mode)
+    if args.sequential:
+        music_etl.with_options(task_runner=SequentialTaskRunner())(
+            mode=args.mode, use_cache=not args.no_cache, backend=args.backend)
+    else:
+        music_etl(mode=args.mode, use_cache=not args.no_cache, backend=args.backend)
     
\ No newline at end of file
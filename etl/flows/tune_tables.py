@@ -0,0 +1,98 @@
+import os
+from configparser import ConfigParser
+from pathlib import Path
+from argparse import ArgumentParser
+
+from src import etl_queries as queries
+from src.aws.redshift import RedshiftClient
+from src.tuning.physical_design import PhysicalDesignTuner, table_definitions, save_designs
+from src.utils.custom_logger import init_logger
+
+
+def main(backend="aws", apply=False):
+    """Propose distribution styles, sort keys and column encodings for the staging, msd, spotify,
+    mapped and analytics tables, from the join keys and filters of the analytics queries and
+    ANALYZE COMPRESSION. The designs are written to [TUNING] DESIGN_PATH, where music_etl.py
+    reads them to create the tables, and a report of the table sizes and query costs before and
+    after is written to {DATA_DIR}/reports/physical_design.json.
+
+    Parameters
+    ----------
+    backend : str, optional
+        "aws" to tune the Redshift cluster, "local" for the database used by
+        `music_etl.py --backend local`. Default to "aws"
+    apply : bool, optional
+        If True, also alter the existing tables, instead of waiting for the next
+        run of the ETL to recreate them. Default to False
+    """
+
+    # Set up
+    p = Path(__file__).with_name('config.cfg')
+    config = ConfigParser()
+    config.read(p)
+
+    data_dir = config['DATA']['DATA_DIR']
+    design_path = os.path.expanduser(config.get('TUNING', 'DESIGN_PATH', fallback=''))
+
+    logger = init_logger(Path(__file__).name)
+
+    if backend == 'local':
+        from src.local import LocalRedshiftClient
+        redshift = LocalRedshiftClient(config.get('LOCAL', 'ROOT_DIR', fallback=f"{data_dir}/local"), logger)
+    else:
+        redshift = RedshiftClient(
+            host        = config['REDSHIFT']['HOST'],
+            port        = int(config['REDSHIFT']['PORT']),
+            database    = config['REDSHIFT']['DATABASE'],
+            user        = config['REDSHIFT']['USERNAME'],
+            password    = config['REDSHIFT']['PASSWORD'],
+            logger      = logger
+        )
+
+    analytics = queries.AnalyticsQueries()
+    definitions = table_definitions(
+        queries.StagingMsdQueries(), queries.StagingMappedQueries(), queries.StagingSpotifyQueries(), analytics
+    )
+    tuner = PhysicalDesignTuner(
+        client          = redshift,
+        definitions     = definitions,
+        queries         = [query for query in vars(queries.AnalyticsQueries).values() if isinstance(query, str)],
+        logger          = logger,
+        all_max_rows    = config.getint('TUNING', 'ALL_MAX_ROWS', fallback=0)
+    )
+
+    # Queries whose plans are compared before and after
+    probes = {
+        'analytics.songs'           : analytics.select_analytics_songs.format(delta_join=""),
+        'analytics.artists'         : analytics.select_analytics_artists.format(delta_join=""),
+        'analytics.songs delta'     : analytics.insert_new_analytics_songs,
+        'analytics.artists delta'   : analytics.insert_new_analytics_artists,
+    }
+
+    before = tuner.measure(probes)
+    designs = tuner.propose()
+
+    if design_path:
+        save_designs(designs, design_path)
+        logger.info(f"Designs written to {design_path}, the next ETL run creates the tables with them")
+    else:
+        logger.warning("[TUNING] DESIGN_PATH is not set, the ETL will keep creating the tables without the designs")
+
+    if apply:
+        # Materialized views can't be altered, they get their design when the ETL creates them again
+        views = ['analytics.songs', 'analytics.artists'] if config.get('ANALYTICS', 'MATERIALIZATION', fallback='full') == 'view' else []
+        tuner.apply(designs, views)
+
+    after = tuner.measure(probes)
+    tuner.report(before, after, designs, f"{data_dir}/reports/physical_design.json")
+    redshift.close()
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument('-b', '--backend', default='aws', choices=['aws', 'local'])
+    parser.add_argument('-a', '--apply', action='store_true', help="Also alter the existing tables")
+
+    args = parser.parse_args()
+    main(args.backend, args.apply)
@@ -0,0 +1,159 @@
+"""Benchmark the MSD extractors on synthetic datasets of increasing size.
+
+Every (extractor, serialization) case runs in its own process, so that its peak RSS can be
+measured. Results are appended to a JSON-lines file together with the current git commit,
+and --compare prints the latest result of every case for each commit.
+
+Examples:
+    python scripts/benchmark_msd_extraction.py --scales 1000 10000
+    python scripts/benchmark_msd_extraction.py --compare
+"""
+
+import os
+import json
+import glob
+import time
+import logging
+import resource
+import subprocess
+import multiprocessing
+from pathlib import Path
+from datetime import datetime
+from argparse import ArgumentParser
+
+from src.msd import SongExtractor, ArtistExtractor
+from src.msd.synthetic import SyntheticMsdGenerator
+from src.utils.custom_logger import init_logger
+
+
+logger = init_logger(Path(__file__).name)
+
+extractors = {
+    'songs'     : SongExtractor,
+    'artists'   : ArtistExtractor,
+}
+
+serializations = {
+    'ndjson'    : {'new_line_delimited': True},
+    'json'      : {'new_line_delimited': False},
+}
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def prepare_dataset(data_dir: str, num_files: int, seed: int = 0) -> str:
+    """Generate the synthetic dataset of this size, unless it was generated before"""
+    dataset_dir = f"{data_dir}/synthetic_msd_{num_files}"
+    done_marker = f"{dataset_dir}/.done"
+
+    if not os.path.exists(done_marker):
+        logger.info(f"Generating {num_files} synthetic files in {dataset_dir}...")
+        SyntheticMsdGenerator(seed=seed, logger=logger).generate_many(dataset_dir, num_files)
+        Path(done_marker).touch()
+
+    return dataset_dir
+
+
+def run_case(extractor_name: str, serialization: str, dataset_dir: str, output_path: str, queue):
+    """Run one benchmark case. Meant to be run in a child process."""
+    quiet_logger = logging.getLogger(f"benchmark.{extractor_name}")
+    quiet_logger.setLevel(logging.WARNING)
+    extractor = extractors[extractor_name](quiet_logger)
+
+    start = time.perf_counter()
+    data = extractor.extract_many_files(f"{dataset_dir}/**/*.h5")
+    extract_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extractor.output_json(data, output_path, **serializations[serialization])
+    write_seconds = time.perf_counter() - start
+
+    queue.put({
+        'records'           : len(data),
+        'extract_seconds'   : extract_seconds,
+        'write_seconds'     : write_seconds,
+        'output_bytes'      : os.path.getsize(output_path) if os.path.exists(output_path) else 0,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb'       : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def benchmark(scales: list[int], data_dir: str, results_path: str):
+    commit = get_commit()
+    context = multiprocessing.get_context('spawn')
+
+    for num_files in scales:
+        dataset_dir = prepare_dataset(data_dir, num_files)
+        num_found = len(glob.glob(f"{dataset_dir}/**/*.h5", recursive=True))
+
+        for extractor_name in extractors:
+            for serialization in serializations:
+                output_path = f"{data_dir}/output/{extractor_name}_{num_files}.{serialization}"
+                queue = context.Queue()
+                process = context.Process(
+                    target=run_case, args=(extractor_name, serialization, dataset_dir, output_path, queue))
+                process.start()
+                measures = queue.get()
+                process.join()
+
+                result = {
+                    'commit'        : commit,
+                    'timestamp'     : datetime.now().isoformat(),
+                    'scale'         : num_files,
+                    'extractor'     : extractor_name,
+                    'serialization' : serialization,
+                    'files'         : num_found,
+                    'files_per_s'   : num_found / measures['extract_seconds'] if measures['extract_seconds'] > 0 else None,
+                    **measures
+                }
+                logger.info(
+                    f"{num_files} files, {extractor_name}, {serialization}: "
+                    f"{result['files_per_s']:.0f} files/s, {measures['peak_rss_mb']:.0f} MB peak RSS, "
+                    f"{measures['output_bytes']} bytes"
+                )
+
+                os.makedirs(os.path.dirname(results_path), exist_ok=True)
+                with open(results_path, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+
+
+def compare(results_path: str):
+    """Print the latest result of every case, one column per commit"""
+    with open(results_path, 'r') as f:
+        results = [json.loads(line) for line in f]
+
+    commits = list(dict.fromkeys(result['commit'] for result in results))
+    latest = {}
+    for result in results:
+        latest[(result['scale'], result['extractor'], result['serialization'], result['commit'])] = result
+
+    cases = sorted({key[:3] for key in latest})
+    print('scale, extractor, serialization | ' + ' | '.join(commits) + '  (files/s, peak MB)')
+    for case in cases:
+        cells = []
+        for commit in commits:
+            result = latest.get((*case, commit))
+            cells.append(f"{result['files_per_s']:.0f}, {result['peak_rss_mb']:.0f}" if result else '-')
+        print(f"{case[0]}, {case[1]}, {case[2]} | " + ' | '.join(cells))
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument('--scales', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--data-dir', default='./tmp/benchmark')
+    parser.add_argument('--results', default='./tmp/benchmark/msd_extraction.jsonl')
+    parser.add_argument('--compare', action='store_true', help="Compare stored results across commits")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+    else:
+        benchmark(args.scales, args.data_dir, args.results)
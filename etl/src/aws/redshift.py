@@ -1,7 +1,15 @@
-import redshift_connector
-from redshift_connector import ProgrammingError
+import json
+import time
+import threading
+from datetime import datetime
 from src.utils.custom_logger import init_logger
+from src.utils.metrics import QueryMetric, QueryMetricsRegistry
+from src.etl_queries import LoadingQueries, TuningQueries
 from logging import Logger
+
+loading = LoadingQueries()
+tuning = TuningQueries()
+
 class RedshiftClient:
     """Custom Redshift client class"""
     def __init__(
@@ -12,52 +20,178 @@ class RedshiftClient:
             user: str = 'awsuser', 
             password: str = None,
             logger: Logger = None,
-            autocommit=True
+            autocommit=True,
+            metrics: QueryMetricsRegistry = None,
+            slow_query_seconds: float = 60,
+            track_query_id: bool = True
         ) -> None:
         self.logger = logger or init_logger(self.__class__.__name__)
+        self.metrics = metrics or QueryMetricsRegistry()
+        self.slow_query_seconds = slow_query_seconds
+        self.track_query_id = track_query_id
+
+        self._init_kwargs = dict(
+            host=host, database=database, port=port, user=user, password=password, 
+            autocommit=autocommit, slow_query_seconds=slow_query_seconds, track_query_id=track_query_id
+        )
+
+        # A connection can only run one query at a time, so every thread that uses 
+        # this client (e.g. tasks run by a ConcurrentTaskRunner) gets its own connection.
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        # Create connection for the current thread
+        self.conn
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
 
-        # Create connection
+    def _connect(self):
+        # Imported on first connection, so that importing this module stays cheap
+        import redshift_connector
+
+        kwargs = self._init_kwargs
         try:
-            self.conn = redshift_connector.connect(
-                host=host, database=database, port=port, user=user, password=password)
-            self.conn.autocommit = autocommit
+            conn = redshift_connector.connect(
+                host=kwargs['host'], database=kwargs['database'], port=kwargs['port'], 
+                user=kwargs['user'], password=kwargs['password'])
+            conn.autocommit = kwargs['autocommit']
             self.logger.info(f"Connected to Redshift cluster")
         except Exception as e:
             self.logger.error(f"Failed to connect to Redshift cluster")
             self.logger.error(e)
             raise e
+        return conn
+
+    def clone(self) -> "RedshiftClient":
+        """Open a new connection with the same settings. The clone shares the logger 
+        and metrics registry of this client.
+
+        Returns
+        -------
+        RedshiftClient
+        """
+        return self.__class__(logger=self.logger, metrics=self.metrics, **self._init_kwargs)
 
-    def execute_query(self, query: str, return_result=False) -> list:
+    def close(self):
+        """Close the connections opened by all threads"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def execute_query(
+            self, 
+            query: str, 
+            return_result=False, 
+            params: tuple | list = None, 
+            label: str = None,
+            raise_on_error: bool = False
+        ) -> list:
         """Execute a query against the Redshift database. 
 
+        Every call is measured (wall time, rows returned or affected, Redshift query id) 
+        and recorded in the client's metrics registry. Queries slower than 
+        `slow_query_seconds` are logged as warnings.
+
         Parameters
         ----------
         query : str
+        params : tuple | list, optional
+            Values bound to the %s placeholders of the query, by default None
+        label : str, optional
+            Name of the statement in the metrics, by default the first line of the query
         return_result : bool, optional
             Default: False. If True, return the result of the query.
+        raise_on_error : bool, optional
+            If True, raise the error of a failed query instead of returning None, for 
+            statements whose failure must stop the caller (loads, builds). Default: False
 
         Returns
         -------
         list
-            A list containing rows of the query result
+            A list containing rows of the query result, None if the query failed
         """
+        label = label or self._default_label(query)
         cursor = self.conn.cursor()
+        started_at = datetime.now()
+        start = time.perf_counter()
 
         try:
-            cursor.execute(query)
+            self._execute(cursor, query, params)
         except Exception as e:
             self.logger.error(e)
             self.logger.error(f"Executed query: {query}")
             self.conn.rollback()
             cursor.close()
+            self._record_metric(label, None, started_at, time.perf_counter() - start, None, False)
+            if raise_on_error:
+                raise
             return None
         else:
-            try:
-                result = cursor.fetchall()
-                cursor.close()
-                return result
-            except ProgrammingError as e:
-                return None
+            result, rows = self._fetch(cursor)
+            elapsed = time.perf_counter() - start
+            query_id = self._last_query_id(cursor)
+            cursor.close()
+            self._record_metric(label, query_id, started_at, elapsed, rows, True)
+            return result
+
+    def _execute(self, cursor, query: str, params: tuple | list = None):
+        cursor.execute(query, params)
+
+    def _fetch(self, cursor) -> tuple[list, int]:
+        """Fetch the result of the last query, and the number of rows returned or affected"""
+        from redshift_connector import ProgrammingError
+
+        try:
+            result = cursor.fetchall()
+            return result, len(result)
+        except ProgrammingError as e:
+            return None, cursor.rowcount if cursor.rowcount >= 0 else None
+
+    def _default_label(self, query: str) -> str:
+        lines = [line.strip() for line in query.strip().splitlines() if line.strip()]
+        return lines[0][:80] if lines else ""
+
+    def _last_query_id(self, cursor) -> int:
+        if not self.track_query_id:
+            return None
+        try:
+            cursor.execute(loading.last_query_id)
+            return cursor.fetchone()[0]
+        except Exception:
+            return None
+
+    def _record_metric(
+            self, 
+            label: str, 
+            query_id: int, 
+            started_at: datetime, 
+            elapsed: float, 
+            rows: int, 
+            succeeded: bool
+        ):
+        self.metrics.record(QueryMetric(
+            label           = label,
+            query_id        = query_id,
+            started_at      = started_at,
+            elapsed_seconds = elapsed,
+            rows            = rows,
+            succeeded       = succeeded
+        ))
+
+        if elapsed >= self.slow_query_seconds:
+            self.logger.warning(
+                f"Slow query ({elapsed:.1f}s, query id {query_id}, {rows} rows): {label}")
 
 
     def create_table(self):
@@ -77,3 +211,212 @@ class RedshiftClient:
         
     def copy_s3_to_redshift(self):
         pass
+
+    def get_table_fingerprint(self, table: str) -> str:
+        """Get the fingerprint of the inputs the table was built from.
+
+        Parameters
+        ----------
+        table : str
+            Schema-qualified table name
+
+        Returns
+        -------
+        str
+            The fingerprint, None if the table doesn't exist or has no fingerprint
+        """
+        schema_name, table_name = table.split('.')
+        result = self.execute_query(
+            loading.get_table_fingerprint.format(schema_name=schema_name, table_name=table_name),
+            label=f"get fingerprint {table}"
+        )
+        if result and result[0][0] and result[0][0].startswith('fingerprint:'):
+            return result[0][0].removeprefix('fingerprint:')
+        return None
+
+    def set_table_fingerprint(self, table: str, fingerprint: str, is_view: bool = False):
+        """Record the fingerprint of the inputs the table was built from
+
+        Parameters
+        ----------
+        table : str
+            Schema-qualified table name
+        fingerprint : str
+        is_view : bool, optional
+            True if the table is a (materialized) view, by default False
+        """
+        self.execute_query(
+            loading.set_table_fingerprint.format(
+                object_type='VIEW' if is_view else 'TABLE', table=table, fingerprint=fingerprint
+            ),
+            label=f"set fingerprint {table}"
+        )
+
+    def analyze_compression(self, table: str) -> dict[str, str]:
+        """Get the column encodings recommended by ANALYZE COMPRESSION, from a sample of the table
+
+        Parameters
+        ----------
+        table : str
+            Schema-qualified table name
+
+        Returns
+        -------
+        dict[str, str]
+            Mapping of column name to encoding, empty if the analysis failed
+        """
+        result = self.execute_query(tuning.analyze_compression.format(table=table), label=f"analyze compression {table}")
+        return {row[1]: row[2].lower() for row in result or []}
+
+    def explain(self, query: str) -> list[str]:
+        """Get the execution plan of a query
+
+        Parameters
+        ----------
+        query : str
+
+        Returns
+        -------
+        list[str]
+            Lines of the plan, empty if the query can't be planned
+        """
+        result = self.execute_query(tuning.explain.format(query=query), label="explain")
+        return [row[0] for row in result or []]
+
+    def table_info(self, tables: list[str]) -> dict[str, dict]:
+        """Get the physical design and size of some tables from SVV_TABLE_INFO
+
+        Parameters
+        ----------
+        tables : list[str]
+            Schema-qualified table names
+
+        Returns
+        -------
+        dict[str, dict]
+            Mapping of table name to its diststyle, sortkey1, encoded, size (MB) and tbl_rows. 
+            Empty tables are missing
+        """
+        result = self.execute_query(
+            tuning.table_info.format(tables=', '.join(f"'{table}'" for table in tables)), label="table info"
+        )
+        columns = ['diststyle', 'sortkey1', 'encoded', 'size', 'tbl_rows']
+        return {row[0]: dict(zip(columns, row[1:])) for row in result or []}
+
+    def insert_records(self, table: str, records: list[dict], batch_size: int = 500) -> int:
+        """Insert records directly into a table using batched multi-row parameterized 
+        INSERT statements. Meant for small loads, where writing a file, uploading it to S3 
+        and running COPY costs more than the load itself.
+
+        List and dict values are serialized to JSON and parsed into SUPER by Redshift.
+
+        Parameters
+        ----------
+        table : str
+            Name of the target table. Its columns must match the keys of the records
+        records : list[dict]
+            Records to insert. All records must have the same keys
+        batch_size : int, optional
+            Number of rows per INSERT statement, by default 500
+
+        Returns
+        -------
+        int
+            Number of inserted rows
+
+        Raises
+        ------
+        Exception
+            The error of the first failed INSERT. The batches before it stay inserted
+        """
+        if len(records) == 0:
+            self.logger.warning(f"No records to insert into {table}")
+            return 0
+
+        columns = list(records[0].keys())
+        super_columns = {
+            col for col in columns 
+            if any(isinstance(record[col], (list, dict)) for record in records)
+        }
+        placeholders = ', '.join(
+            'JSON_PARSE(%s)' if col in super_columns else '%s' for col in columns
+        )
+        row_template = f"({placeholders})"
+
+        inserted = 0
+
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            params = []
+
+            for record in batch:
+                for col in columns:
+                    value = record[col]
+                    params.append(json.dumps(value) if col in super_columns and value is not None else value)
+
+            query = loading.insert_records.format(
+                table   = table,
+                columns = ', '.join(columns),
+                values  = ', '.join([row_template] * len(batch))
+            )
+            # A failed batch raises, so that a partial insert is not reported as complete
+            self.execute_query(query, params=params, label=f"insert {table}", raise_on_error=True)
+            inserted += len(batch)
+
+        self.logger.info(f"Inserted {inserted} rows into {table}")
+        return inserted
+
+    def unload_to_s3(
+            self,
+            query: str,
+            destination_path: str,
+            iam_role: str,
+            region_name: str,
+            partition_by: list[str] = None,
+            max_file_size_mb: int = 256
+        ):
+        """Export the result of a query to S3 as Parquet files using UNLOAD. Every slice
+        of the cluster writes its own files in parallel, and a manifest listing all
+        the written files is put at `{destination_path}manifest`.
+
+        Parameters
+        ----------
+        query : str
+            The SELECT statement whose result will be exported
+        destination_path : str
+            S3 prefix to write the files to, for example s3://bucket/analytics/songs/
+        iam_role : str
+            ARN of the IAM role that Redshift assumes to write to S3
+        region_name : str
+            Region of the destination bucket
+        partition_by : list[str], optional
+            Columns to partition the output by (Hive-style folders), by default None
+        max_file_size_mb : int, optional
+            Maximum size of each Parquet file, by default 256
+
+        Returns
+        -------
+        list
+            Result returned by Redshift
+
+        Raises
+        ------
+        Exception
+            The error of a failed UNLOAD, for example a missing table or a wrong IAM role
+        """
+        if partition_by:
+            partition_clause = loading.unload_partition_clause.format(columns=', '.join(partition_by))
+        else:
+            partition_clause = ""
+
+        # The query is embedded in a string literal, so single quotes have to be doubled
+        unload_query = loading.unload_redshift_to_s3.format(
+            query               = query.replace("'", "''"),
+            destination_path    = destination_path,
+            iam_role            = iam_role,
+            partition_clause    = partition_clause,
+            max_file_size_mb    = max_file_size_mb,
+            region_name         = region_name
+        )
+        self.logger.info(f"Unloading to {destination_path}")
+        return self.execute_query(unload_query, label=f"unload {destination_path}", raise_on_error=True)
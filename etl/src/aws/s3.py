@@ -1,5 +1,6 @@
-import boto3
+import os
 from src.utils.custom_logger import init_logger
+from src.utils.metrics import add_to_active_stages
 
 class S3Client:
     """Custom S3 client class"""
@@ -16,6 +17,9 @@ class S3Client:
 
         self.region_name = region_name
 
+        # Imported on first use, so that importing this module stays cheap
+        import boto3
+
         try:
             self.client = boto3.client(
                 's3',
@@ -72,11 +76,61 @@ class S3Client:
         try:
             self.client.upload_file(input_file_path, bucket_name, file_path)
             self.logger.info(f"File uploaded to s3://{bucket_name}/{file_path}")
+            add_to_active_stages(bytes_uploaded=os.path.getsize(input_file_path))
         except Exception as e:
             self.logger.error(e)
             raise e
 
 
+    def list_etags(self, s3_path: str) -> dict[str, str]:
+        """List the ETags of all objects under an S3 path. ETags change whenever the 
+        content of an object changes, so they can be used to detect new input data.
+
+        Parameters
+        ----------
+        s3_path : str
+            Full S3 path to an object or a prefix, for example s3://bucket/msd/songs/
+
+        Returns
+        -------
+        dict[str, str]
+            Mapping of object key to ETag
+        """
+        bucket_name, _, prefix = s3_path.removeprefix("s3://").partition("/")
+        paginator = self.client.get_paginator('list_objects_v2')
+        etags = {}
+
+        try:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    etags[obj['Key']] = obj['ETag']
+        except Exception as e:
+            self.logger.error(e)
+            raise e
+
+        return etags
+
+    def delete_files(self, bucket_name: str, file_paths: list[str]):
+        """Delete objects, 1000 at a time (the limit of one DeleteObjects request)
+
+        Parameters
+        ----------
+        bucket_name : str
+        file_paths : list[str]
+            Keys of the objects
+        """
+        try:
+            for start in range(0, len(file_paths), 1000):
+                self.client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={'Objects': [{'Key': key} for key in file_paths[start:start + 1000]], 'Quiet': True}
+                )
+            if len(file_paths) > 0:
+                self.logger.info(f"Deleted {len(file_paths)} files from s3://{bucket_name}")
+        except Exception as e:
+            self.logger.error(e)
+            raise e
+
     def download_file(self, bucket_name: str, file_path: str, output_file_path: str):
         try:
             self.client.download_file(bucket_name, file_path, output_file_path)
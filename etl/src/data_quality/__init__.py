@@ -1,2 +1,9 @@
-from src.data_quality.data_quality import DataQualityOperator
-from src.data_quality.tests import all_tests
\ No newline at end of file
+from src.utils.lazy import lazy_exports
+
+exports = {
+    'DataQualityOperator'   : 'src.data_quality.data_quality',
+    'all_tests'             : 'src.data_quality.tests',
+}
+
+__all__ = list(exports)
+__getattr__, __dir__ = lazy_exports(__name__, exports)
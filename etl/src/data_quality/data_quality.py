@@ -1,7 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 from src.aws.redshift import RedshiftClient
 from logging import Logger
 from src.utils.custom_logger import init_logger
-from src.data_quality.tests import Test
+from src.data_quality.tests import Test, is_batchable, batched_query, has_data_test
 
 class DataQualityOperator:
     """Class to run data tests"""
@@ -22,20 +23,55 @@ class DataQualityOperator:
         -------
         bool
             Return True if the test passes, False otherwise.
-        """        
+        """
         try:
-            result = self.client.execute_query(test.query)
+            result = self.client.execute_query(test.query, label=test.name)
         except Exception as e:
             self.logger.error(e)
             return False
         else:
-            if len(result) == 0:
+            if test.check == 'catalog_has_data' and result and result[0][0] is None:
+                # The catalog has no rows for the table, which it only shows to superusers
+                self.logger.warning(f"No catalog row counts for {test.table}, data test {test.name} scans the table instead.")
+                return self.run_test(has_data_test(test.name, test.table))
+            elif len(result) == 0:
                 self.logger.info(f"Data test {test.name} PASSED.")
                 return True
             else:
                 self.logger.info(f"Data test {test.name} FAIED.")
                 return False
 
+    def run_table_tests(self, client: RedshiftClient, table: str, tests: list[Test]) -> dict[str, bool]:
+        """Run all tests on one table in a single scan.
+
+        Parameters
+        ----------
+        client : RedshiftClient
+            Client to run the query with
+        table : str
+            Name of the table the tests are checking
+        tests : list[Test]
+            Batchable tests on this table
+
+        Returns
+        -------
+        dict[str, bool]
+            Mapping of test name to True if the test passes, False otherwise.
+        """
+        result = client.execute_query(batched_query(table, tests), label=f"data tests {table}")
+
+        if not result:
+            self.logger.error(f"Failed to run data tests on {table}")
+            return {test.name: False for test in tests}
+
+        results = {}
+
+        for test, failed in zip(tests, result[0]):
+            results[test.name] = not failed
+            self.logger.info(f"Data test {test.name} {'FAILED' if failed else 'PASSED'}.")
+
+        return results
+
     def run_multi_tests(self, tests: list[Test]):
         """Iterate through a list of Test objects, run and report results.
 
@@ -49,15 +85,55 @@ class DataQualityOperator:
             Raise this exception to alert that the data test has failed.
         """
 
-        all_tests = []
-        failed_tests = []
-        
+        results = {test.name: self.run_test(test) for test in tests}
+        self._report(results)
+
+    def run_batched_tests(self, tests: list[Test], max_workers: int = 4):
+        """Group tests by table and scope and run each group as a single query, so every 
+        table is scanned once. Groups on different tables run concurrently, each on its own
+        connection. Tests that cannot be batched, like catalog checks, run one by one.
+
+        Parameters
+        ----------
+        tests : list[Test]
+        max_workers : int, optional
+            Maximum number of tables tested at the same time, by default 4
+
+        Raises
+        ------
+        ValueError
+            Raise this exception to alert that the data test has failed.
+        """
+        groups: dict[tuple[str, str], list[Test]] = {}
+        single_tests = []
+
         for test in tests:
-            result = self.run_test(test)
-            all_tests.append({'name': test.name, 'result': result})
-            
-            if result is False:
-                failed_tests.append(test.name)
+            if is_batchable(test):
+                groups.setdefault((test.table, test.scope), []).append(test)
+            else:
+                single_tests.append(test)
+
+        def run_group(item: tuple[tuple[str, str], list[Test]]) -> dict[str, bool]:
+            (table, _), table_tests = item
+            client = self.client.clone()
+            try:
+                return self.run_table_tests(client, table, table_tests)
+            finally:
+                client.close()
+
+        group_results = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(run_group, groups.items()):
+                group_results.update(result)
+
+        group_results.update({test.name: self.run_test(test) for test in single_tests})
+
+        # Report in the original order of the tests
+        self._report({test.name: group_results[test.name] for test in tests})
+
+    def _report(self, results: dict[str, bool]):
+        failed_tests = [name for name, passed in results.items() if passed is False]
 
         if len(failed_tests) > 0:
             message = f"There are {len(failed_tests)} failed data test(s): {', '.join(failed_tests)}"
@@ -65,5 +141,3 @@ class DataQualityOperator:
             raise ValueError(message)
         else:
             self.logger.info("All data tests has PASSED.")
-
-            
@@ -1,47 +1,162 @@
 from pydantic import BaseModel
+from typing import Optional
 
 class Test(BaseModel):
     name: str
     query: str
     expected_result: int
+    table: Optional[str]
+    check: Optional[str]
+    column: Optional[str]
+    scope: Optional[str]
 
-def has_data_query(table):
-    return f"select count(*) as cnt from {table} having cnt = 0"
+def where_clause(scope):
+    return f" where {scope}" if scope else ""
 
-def unique_query(table, column):
-    return f"select {column}, count(*) as cnt from {table} group by 1 having cnt > 1"
+def has_data_query(table, scope=None):
+    return f"select count(*) as cnt from {table}{where_clause(scope)} having cnt = 0"
 
-def not_null_query(table, column):
-    return f"select count(case when {column} is null then 1 else null end) as cnt from {table} having cnt > 1"
+def unique_query(table, column, scope=None):
+    return f"select {column}, count(*) as cnt from {table}{where_clause(scope)} group by 1 having cnt > 1"
+
+def not_null_query(table, column, scope=None):
+    return f"select count(case when {column} is null then 1 else null end) as cnt from {table}{where_clause(scope)} having cnt > 1"
+
+def catalog_has_data_query(table):
+    """Check emptiness from the block-level row counts kept in the system catalog,
+    without scanning the table. Unlike SVV_TABLE_INFO, STV_TBL_PERM also lists empty tables.
+    Rows deleted but not yet vacuumed are still counted. Only superusers see the tables
+    of other users in STV_TBL_PERM: when the catalog has no rows for the table, the count
+    is NULL, and DataQualityOperator falls back to `has_data_query`.
+    """
+    schema_name, table_name = table.split('.')
+    return f"""select sum(perm.rows) as cnt
+    from stv_tbl_perm as perm
+    join pg_class as cls on cls.oid = perm.id
+    join pg_namespace as ns on ns.oid = cls.relnamespace
+    where ns.nspname = '{schema_name}' and cls.relname = '{table_name}'
+    having cnt = 0 or cnt is null"""
+
+
+query_builders = {
+    'has_data'          : lambda table, column, scope: has_data_query(table, scope),
+    'unique'            : lambda table, column, scope: unique_query(table, column, scope),
+    'not_null'          : lambda table, column, scope: not_null_query(table, column, scope),
+    'catalog_has_data'  : lambda table, column, scope: catalog_has_data_query(table),
+}
+
+# Expressions that evaluate to true when a check fails. They mirror the queries above,
+# so that checks on the same table can be computed together in one scan.
+failure_expressions = {
+    'has_data'  : "count(*) = 0",
+    'unique'    : "(count({column}) > count(distinct {column}) or count(*) - count({column}) > 1)",
+    'not_null'  : "count(case when {column} is null then 1 else null end) > 1",
+}
+
+def make_test(name, check, table, column=None, scope=None):
+    query = query_builders[check](table, column, scope)
+    return Test(name=name, query=query, expected_result=0, table=table, check=check, column=column, scope=scope)
+
+def has_data_test(name, table, scope=None):
+    return make_test(name, 'has_data', table, scope=scope)
+
+def catalog_has_data_test(name, table):
+    return make_test(name, 'catalog_has_data', table)
+
+def unique_test(name, table, column, scope=None):
+    return make_test(name, 'unique', table, column, scope)
+
+def not_null_test(name, table, column, scope=None):
+    return make_test(name, 'not_null', table, column, scope)
+
+def scoped(tests: list[Test], scope: str, tables: list[str] = None) -> list[Test]:
+    """Restrict tests to a subset of rows, for example the rows loaded in the current run.
+
+    Parameters
+    ----------
+    tests : list[Test]
+    scope : str
+        SQL predicate selecting the rows to test, e.g. "loaded_at >= '2023-01-01'"
+    tables : list[str], optional
+        Only scope the tests on these tables, by default all tables
+
+    Returns
+    -------
+    list[Test]
+        New list of tests. Catalog checks and tests with custom queries are kept as is.
+    """
+    result = []
+    for test in tests:
+        if test.check in failure_expressions and (tables is None or test.table in tables):
+            result.append(make_test(test.name, test.check, test.table, test.column, scope))
+        else:
+            result.append(test)
+    return result
+
+def scanning(tests: list[Test], tables: list[str]) -> list[Test]:
+    """Replace the catalog checks on some tables with checks scanning them, for relations 
+    whose rows are not counted in STV_TBL_PERM under their own name, like materialized views.
+
+    Parameters
+    ----------
+    tests : list[Test]
+    tables : list[str]
+
+    Returns
+    -------
+    list[Test]
+        New list of tests
+    """
+    return [
+        has_data_test(test.name, test.table) if test.check == 'catalog_has_data' and test.table in tables else test
+        for test in tests
+    ]
+
+def is_batchable(test: Test) -> bool:
+    return test.table is not None and test.check in failure_expressions
+
+def batched_query(table: str, tests: list[Test]) -> str:
+    """Compile all checks on one table (and scope) into a single query, returning one 
+    row with one boolean column per test (true = failed), in the same order as `tests`.
+    """
+    expressions = [failure_expressions[test.check].format(column=test.column) for test in tests]
+    select_list = "\n    , ".join(expressions)
+    return f"select\n    {select_list}\nfrom {table}{where_clause(tests[0].scope)}"
 
 
 all_tests = [
     
     # Test staging tables have data
-    Test(name='staging_msd_songs_has_data', query = has_data_query('staging.msd_songs'), expected_result = 0),
-    Test(name='staging_msd_artists_has_data', query = has_data_query('staging.msd_artists'), expected_result = 0),
-    Test(name='staging_mapped_songs_has_data', query = has_data_query('staging.mapped_songs'), expected_result = 0),
-    Test(name='staging_mapped_artists_has_data', query = has_data_query('staging.mapped_artists'), expected_result = 0),
-    Test(name='staging_spotify_songs_has_data', query = has_data_query('staging.spotify_songs'), expected_result = 0),
-    Test(name='staging_spotify_artists_has_data', query = has_data_query('staging.spotify_artists'), expected_result = 0),
+    catalog_has_data_test('staging_msd_songs_has_data', 'staging.msd_songs'),
+    catalog_has_data_test('staging_msd_artists_has_data', 'staging.msd_artists'),
+    catalog_has_data_test('staging_mapped_songs_has_data', 'staging.mapped_songs'),
+    catalog_has_data_test('staging_mapped_artists_has_data', 'staging.mapped_artists'),
+    catalog_has_data_test('staging_spotify_songs_has_data', 'staging.spotify_songs'),
+    catalog_has_data_test('staging_spotify_artists_has_data', 'staging.spotify_artists'),
+    catalog_has_data_test('staging_spotify_albums_has_data', 'staging.spotify_albums'),
+    catalog_has_data_test('staging_spotify_audio_features_has_data', 'staging.spotify_audio_features'),
 
     # Test analytics tables have data
-    Test(name='analytics_songs_has_data', query = has_data_query('analytics.songs'), expected_result = 0),
-    Test(name='analytics_artists_has_data', query = has_data_query('analytics.artists'), expected_result = 0),
-    Test(name='msd_songs_has_data', query = has_data_query('msd.songs'), expected_result = 0),
-    Test(name='msd_artists_has_data', query = has_data_query('msd.artists'), expected_result = 0),
-    Test(name='mapped_songs_has_data', query = has_data_query('mapped.songs'), expected_result = 0),
-    Test(name='mapped_artists_has_data', query = has_data_query('mapped.artists'), expected_result = 0),
-    Test(name='spotify_songs_has_data', query = has_data_query('spotify.songs'), expected_result = 0),
-    Test(name='spotify_artists_has_data', query = has_data_query('spotify.artists'), expected_result = 0),
+    catalog_has_data_test('analytics_songs_has_data', 'analytics.songs'),
+    catalog_has_data_test('analytics_artists_has_data', 'analytics.artists'),
+    catalog_has_data_test('msd_songs_has_data', 'msd.songs'),
+    catalog_has_data_test('msd_artists_has_data', 'msd.artists'),
+    catalog_has_data_test('mapped_songs_has_data', 'mapped.songs'),
+    catalog_has_data_test('mapped_artists_has_data', 'mapped.artists'),
+    catalog_has_data_test('spotify_songs_has_data', 'spotify.songs'),
+    catalog_has_data_test('spotify_artists_has_data', 'spotify.artists'),
+    catalog_has_data_test('spotify_albums_has_data', 'spotify.albums'),
+    catalog_has_data_test('spotify_audio_features_has_data', 'spotify.audio_features'),
     
 
-    Test(name='msd_songs_id_unique', query = unique_query('msd.songs', 'id'), expected_result = 0),
-    Test(name='msd_artists_id_unique', query = unique_query('msd.artists', 'id'), expected_result = 0),
-    Test(name='mapped_songs_msd_song_id_unique', query = unique_query('mapped.songs', 'msd_song_id'), expected_result = 0),
-    Test(name='mapped_artists_msd_artist_id_unique', query = unique_query('mapped.artists', 'msd_artist_id'), expected_result = 0),
-    Test(name='spotify_songs_id_unique', query = unique_query('spotify.songs', 'id'), expected_result = 0),
-    Test(name='spotify_artists_id_unique', query = unique_query('spotify.artists', 'id'), expected_result = 0),
-    Test(name='analytics_spotify_songs_id_unique', query = unique_query('analytics.songs', 'spotify_song_id'), expected_result = 0),
-    Test(name='analytics_spotify_songs_id_not_null', query = not_null_query('analytics.songs', 'spotify_song_id'), expected_result = 0),
+    unique_test('msd_songs_id_unique', 'msd.songs', 'id'),
+    unique_test('msd_artists_id_unique', 'msd.artists', 'id'),
+    unique_test('mapped_songs_msd_song_id_unique', 'mapped.songs', 'msd_song_id'),
+    unique_test('mapped_artists_msd_artist_id_unique', 'mapped.artists', 'msd_artist_id'),
+    unique_test('spotify_songs_id_unique', 'spotify.songs', 'id'),
+    unique_test('spotify_artists_id_unique', 'spotify.artists', 'id'),
+    unique_test('spotify_albums_id_unique', 'spotify.albums', 'id'),
+    unique_test('spotify_audio_features_id_unique', 'spotify.audio_features', 'id'),
+    unique_test('analytics_spotify_songs_id_unique', 'analytics.songs', 'spotify_song_id'),
+    not_null_test('analytics_spotify_songs_id_not_null', 'analytics.songs', 'spotify_song_id'),
 ]
\ No newline at end of file
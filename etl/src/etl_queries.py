@@ -8,11 +8,109 @@ class LoadingQueries:
     REGION '{region_name}'
     """
 
-    unload_redshift_to_s3 = ""
+    # Columnar data (audio features) is written as CSV with a header. Columns are loaded
+    # by position, so the files must have the columns of the table in the same order
+    copy_csv_s3_to_redshift = """
+    COPY {table}
+    FROM '{source_path}'
+    IAM_ROLE '{iam_role}'
+    FORMAT AS CSV
+    IGNOREHEADER 1
+    REGION '{region_name}'
+    """
+
+    last_query_id = "SELECT pg_last_query_id()"
+
+    drop_table = "DROP TABLE IF EXISTS {table}"
+
+    # Fingerprints of the inputs a table was built from are stored in the table comment,
+    # so they disappear together with the table
+    get_table_fingerprint = """
+    SELECT descr.description
+    FROM pg_description AS descr
+    JOIN pg_class AS cls ON cls.oid = descr.objoid
+    JOIN pg_namespace AS ns ON ns.oid = cls.relnamespace
+    WHERE ns.nspname = '{schema_name}' AND cls.relname = '{table_name}' AND descr.objsubid = 0
+    """
+
+    set_table_fingerprint = "COMMENT ON {object_type} {table} IS 'fingerprint:{fingerprint}'"
+
+    insert_records = "INSERT INTO {table} ({columns}) VALUES {values}"
+
+    unload_redshift_to_s3 = """
+    UNLOAD ('{query}')
+    TO '{destination_path}'
+    IAM_ROLE '{iam_role}'
+    FORMAT AS PARQUET
+    {partition_clause}
+    MANIFEST VERBOSE
+    ALLOWOVERWRITE
+    PARALLEL ON
+    MAXFILESIZE {max_file_size_mb} MB
+    REGION '{region_name}'
+    """
+
+    unload_partition_clause = "PARTITION BY ({columns}) INCLUDE"
+
+    unload_select_table = "SELECT * FROM {table}"
+
+class TuningQueries:
+
+    analyze_compression = "ANALYZE COMPRESSION {table}"
+
+    explain = "EXPLAIN {query}"
+
+    # Size is in 1 MB blocks. Empty tables are not listed
+    table_info = """
+    SELECT "schema" || '.' || "table" AS table_name, diststyle, sortkey1, encoded, size, tbl_rows
+    FROM svv_table_info
+    WHERE "schema" || '.' || "table" IN ({tables})
+    """
+
+    alter_diststyle_key = "ALTER TABLE {table} ALTER DISTSTYLE KEY DISTKEY {column}"
+    alter_diststyle     = "ALTER TABLE {table} ALTER DISTSTYLE {diststyle}"
+    alter_sortkey       = "ALTER TABLE {table} ALTER COMPOUND SORTKEY ({columns})"
+    alter_encode        = "ALTER TABLE {table} ALTER COLUMN {column} ENCODE {encoding}"
 
 class SearchInputQueries:
-    songs = "select id, name, artist_id, artist_name from staging.msd_songs {limit_clause}"
-    artists = "select distinct id, name from staging.msd_artists {limit_clause}"
+
+    # Keyset pagination: the next page of the search input in ID order, within a range of IDs.
+    # Parameters: last ID read (excluded), upper bound of the range (included), page size.
+    # IDs are not unique in the staging tables: a song is searched once, with one of its rows,
+    # and an artist once, under one of its names, so that a page never ends within an ID
+    songs = """
+    select id, name, artist_id, artist_name, release, year
+    from (
+        select 
+            id, name, artist_id, artist_name, release, year
+            , row_number() over (partition by id order by name, artist_id, release, year) as idx
+        from staging.msd_songs
+        where id > %s and id <= %s
+    ) as songs
+    where idx = 1
+    order by id
+    limit %s
+    """
+
+    artists = """
+    select id, min(name) as name
+    from staging.msd_artists
+    where id > %s and id <= %s
+    group by id
+    order by id
+    limit %s
+    """
+
+    # Split the distinct IDs of a table into ranges of about the same size, in ID order
+    key_ranges = """
+    select bucket, max(id) as upper, count(*) as ids
+    from (
+        select id, ntile({num_ranges}) over (order by id) as bucket
+        from (select distinct id from {table}) as distinct_ids
+    ) as buckets
+    group by bucket
+    order by bucket
+    """
 
 class SchemaQueries:
 
@@ -70,7 +168,8 @@ class StagingMappedQueries:
     create_table_songs = """
     CREATE TABLE IF NOT EXISTS staging.mapped_songs (
         msd_song_id         VARCHAR(256),
-        spotify_song_ids    SUPER
+        spotify_song_ids    SUPER,
+        spotify_song_scores SUPER
     )
     DISTSTYLE KEY
     DISTKEY(msd_song_id)
@@ -90,6 +189,8 @@ class StagingSpotifyQueries:
     
     drop_table_songs        = """DROP TABLE IF EXISTS staging.spotify_songs"""
     drop_table_artists      = """DROP TABLE IF EXISTS staging.spotify_artists"""
+    drop_table_albums       = """DROP TABLE IF EXISTS staging.spotify_albums"""
+    drop_table_audio_features = """DROP TABLE IF EXISTS staging.spotify_audio_features"""
 
     create_table_songs = """
     CREATE TABLE IF NOT EXISTS staging.spotify_songs (
@@ -120,6 +221,47 @@ class StagingSpotifyQueries:
     DISTKEY(id)
     """
 
+    create_table_albums = """
+    CREATE TABLE IF NOT EXISTS staging.spotify_albums (
+        id                      VARCHAR(256),
+        name                    VARCHAR(256),
+        url                     VARCHAR(MAX),
+        album_type              VARCHAR(32),
+        release_date            VARCHAR(16),
+        release_date_precision  VARCHAR(8),
+        total_tracks            INTEGER,
+        label                   VARCHAR(256),
+        popularity              NUMERIC,
+        genres                  SUPER,
+        external_ids            SUPER,
+        artists                 SUPER
+    )
+    DISTSTYLE KEY
+    DISTKEY(id)
+    """
+
+    # Same column order as src.spotify.custom_types.audio_features_columns
+    create_table_audio_features = """
+    CREATE TABLE IF NOT EXISTS staging.spotify_audio_features (
+        id                  VARCHAR(256),
+        danceability        REAL,
+        energy              REAL,
+        key                 SMALLINT,
+        loudness            REAL,
+        mode                SMALLINT,
+        speechiness         REAL,
+        acousticness        REAL,
+        instrumentalness    REAL,
+        liveness            REAL,
+        valence             REAL,
+        tempo               REAL,
+        duration_ms         INTEGER,
+        time_signature      SMALLINT
+    )
+    DISTSTYLE KEY
+    DISTKEY(id)
+    """
+
 
 class AnalyticsQueries:
 
@@ -131,6 +273,8 @@ class AnalyticsQueries:
 
     drop_table_spotify_songs        = "DROP TABLE IF EXISTS spotify.songs"
     drop_table_spotify_artists      = "DROP TABLE IF EXISTS spotify.artists"
+    drop_table_spotify_albums       = "DROP TABLE IF EXISTS spotify.albums"
+    drop_table_spotify_audio_features = "DROP TABLE IF EXISTS spotify.audio_features"
 
     drop_table_mapped_songs         = "DROP TABLE IF EXISTS mapped.songs"
     drop_table_mapped_artists       = "DROP TABLE IF EXISTS mapped.artists"
@@ -227,6 +371,64 @@ class AnalyticsQueries:
     where idx = 1
     """
 
+    create_table_spotify_albums = """
+    CREATE TABLE spotify.albums 
+    DISTSTYLE KEY
+    DISTKEY(id)
+    AS 
+    with base as (
+        select 
+            *
+            , row_number() over (partition by id) as idx
+        from staging.spotify_albums
+    )
+    select
+        id
+        , name
+        , url
+        , album_type
+        , release_date
+        , release_date_precision
+        , total_tracks
+        , label
+        , popularity
+        , genres
+        , external_ids
+        , artists
+    from base
+    where idx = 1
+    """
+
+    create_table_spotify_audio_features = """
+    CREATE TABLE spotify.audio_features 
+    DISTSTYLE KEY
+    DISTKEY(id)
+    AS 
+    with base as (
+        select 
+            *
+            , row_number() over (partition by id) as idx
+        from staging.spotify_audio_features
+    )
+    select
+        id
+        , danceability
+        , energy
+        , key
+        , loudness
+        , mode
+        , speechiness
+        , acousticness
+        , instrumentalness
+        , liveness
+        , valence
+        , tempo
+        , duration_ms
+        , time_signature
+    from base
+    where idx = 1
+    """
+
     create_table_mapped_songs = """
     CREATE TABLE mapped.songs 
     DISTSTYLE ALL
@@ -240,6 +442,7 @@ class AnalyticsQueries:
     select
         msd_song_id
         , spotify_song_ids
+        , spotify_song_scores
     from base
     where idx = 1
     """
@@ -262,14 +465,21 @@ class AnalyticsQueries:
     """
 
 
-    create_table_analytics_songs = """
-    CREATE TABLE analytics.songs AS
-    WITH unnested AS (
+    # The analytics tables are built from the rows of the mapped tables, one row per
+    # (MSD ID, Spotify ID) pair. {delta_join} restricts the rows to the pairs that are not in 
+    # the analytics table yet, to apply only the delta of the mapped tables.
+    select_analytics_songs = """
+    WITH all_pairs AS (
         SELECT 
             msd_song_id,
             CAST(spotify_song_id AS VARCHAR) AS spotify_song_id
         FROM mapped.songs as mapped_songs
         , mapped_songs.spotify_song_ids AS spotify_song_id
+    ),
+    unnested AS (
+        SELECT all_pairs.* 
+        FROM all_pairs
+        {delta_join}
     )
 
     SELECT 
@@ -286,21 +496,33 @@ class AnalyticsQueries:
         , spotify.popularity            as spotify_popularity
         , spotify.duration_ms
         , spotify.album_id
+        , album.name                    as spotify_album_name
+        , album.release_date            as spotify_album_release_date
+        , features.tempo
+        , features.energy
+        , features.danceability
+        , features.valence
 
     FROM unnested
     LEFT JOIN msd.songs AS msd ON unnested.msd_song_id = msd.id
     LEFT JOIN spotify.songs AS spotify ON unnested.spotify_song_id = spotify.id
+    LEFT JOIN spotify.albums AS album ON spotify.album_id = album.id
+    LEFT JOIN spotify.audio_features AS features ON unnested.spotify_song_id = features.id
     WHERE spotify.id is not null
     """
 
-    create_table_analytics_artists = """
-    CREATE TABLE analytics.artists AS
-    with unnested as (
+    select_analytics_artists = """
+    WITH all_pairs AS (
         SELECT 
             msd_artist_id,
             CAST(spotify_artist_id AS VARCHAR) AS spotify_artist_id
         FROM mapped.artists as mapped_artists
         , mapped_artists.spotify_artist_ids as spotify_artist_id
+    ),
+    unnested AS (
+        SELECT all_pairs.* 
+        FROM all_pairs
+        {delta_join}
     )
     SELECT
         unnested.msd_artist_id
@@ -321,4 +543,87 @@ class AnalyticsQueries:
     LEFT JOIN msd.artists AS msd ON unnested.msd_artist_id = msd.id
     LEFT JOIN spotify.artists AS spotify ON unnested.spotify_artist_id = spotify.id
     WHERE spotify.id is not NULL
-    """
\ No newline at end of file
+    """
+
+    create_table_analytics_songs = "CREATE TABLE analytics.songs AS" + select_analytics_songs.format(delta_join="")
+    create_table_analytics_artists = "CREATE TABLE analytics.artists AS" + select_analytics_artists.format(delta_join="")
+
+    # Materialized views, refreshed by Redshift when the mapped, msd and spotify tables 
+    # change, incrementally when the view allows it
+    create_view_analytics_songs = (
+        "CREATE MATERIALIZED VIEW analytics.songs AUTO REFRESH YES AS" + select_analytics_songs.format(delta_join="")
+    )
+    create_view_analytics_artists = (
+        "CREATE MATERIALIZED VIEW analytics.artists AUTO REFRESH YES AS" + select_analytics_artists.format(delta_join="")
+    )
+
+    refresh_view = "REFRESH MATERIALIZED VIEW {view}"
+
+    # Refill a table in place, keeping the materialized views built on it. DELETE rather 
+    # than TRUNCATE, which Redshift refreshes views from by recomputing them
+    delete_all_rows = "DELETE FROM {table}"
+    insert_select   = "INSERT INTO {table} {select}"
+
+    # Delta of the analytics tables: delete the pairs that are no longer mapped, 
+    # then insert the pairs that are new
+    delete_removed_analytics_songs = """
+    DELETE FROM analytics.songs
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM mapped.songs as mapped_songs
+        , mapped_songs.spotify_song_ids AS spotify_song_id
+        WHERE mapped_songs.msd_song_id = songs.msd_song_id
+            AND CAST(spotify_song_id AS VARCHAR) = songs.spotify_song_id
+    )
+    """
+
+    new_songs_join = """
+        LEFT JOIN analytics.songs AS existing 
+            ON all_pairs.msd_song_id = existing.msd_song_id 
+            AND all_pairs.spotify_song_id = existing.spotify_song_id
+        WHERE existing.msd_song_id IS NULL"""
+
+    insert_new_analytics_songs = "INSERT INTO analytics.songs" + select_analytics_songs.format(delta_join=new_songs_join)
+
+    delete_removed_analytics_artists = """
+    DELETE FROM analytics.artists
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM mapped.artists as mapped_artists
+        , mapped_artists.spotify_artist_ids AS spotify_artist_id
+        WHERE mapped_artists.msd_artist_id = artists.msd_artist_id
+            AND CAST(spotify_artist_id AS VARCHAR) = artists.spotify_artist_id
+    )
+    """
+
+    new_artists_join = """
+        LEFT JOIN analytics.artists AS existing 
+            ON all_pairs.msd_artist_id = existing.msd_artist_id 
+            AND all_pairs.spotify_artist_id = existing.spotify_artist_id
+        WHERE existing.msd_artist_id IS NULL"""
+
+    insert_new_analytics_artists = "INSERT INTO analytics.artists" + select_analytics_artists.format(delta_join=new_artists_join)
+
+    # Keys of the rows the delta inserts, recorded before inserting them, so that the data 
+    # tests can be scoped to the rows sharing a key with them. Deleting rows cannot break 
+    # the uniqueness or not-null checks, so the removed pairs are not recorded
+    drop_table_analytics_songs_delta    = "DROP TABLE IF EXISTS staging.analytics_songs_delta"
+    drop_table_analytics_artists_delta  = "DROP TABLE IF EXISTS staging.analytics_artists_delta"
+
+    create_table_analytics_songs_delta = (
+        "CREATE TABLE staging.analytics_songs_delta AS SELECT new_rows.msd_song_id, new_rows.spotify_song_id FROM (" 
+        + select_analytics_songs.format(delta_join=new_songs_join) + ") AS new_rows"
+    )
+    create_table_analytics_artists_delta = (
+        "CREATE TABLE staging.analytics_artists_delta AS SELECT new_rows.msd_artist_id, new_rows.spotify_artist_id FROM (" 
+        + select_analytics_artists.format(delta_join=new_artists_join) + ") AS new_rows"
+    )
+
+    delta_scope_analytics_songs = """(
+        msd_song_id IN (SELECT msd_song_id FROM staging.analytics_songs_delta)
+        OR spotify_song_id IN (SELECT spotify_song_id FROM staging.analytics_songs_delta)
+    )"""
+    delta_scope_analytics_artists = """(
+        msd_artist_id IN (SELECT msd_artist_id FROM staging.analytics_artists_delta)
+        OR spotify_artist_id IN (SELECT spotify_artist_id FROM staging.analytics_artists_delta)
+    )"""
@@ -2,15 +2,20 @@ import subprocess
 import os
 from logging import Logger
 from src.utils.custom_logger import init_logger
+from src.utils.download import RangedDownloader
 
 class FileOperator():
 
     def __init__(self, logger: Logger = None):
         self.logger = logger or init_logger(self.__class__.__name__)
 
-    def download_file(self, url, output_file_path):
+    def download_file(self, url, output_file_path, checksum: str = None, num_workers: int = 4):
+        """Download a file with parallel range requests, continuing the chunks of an interrupted 
+        download. The output file is only written once its size (and SHA-256 if `checksum` is 
+        given) is verified. See RangedDownloader
+        """
         self.logger.info("Downloading file...")
-        subprocess.run(["wget", url, "-O", output_file_path])
+        RangedDownloader(num_workers=num_workers, logger=self.logger).download(url, output_file_path, checksum)
         return output_file_path
 
     def extract_file(self, input_file_path, output_folder):
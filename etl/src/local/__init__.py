@@ -0,0 +1,10 @@
+from src.utils.lazy import lazy_exports
+
+exports = {
+    'LocalS3Client'             : 'src.local.storage',
+    'LocalRedshiftClient'       : 'src.local.database',
+    'SyntheticSpotifyClient'    : 'src.local.spotify',
+}
+
+__all__ = list(exports)
+__getattr__, __dir__ = lazy_exports(__name__, exports)
@@ -0,0 +1,282 @@
+import os
+import re
+import csv
+import json
+import sqlite3
+from pathlib import Path
+from logging import Logger
+
+from src.aws.redshift import RedshiftClient
+from src.utils.metrics import QueryMetricsRegistry
+from src.etl_queries import SchemaQueries
+from src.local.sql import translate, fnv_hash, mod
+from src.local.storage import local_path, list_objects, read_json_records
+
+
+# One SQLite file per schema, attached to every connection under the schema name
+schemas = [name.removeprefix('create_schema_') for name in vars(SchemaQueries) if name.startswith('create_schema_')]
+
+copy_pattern = re.compile(r"^COPY\s+(?P<table>[\w.]+)\s+FROM\s+'(?P<source_path>[^']+)'", re.IGNORECASE)
+copy_csv_pattern = re.compile(r"FORMAT AS CSV", re.IGNORECASE)
+ignore_header_pattern = re.compile(r"IGNOREHEADER (?P<lines>\d+)", re.IGNORECASE)
+unload_pattern = re.compile(r"^UNLOAD\s+\('(?P<query>.*)'\)\s+TO\s+'(?P<destination_path>[^']+)'", re.IGNORECASE | re.DOTALL)
+unload_partition_pattern = re.compile(r"PARTITION BY \((?P<columns>[^)]*)\)", re.IGNORECASE)
+create_schema_pattern = re.compile(r"^CREATE SCHEMA", re.IGNORECASE)
+drop_schema_pattern = re.compile(r"^DROP SCHEMA IF EXISTS (?P<schema>\w+)", re.IGNORECASE)
+drop_table_pattern = re.compile(r"^DROP TABLE IF EXISTS (?P<table>[\w.]+)", re.IGNORECASE)
+create_view_pattern = re.compile(
+    r"^CREATE MATERIALIZED VIEW (?P<view>[\w.]+)\s+(?:.*?\s+)?AS\s+(?P<query>.*)$", 
+    re.IGNORECASE | re.DOTALL
+)
+refresh_view_pattern = re.compile(r"^REFRESH MATERIALIZED VIEW (?P<view>[\w.]+)", re.IGNORECASE)
+alter_physical_design_pattern = re.compile(
+    r"^ALTER TABLE [\w.]+ ALTER (?:DISTSTYLE|(?:COMPOUND |INTERLEAVED )?SORTKEY|COLUMN \w+ ENCODE)", re.IGNORECASE
+)
+
+fingerprints_table = "main._fingerprints"
+views_table = "main._materialized_views"
+
+
+class LocalRedshiftClient(RedshiftClient):
+    """Embedded replacement of RedshiftClient backed by SQLite, so that the whole pipeline
+    can run on a laptop. Redshift queries are translated with `src.local.sql.translate()`,
+    and the statements that have no SQLite equivalent are emulated:
+
+    - Schemas are SQLite files in {root_dir}/redshift, attached to every connection
+    - COPY reads the JSON or CSV files that LocalS3Client stored under the source path
+    - UNLOAD writes new-line delimited JSON files (instead of Parquet) and a manifest
+    - Table fingerprints are kept in a bookkeeping table instead of table comments
+    - Materialized views are tables, whose query is kept to recompute them on REFRESH
+    - Distribution styles, sort keys and encodings are ignored. ANALYZE COMPRESSION, EXPLAIN
+      and SVV_TABLE_INFO are answered from the column types, query plan and size of the SQLite tables
+    """
+
+    def __init__(
+            self,
+            root_dir: str,
+            logger: Logger = None,
+            autocommit=True,
+            metrics: QueryMetricsRegistry = None,
+            slow_query_seconds: float = 60,
+            **kwargs
+        ) -> None:
+        """
+        Parameters
+        ----------
+        root_dir : str
+            Root of the local storage, shared with LocalS3Client
+        logger : Logger, optional
+        autocommit : bool, optional
+            Kept for compatibility with RedshiftClient, statements are always autocommitted
+        metrics : QueryMetricsRegistry, optional
+            Registry to record the query measurements in, by default a new one
+        slow_query_seconds : float, optional
+            Queries slower than this are logged as warnings, by default 60
+        """
+        self.root_dir = root_dir
+        self.database_dir = os.path.join(root_dir, 'redshift')
+        os.makedirs(self.database_dir, exist_ok=True)
+
+        super().__init__(
+            host=None, logger=logger, metrics=metrics,
+            slow_query_seconds=slow_query_seconds, track_query_id=False
+        )
+        self._init_kwargs = dict(root_dir=root_dir, autocommit=autocommit, slow_query_seconds=slow_query_seconds)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            os.path.join(self.database_dir, 'main.db'),
+            timeout=60, isolation_level=None, check_same_thread=False
+        )
+        conn.create_function('fnv_hash', 1, fnv_hash, deterministic=True)
+        conn.create_function('mod', 2, mod, deterministic=True)
+
+        for schema in schemas:
+            conn.execute("ATTACH DATABASE ? AS " + schema, (os.path.join(self.database_dir, f"{schema}.db"),))
+            conn.execute(f"PRAGMA {schema}.journal_mode=WAL")
+
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {fingerprints_table} (table_name TEXT PRIMARY KEY, fingerprint TEXT)")
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {views_table} (view_name TEXT PRIMARY KEY, query TEXT)")
+        self.logger.info(f"Connected to local database in {self.database_dir}")
+        return conn
+
+    def _execute(self, cursor, query: str, params: tuple | list = None):
+        statement = query.strip()
+
+        if match := copy_pattern.match(statement):
+            if copy_csv_pattern.search(statement):
+                header_match = ignore_header_pattern.search(statement)
+                self._copy_csv(cursor, match['table'], match['source_path'], int(header_match['lines']) if header_match else 0)
+            else:
+                self._copy(cursor, match['table'], match['source_path'])
+
+        elif match := unload_pattern.match(statement):
+            self._unload(match['query'].replace("''", "'"), match['destination_path'], statement)
+
+        elif create_schema_pattern.match(statement) or alter_physical_design_pattern.match(statement):
+            # All schemas are attached when connecting, and SQLite has no physical design options
+            pass
+
+        elif match := drop_schema_pattern.match(statement):
+            self._drop_schema(cursor, match['schema'])
+
+        elif match := create_view_pattern.match(statement):
+            cursor.execute(f"INSERT OR REPLACE INTO {views_table} (view_name, query) VALUES (?, ?)", (match['view'], match['query']))
+            cursor.execute(f"CREATE TABLE {match['view']} AS {translate(match['query'])}")
+
+        elif match := refresh_view_pattern.match(statement):
+            (query,) = cursor.execute(f"SELECT query FROM {views_table} WHERE view_name = ?", (match['view'],)).fetchone()
+            cursor.execute(f"DELETE FROM {match['view']}")
+            cursor.execute(f"INSERT INTO {match['view']} {translate(query)}")
+
+        else:
+            if match := drop_table_pattern.match(statement):
+                cursor.execute(f"DELETE FROM {fingerprints_table} WHERE table_name = ?", (match['table'],))
+
+            cursor.execute(translate(query, parameterized=params is not None), params or ())
+
+    def _fetch(self, cursor) -> tuple[list, int]:
+        if cursor.description is None:
+            return None, cursor.rowcount if cursor.rowcount >= 0 else None
+        result = cursor.fetchall()
+        return result, len(result)
+
+    def _table_columns(self, cursor, table: str) -> list[str]:
+        schema_name, table_name = table.split('.')
+        return [row[1] for row in cursor.execute(f"PRAGMA {schema_name}.table_info({table_name})").fetchall()]
+
+    def _copy(self, cursor, table: str, source_path: str):
+        """Emulate COPY ... FORMAT AS JSON 'auto': load all the files under the source path,
+        matching keys to column names. Lists and dicts are stored as JSON text.
+        """
+        columns = self._table_columns(cursor, table)
+        rows = []
+
+        for path in list_objects(self.root_dir, source_path):
+            for record in read_json_records(path):
+                record = {key.lower(): value for key, value in record.items()}
+                rows.append([
+                    json.dumps(value) if isinstance(value, (list, dict)) else value
+                    for value in (record.get(col) for col in columns)
+                ])
+
+        cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows
+        )
+
+    def _copy_csv(self, cursor, table: str, source_path: str, ignore_header: int = 0):
+        """Emulate COPY ... FORMAT AS CSV IGNOREHEADER n: load all the files under the source 
+        path, matching fields to columns by position. Empty fields are loaded as NULL.
+        """
+        columns = self._table_columns(cursor, table)
+        rows = []
+
+        for path in list_objects(self.root_dir, source_path):
+            with open(path, 'r', newline='') as f:
+                for row in list(csv.reader(f))[ignore_header:]:
+                    rows.append([value if value != '' else None for value in row])
+
+        cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows
+        )
+
+    def _unload(self, query: str, destination_path: str, statement: str):
+        """Emulate UNLOAD ... MANIFEST ALLOWOVERWRITE: write the result of the query to
+        new-line delimited JSON files, one per partition, and a manifest listing them.
+        """
+        partition_match = unload_partition_pattern.search(statement)
+        partition_by = [col.strip() for col in partition_match['columns'].split(',')] if partition_match else []
+
+        cursor = self.conn.execute(translate(query))
+        columns = [col[0] for col in cursor.description]
+        parts: dict[str, list[dict]] = {}
+
+        for row in cursor.fetchall():
+            record = dict(zip(columns, row))
+            folder = ''.join(
+                f"{col}={'__HIVE_DEFAULT_PARTITION__' if record[col] is None else record[col]}/"
+                for col in partition_by
+            )
+            parts.setdefault(folder, []).append(record)
+
+        output_dir = Path(local_path(self.root_dir, destination_path))
+        for old_part in output_dir.rglob('*_part_00.json') if output_dir.is_dir() else []:
+            old_part.unlink()
+
+        entries = []
+        for folder, records in parts.items():
+            part_path = output_dir / folder / "0000_part_00.json"
+            part_path.parent.mkdir(parents=True, exist_ok=True)
+            part_path.write_text(''.join(json.dumps(record, default=str) + '\n' for record in records))
+            entries.append({
+                'url': f"{destination_path}{folder}0000_part_00.json",
+                'meta': {'content_length': part_path.stat().st_size, 'record_count': len(records)}
+            })
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        (output_dir / "manifest").write_text(json.dumps({'entries': entries}))
+
+    def _drop_schema(self, cursor, schema: str):
+        tables = cursor.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'").fetchall()
+        for (table_name,) in tables:
+            cursor.execute(f"DROP TABLE IF EXISTS {schema}.{table_name}")
+        cursor.execute(f"DELETE FROM {fingerprints_table} WHERE table_name LIKE ?", (f"{schema}.%",))
+        cursor.execute(f"DELETE FROM {views_table} WHERE view_name LIKE ?", (f"{schema}.%",))
+
+    def get_table_fingerprint(self, table: str) -> str:
+        schema_name, table_name = table.split('.')
+        if schema_name not in schemas:
+            return None
+
+        result = self.execute_query(
+            f"""SELECT fingerprint FROM {fingerprints_table}
+            WHERE table_name = ? AND EXISTS (SELECT 1 FROM {schema_name}.sqlite_master WHERE type = 'table' AND name = ?)""",
+            params=(table, table_name), label=f"get fingerprint {table}"
+        )
+        return result[0][0] if result else None
+
+    def set_table_fingerprint(self, table: str, fingerprint: str, is_view: bool = False):
+        self.execute_query(
+            f"INSERT OR REPLACE INTO {fingerprints_table} (table_name, fingerprint) VALUES (?, ?)",
+            params=(table, fingerprint), label=f"set fingerprint {table}"
+        )
+
+    def analyze_compression(self, table: str) -> dict[str, str]:
+        """AZ64 for numeric columns, ZSTD for the others, by declared column type"""
+        schema_name, table_name = table.split('.')
+        result = self.execute_query(f"PRAGMA {schema_name}.table_info({table_name})", label=f"analyze compression {table}")
+        numeric_types = ('INT', 'REAL', 'NUM', 'FLOAT', 'DOUBLE', 'DECIMAL')
+        return {
+            row[1]: 'az64' if any(name in (row[2] or '').upper() for name in numeric_types) else 'zstd'
+            for row in result or []
+        }
+
+    def explain(self, query: str) -> list[str]:
+        """SQLite query plan, without costs"""
+        result = self.execute_query(f"EXPLAIN QUERY PLAN {translate(query)}", label="explain")
+        return [row[3] for row in result or []]
+
+    def table_info(self, tables: list[str]) -> dict[str, dict]:
+        info = {}
+        for table in tables:
+            schema_name, table_name = table.split('.')
+            exists = self.execute_query(
+                f"SELECT 1 FROM {schema_name}.sqlite_master WHERE type = 'table' AND name = ?",
+                params=(table_name,), label="table info"
+            )
+            if not exists:
+                continue
+
+            (rows,) = self.execute_query(f"SELECT count(*) FROM {table}", label="table info")[0]
+            # dbstat is not compiled in every SQLite build
+            size = self.execute_query(
+                f"SELECT sum(pgsize) FROM dbstat(?) WHERE name = ?", params=(schema_name, table_name), label="table info"
+            )
+            info[table] = {
+                'diststyle' : None,
+                'sortkey1'  : None,
+                'encoded'   : None,
+                'size'      : round(size[0][0] / 2**20, 3) if size and size[0][0] else None,
+                'tbl_rows'  : rows,
+            }
+        return info
@@ -0,0 +1,193 @@
+import re
+import time
+import string
+import hashlib
+from logging import Logger
+from src.utils.custom_logger import init_logger
+
+
+def _digest(*parts) -> int:
+    return int.from_bytes(hashlib.sha1(':'.join(str(part) for part in parts).encode('utf-8')).digest()[:8], 'big')
+
+
+def _spotify_id(*parts) -> str:
+    """Deterministic 22-character base62 ID, like Spotify IDs"""
+    alphabet = string.digits + string.ascii_letters
+    number = _digest(*parts) * _digest(*parts, 'salt')
+    chars = []
+    for _ in range(22):
+        number, remainder = divmod(number, 62)
+        chars.append(alphabet[remainder])
+    return ''.join(chars)
+
+
+class SyntheticResponse:
+    """Minimal stand-in of requests.Response"""
+
+    def __init__(self, data: dict) -> None:
+        self._data = data
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self) -> dict:
+        return self._data
+
+
+class SyntheticSpotifySession:
+    """Stand-in of the requests Session used by the fetchers. Answers the search, tracks,
+    artists, albums and audio features endpoints with synthetic data. The same request always gets the same answer,
+    and IDs returned by a search can be fetched. Like real searches, the first hit is the
+    searched song or artist, followed by covers, karaoke versions, remasters and namesakes.
+    """
+
+    genres = ['rock', 'pop', 'soul', 'jazz', 'indie', 'folk', 'house', 'metal']
+
+    def __init__(self, seed: int = 0, latency_seconds: float = 0.0, max_results: int = 6) -> None:
+        self.seed = seed
+        self.latency_seconds = latency_seconds
+        self.max_results = max_results
+        self.headers = {}
+
+    def get(self, url: str, params: dict = None) -> SyntheticResponse:
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+
+        params = params or {}
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+
+        if endpoint == 'search':
+            return SyntheticResponse(self._search(params['q'], params['type'], int(params.get('limit', 10))))
+        elif endpoint == 'tracks':
+            return SyntheticResponse({'tracks': [self._track(id) for id in params['ids'].split(',')]})
+        elif endpoint == 'artists':
+            return SyntheticResponse({'artists': [self._artist(id) for id in params['ids'].split(',')]})
+        elif endpoint == 'albums':
+            return SyntheticResponse({'albums': [self._album(id) for id in params['ids'].split(',')]})
+        elif endpoint == 'audio-features':
+            return SyntheticResponse({'audio_features': [self._audio_features(id) for id in params['ids'].split(',')]})
+        else:
+            return SyntheticResponse({})
+
+    def _search(self, q: str, object_type: str, limit: int) -> dict:
+        num_results = min(limit, _digest(self.seed, object_type, q) % (self.max_results + 1))
+        match = re.match(r"(?:track:(?P<title>.*) )?artist:(?P<artist>.*)", q)
+        title, artist = (match['title'] or '', match['artist']) if match else (q, q)
+        items = []
+
+        for i in range(num_results):
+            id = _spotify_id(self.seed, object_type, q, i)
+            variant = 0 if i == 0 else _digest(self.seed, 'variant', q, i) % 4
+            other_artist = f"Artist {id[:6]}"
+
+            if object_type == 'artist':
+                items.append({'id': id, 'name': [artist, f"The {artist}", other_artist, f"{artist} Tribute Band"][variant]})
+            else:
+                name, artist_name = [
+                    (title, artist),
+                    (f"{title} - Remastered", artist),
+                    (f"{title} (Karaoke Version)", "Karaoke Hits Band"),
+                    (title, other_artist),
+                ][variant]
+                year = 1960 + _digest(self.seed, 'year', id) % 60
+                items.append({
+                    'id'        : id,
+                    'name'      : name,
+                    'artists'   : [{'id': _spotify_id(self.seed, 'artist', artist_name), 'name': artist_name}],
+                    'album'     : {'id': _spotify_id(self.seed, 'album', id), 'name': f"Album {id[:6]}", 'release_date': f"{year}-01-01"},
+                })
+
+        return {f"{object_type}s": {'items': items}}
+
+    def _track(self, id: str) -> dict:
+        digest = _digest(self.seed, 'track', id)
+        artist_id = _spotify_id(self.seed, 'track_artist', id)
+        return {
+            'id'                : id,
+            'name'              : f"Track {id[:6]}",
+            'external_urls'     : {'spotify': f"https://open.spotify.com/track/{id}"},
+            'external_ids'      : {'isrc': f"QZ{digest % 10**10:010d}"},
+            'popularity'        : digest % 101,
+            'available_markets' : ['US', 'GB', 'SE', 'VN'][:1 + digest % 4],
+            'album'             : {'id': _spotify_id(self.seed, 'album', id)},
+            'artists'           : [{'id': artist_id, 'name': f"Artist {artist_id[:6]}"}],
+            'duration_ms'       : 60000 + digest % 300000,
+        }
+
+    def _artist(self, id: str) -> dict:
+        digest = _digest(self.seed, 'artist', id)
+        return {
+            'id'                : id,
+            'name'              : f"Artist {id[:6]}",
+            'external_urls'     : {'spotify': f"https://open.spotify.com/artist/{id}"},
+            'followers'         : {'total': digest % 1000000},
+            'popularity'        : digest % 101,
+            'genres'            : self.genres[:digest % 4],
+        }
+
+    def _album(self, id: str) -> dict:
+        digest = _digest(self.seed, 'album', id)
+        artist_id = _spotify_id(self.seed, 'album_artist', id)
+        return {
+            'id'                        : id,
+            'name'                      : f"Album {id[:6]}",
+            'album_type'                : ['album', 'single', 'compilation'][digest % 3],
+            'external_urls'             : {'spotify': f"https://open.spotify.com/album/{id}"},
+            'external_ids'              : {'upc': f"{digest % 10**12:012d}"},
+            'release_date'              : f"{1960 + digest % 60}-01-01",
+            'release_date_precision'    : 'day',
+            'total_tracks'              : 1 + digest % 20,
+            'label'                     : f"Label {digest % 50}",
+            'popularity'                : digest % 101,
+            'genres'                    : [],
+            'artists'                   : [{'id': artist_id, 'name': f"Artist {artist_id[:6]}"}],
+        }
+
+    def _audio_features(self, id: str) -> dict:
+        digest = _digest(self.seed, 'audio_features', id)
+        # Features in [0, 1], taken from successive bytes of the digest
+        unit = lambda i: round((digest >> (8 * i) & 0xff) / 255, 3)
+        return {
+            'id'                : id,
+            'type'              : 'audio_features',
+            'danceability'      : unit(0),
+            'energy'            : unit(1),
+            'key'               : digest % 12,
+            'loudness'          : round(-30 * unit(2), 3),
+            'mode'              : digest % 2,
+            'speechiness'       : unit(3),
+            'acousticness'      : unit(4),
+            'instrumentalness'  : unit(5),
+            'liveness'          : unit(6),
+            'valence'           : unit(7),
+            'tempo'             : round(60 + 140 * unit(1) * unit(0), 3),
+            'duration_ms'       : 60000 + digest % 300000,
+            'time_signature'    : 3 + digest % 3,
+        }
+
+
+class SyntheticSpotifyClient:
+    """Offline replacement of SpotifyClient, to be passed to SongFetcher and ArtistFetcher.
+    No credentials are needed and no request leaves the machine.
+    """
+
+    def __init__(self, seed: int = 0, latency_seconds: float = 0.0, logger: Logger = None) -> None:
+        """
+        Parameters
+        ----------
+        seed : int, optional
+            Seed of the synthetic data, by default 0
+        latency_seconds : float, optional
+            Time every request takes, to simulate the latency of the API, by default 0
+        logger : Logger, optional
+        """
+        self.logger = logger or init_logger(self.__class__.__name__)
+        self.session = SyntheticSpotifySession(seed, latency_seconds)
+        self.logger.info("Using synthetic Spotify data")
+
+    def check_authentication(self):
+        pass
+
+    def check_connection(self):
+        pass
@@ -0,0 +1,89 @@
+import re
+
+
+# DDL options that only exist in Redshift
+redshift_table_options = [
+    r"\bDISTSTYLE\s+\w+",
+    r"\bDISTKEY\s*\([^)]*\)",
+    r"\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)",
+    r"\bENCODE\s+\w+",
+]
+
+# FROM mapped.songs as mapped_songs, mapped_songs.spotify_song_ids AS spotify_song_id
+unnest_pattern = re.compile(
+    r"(FROM\s+\w+\.\w+\s+as\s+(?P<alias>\w+)\s*),\s*(?P=alias)\.(?P<column>\w+)\s+AS\s+(?P<element>\w+)", 
+    re.IGNORECASE
+)
+
+# Row count check on the system catalog, see data_quality.tests.catalog_has_data_query
+catalog_count_pattern = re.compile(
+    r"select\s+sum\(perm\.rows\) as cnt\s+from stv_tbl_perm.*?"
+    r"ns\.nspname = '(?P<schema>\w+)' and cls\.relname = '(?P<table>\w+)'\s+(?P<having>having .*)$",
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def translate(query: str, parameterized: bool = False) -> str:
+    """Translate a Redshift query from etl_queries / data_quality to SQLite.
+
+    - Distribution, sort key and encoding options are removed
+    - VARCHAR(MAX) and SUPER columns become TEXT (SUPER values are stored as JSON text)
+    - Navigating a SUPER array in the FROM clause (PartiQL unnest) becomes json_each()
+    - Catalog row counts on STV_TBL_PERM become a count(*) on the table
+    - JSON_PARSE() becomes json(), and %s placeholders become ? for parameterized queries
+
+    Parameters
+    ----------
+    query : str
+        Redshift query
+    parameterized : bool, optional
+        True if the query is executed with parameters, by default False
+
+    Returns
+    -------
+    str
+        SQLite query
+    """
+    catalog_count = catalog_count_pattern.search(query.strip())
+    if catalog_count:
+        return (f"select count(*) as cnt from {catalog_count['schema']}.{catalog_count['table']} "
+                f"{catalog_count['having']}")
+
+    for pattern in redshift_table_options:
+        query = re.sub(pattern, "", query, flags=re.IGNORECASE)
+
+    query = re.sub(r"\bVARCHAR\s*\(\s*MAX\s*\)", "TEXT", query, flags=re.IGNORECASE)
+    query = re.sub(r"\bSUPER\b", "TEXT", query)
+
+    for match in list(unnest_pattern.finditer(query)):
+        element = match['element']
+        query = query.replace(
+            match.group(0), 
+            f"{match.group(1)}, json_each({match['alias']}.{match['column']}) AS {element}"
+        )
+        query = re.sub(rf"CAST\(\s*{element}\s+AS", f"CAST({element}.value AS", query, flags=re.IGNORECASE)
+
+    if parameterized:
+        query = re.sub(r"\bJSON_PARSE\(", "json(", query, flags=re.IGNORECASE)
+        query = query.replace("%s", "?")
+
+    return query
+
+
+def fnv_hash(value) -> int:
+    """64-bit FNV-1a hash of a value, returned as a signed integer like Redshift's FNV_HASH"""
+    if value is None:
+        return None
+
+    result = 0xcbf29ce484222325
+    for byte in str(value).encode('utf-8'):
+        result ^= byte
+        result = (result * 0x100000001b3) & 0xffffffffffffffff
+
+    return result - (1 << 64) if result >= (1 << 63) else result
+
+
+def mod(a, b):
+    if a is None or b is None:
+        return None
+    return int(a) % int(b)
@@ -0,0 +1,118 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from logging import Logger
+from src.utils.custom_logger import init_logger
+from src.utils.metrics import add_to_active_stages
+
+
+def local_path(root_dir: str, s3_path: str) -> str:
+    """Map an S3 path (s3://bucket/key) to its location under the local storage root"""
+    return os.path.join(root_dir, 's3', s3_path.removeprefix("s3://").lstrip("/"))
+
+
+def list_objects(root_dir: str, s3_path: str) -> list[Path]:
+    """List the files of all objects whose key starts with the prefix of an S3 path, 
+    the way COPY and list_objects_v2 match keys.
+
+    Parameters
+    ----------
+    root_dir : str
+        Root of the local storage
+    s3_path : str
+        Full S3 path to an object or a prefix, for example s3://bucket/msd/songs/
+
+    Returns
+    -------
+    list[Path]
+        Paths of the files, sorted by key
+    """
+    bucket_name, _, prefix = s3_path.removeprefix("s3://").partition("/")
+    bucket_dir = Path(local_path(root_dir, bucket_name))
+
+    return [
+        path for path in sorted(bucket_dir.rglob('*'))
+        if path.is_file() and path.relative_to(bucket_dir).as_posix().startswith(prefix)
+    ]
+
+
+def read_json_records(path: str) -> list[dict]:
+    """Read the records of a JSON file. Supports a JSON array, new-line delimited JSON 
+    and concatenated JSON objects.
+    """
+    content = Path(path).read_text()
+    decoder = json.JSONDecoder()
+    records = []
+    position = 0
+
+    while True:
+        while position < len(content) and content[position].isspace():
+            position += 1
+        if position >= len(content):
+            break
+        value, position = decoder.raw_decode(content, position)
+        records.extend(value if isinstance(value, list) else [value])
+
+    return records
+
+
+class LocalS3Client:
+    """Filesystem-backed replacement of S3Client. Objects are stored as plain files 
+    in {root_dir}/s3/{bucket}/{key}
+    """
+
+    def __init__(self, root_dir: str, logger: Logger = None):
+        self.logger = logger or init_logger(self.__class__.__name__)
+        self.root_dir = root_dir
+        os.makedirs(os.path.join(root_dir, 's3'), exist_ok=True)
+        self.logger.info(f"Using local storage in {root_dir}")
+
+    def _object_path(self, bucket_name: str, file_name: str) -> str:
+        return local_path(self.root_dir, f"{bucket_name}/{file_name}")
+
+    def create_bucket(self, bucket_name: str) -> None:
+        os.makedirs(self._object_path(bucket_name, ""), exist_ok=True)
+
+    def upload_content(self, content: str, bucket_name: str, file_name: str):
+        path = Path(self._object_path(bucket_name, file_name))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+    def upload_file(self, input_file_path: str, bucket_name: str, file_path: str):
+        destination = self._object_path(bucket_name, file_path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(input_file_path, destination)
+        self.logger.info(f"File copied to s3://{bucket_name}/{file_path}")
+        add_to_active_stages(bytes_uploaded=os.path.getsize(input_file_path))
+
+    def list_etags(self, s3_path: str) -> dict[str, str]:
+        """List the MD5 of all files under an S3 path, like the ETags of objects uploaded 
+        in a single part.
+
+        Parameters
+        ----------
+        s3_path : str
+            Full S3 path to an object or a prefix, for example s3://bucket/msd/songs/
+
+        Returns
+        -------
+        dict[str, str]
+            Mapping of object key to ETag
+        """
+        bucket_dir = Path(self._object_path(s3_path.removeprefix("s3://").partition("/")[0], ""))
+
+        return {
+            path.relative_to(bucket_dir).as_posix(): f'"{hashlib.md5(path.read_bytes()).hexdigest()}"'
+            for path in list_objects(self.root_dir, s3_path)
+        }
+
+    def delete_files(self, bucket_name: str, file_paths: list[str]):
+        for file_path in file_paths:
+            os.remove(self._object_path(bucket_name, file_path))
+        if len(file_paths) > 0:
+            self.logger.info(f"Deleted {len(file_paths)} files from s3://{bucket_name}")
+
+    def download_file(self, bucket_name: str, file_path: str, output_file_path: str):
+        shutil.copyfile(self._object_path(bucket_name, file_path), output_file_path)
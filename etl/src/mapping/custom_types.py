@@ -17,6 +17,7 @@ class MappedSong(BaseModel):
     """Class to represent the search results of spotify.SongFetcher.search_one()"""
     msd_song_id: str
     spotify_song_ids: list[str]
+    spotify_song_scores: list[float] = []
 
 class MappedArtist(BaseModel):
     """Class to represent the search results of spotify.ArtistFetcher.search_one()"""
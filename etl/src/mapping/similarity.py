@@ -0,0 +1,137 @@
+import re
+import numpy as np
+
+from src.msd.custom_types import MsdSong
+
+
+# Versions that are rarely the MSD recording, unless the MSD title says so
+noise_terms = [
+    'karaoke', 'cover', 'tribute', 'instrumental', 'made famous by', 'in the style of',
+    'originally performed', 'backing track', 'remix', 'live'
+]
+
+# Weights of the components of the score. Missing components (no release or year in the
+# MSD data) are left out and the other weights are scaled up.
+weights = {'title': 0.5, 'artist': 0.3, 'release': 0.1, 'year': 0.1}
+
+noise_penalty = 0.5
+
+
+def normalize(text: str) -> str:
+    """Lower case, drop bracketed parts and " - ..." version suffixes, keep letters and digits"""
+    text = (text or '').lower()
+    text = re.sub(r"[\(\[].*?[\)\]]", " ", text)
+    text = text.split(' - ')[0]
+    text = text.replace('&', ' and ')
+    return ' '.join(re.findall(r"\w+", text))
+
+
+def _trigram_matrix(texts: list[str], vocabulary: dict[str, int]) -> np.ndarray:
+    matrix = np.zeros((len(texts), len(vocabulary)))
+    for row, text in enumerate(texts):
+        padded = f"  {text} "
+        columns = [vocabulary[padded[i:i + 3]] for i in range(len(padded) - 2)]
+        np.add.at(matrix[row], columns, 1)
+    return matrix
+
+
+def similarity(query: str, candidates: list[str]) -> np.ndarray:
+    """Cosine similarity between the character trigrams of a normalized query and of each
+    normalized candidate, computed for all candidates at once.
+
+    Parameters
+    ----------
+    query : str
+    candidates : list[str]
+
+    Returns
+    -------
+    np.ndarray
+        One similarity in [0, 1] per candidate
+    """
+    texts = [normalize(query)] + [normalize(candidate) for candidate in candidates]
+    vocabulary = {}
+    for text in texts:
+        padded = f"  {text} "
+        for i in range(len(padded) - 2):
+            vocabulary.setdefault(padded[i:i + 3], len(vocabulary))
+
+    matrix = _trigram_matrix(texts, vocabulary)
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1
+    matrix = matrix / norms[:, None]
+
+    return matrix[1:] @ matrix[0]
+
+
+def score_tracks(msd_song: MsdSong, tracks: list[dict]) -> np.ndarray:
+    """Rate Spotify search hits against an MSD song by title, artist, release and year.
+
+    Parameters
+    ----------
+    msd_song : MsdSong
+    tracks : list[dict]
+        Track objects of a Spotify search response
+
+    Returns
+    -------
+    np.ndarray
+        One score in [0, 1] per track
+    """
+    if len(tracks) == 0:
+        return np.zeros(0)
+
+    components = {
+        'title': similarity(msd_song.name, [track.get('name') for track in tracks])
+    }
+
+    # Best match among the artists of each track
+    artist_names = [[artist.get('name') for artist in track.get('artists') or []] or [''] for track in tracks]
+    artist_similarity = similarity(msd_song.artist_name, [name for names in artist_names for name in names])
+    offsets = np.cumsum([0] + [len(names) for names in artist_names[:-1]])
+    components['artist'] = np.maximum.reduceat(artist_similarity, offsets)
+
+    if msd_song.release:
+        components['release'] = similarity(msd_song.release, [(track.get('album') or {}).get('name') for track in tracks])
+
+    if msd_song.year:
+        release_years = np.array([
+            float(((track.get('album') or {}).get('release_date') or 'nan')[:4] or 'nan') for track in tracks
+        ])
+        year_score = 1 - np.minimum(np.abs(release_years - msd_song.year), 10) / 10
+        components['year'] = np.nan_to_num(year_score, nan=0.0)
+
+    total_weight = sum(weights[name] for name in components)
+    scores = sum(weights[name] * values for name, values in components.items()) / total_weight
+
+    msd_title = msd_song.name.lower()
+    penalties = np.array([
+        noise_penalty if any(term in (track.get('name') or '').lower() and term not in msd_title for term in noise_terms)
+        else 1.0
+        for track in tracks
+    ])
+
+    return scores * penalties
+
+
+def select_candidates(scores: np.ndarray, min_score: float = None, top_k: int = None) -> list[int]:
+    """Indices of the candidates to keep, best first
+
+    Parameters
+    ----------
+    scores : np.ndarray
+    min_score : float, optional
+        Keep only the candidates scoring at least this, by default no threshold
+    top_k : int, optional
+        Keep at most this many candidates, by default no limit
+
+    Returns
+    -------
+    list[int]
+    """
+    order = np.argsort(-scores, kind='stable')
+    if min_score is not None:
+        order = order[scores[order] >= min_score]
+    if top_k is not None:
+        order = order[:top_k]
+    return order.tolist()
@@ -1 +1,12 @@
-from src.msd.msd import SongExtractor, ArtistExtractor
\ No newline at end of file
+from src.utils.lazy import lazy_exports
+
+exports = {
+    'SongExtractor'     : 'src.msd.msd',
+    'ArtistExtractor'   : 'src.msd.msd',
+    'iter_h5_images'    : 'src.msd.msd',
+    'track_folder'      : 'src.msd.msd',
+    'compact_msd'       : 'src.msd.store',
+}
+
+__all__ = list(exports)
+__getattr__, __dir__ = lazy_exports(__name__, exports)
@@ -1,6 +1,10 @@
 from abc import ABC, abstractmethod
 from logging import Logger
+from fnmatch import fnmatch
+from pathlib import PurePosixPath
+from typing import Callable, Iterable, Iterator
 import glob
+import tarfile
 import tables
 import numpy as np
 
@@ -8,6 +12,74 @@ from src.utils.custom_logger import init_logger
 from src.utils.helper import iter_execute, write_json
 from src.msd.custom_types import MsdSong, MsdArtist
 
+def open_h5(file_path: str, image: bytes = None) -> tables.File:
+    """Open an H5 file for reading, from disk or, if `image` is given, from its content 
+    already in memory with the HDF5 core driver. Nothing is read from or written to disk 
+    in that case, `file_path` only names the file.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to one H5 file
+    image : bytes, optional
+        Content of the file, by default read the file from disk
+
+    Returns
+    -------
+    tables.File
+    """
+    if image is None:
+        return tables.open_file(file_path, 'r')
+    return tables.open_file(file_path, 'r', driver='H5FD_CORE', driver_core_image=image, driver_core_backing_store=0)
+
+
+def track_folder(file_path: str) -> str:
+    """Folder of a track file in the MSD layout, for example A/B for .../A/B/C/TRABC....h5"""
+    return "/".join(PurePosixPath(file_path).parts[-4:-2])
+
+
+def iter_h5_images(archive_path: str, pattern: str = "*.h5", folders: Iterable[str] = None) -> Iterator[tuple[str, bytes]]:
+    """Stream the H5 files out of a tar archive (.tar, .tar.gz, ...), without unpacking it. 
+    The archive is read once, front to back, and each yielded file is read into memory.
+
+    With `folders`, the files of other folders are skipped without being read, and the 
+    archive is closed once the last of the folders is done. The files of a folder must be
+    next to each other in the archive, as in the MSD archives.
+
+    Parameters
+    ----------
+    archive_path : str
+    pattern : str, optional
+        Only yield members whose name matches this fnmatch pattern, by default "*.h5"
+    folders : Iterable[str], optional
+        Only yield the files of these folders (see track_folder()), by default all of them
+
+    Yields
+    ------
+    tuple[str, bytes]
+        Name of the member in the archive, and its content
+    """
+    wanted = set(folders) if folders is not None else None
+    remaining = set(wanted) if wanted is not None else None
+    current = None
+
+    with tarfile.open(archive_path, 'r|*') as archive:
+        for member in archive:
+            if not (member.isfile() and fnmatch(member.name, pattern)):
+                continue
+
+            folder = track_folder(member.name)
+            if wanted is not None and folder != current:
+                # The archive moved on to the next folder, the previous one is done
+                remaining.discard(current)
+                if len(remaining) == 0:
+                    return
+                current = folder
+
+            if wanted is None or folder in wanted:
+                yield member.name, archive.extractfile(member).read()
+
+
 class BaseExtractor(ABC):
     """Abstract class for MSD dataset extractors"""
     
@@ -15,8 +87,15 @@ class BaseExtractor(ABC):
     def __init__(self, logger: Logger = None) -> None:
         self.logger = logger or init_logger(self.__class__.__name__)
 
+    # Whether store_record() needs the artist terms
+    store_terms = False
+
+    @abstractmethod
+    def extract_one_file(self, input_path: str, image: bytes = None) -> dict:
+        pass
+
     @abstractmethod
-    def extract_one_file(self, input_path: str) -> dict:
+    def store_record(self, row: np.void, terms: list[str]) -> MsdSong | MsdArtist:
         pass
     
     def extract_many_files(self, input_path: str) -> list[MsdSong] | list[MsdArtist]:
@@ -45,15 +124,70 @@ class BaseExtractor(ABC):
                 func=self.extract_one_file, 
                 iterable=self.file_paths, 
                 logger=self.logger,
+                stage=f"{self.__class__.__name__}.extract_many_files"
             )
 
         return data
 
+    def extract_many_images(self, images: Iterable[tuple[str, bytes]]) -> list[MsdSong] | list[MsdArtist]:
+        """Extract multiple objects from H5 files already in memory, for example the members 
+        of an archive streamed by iter_h5_images()
+
+        Parameters
+        ----------
+        images : Iterable[tuple[str, bytes]]
+            Name and content of each H5 file
+
+        Returns
+        -------
+        list[MsdSong] | list[MsdArtist]
+            List of MsdSong objects or MsdArtist objects
+        """
+        return iter_execute(
+            func=lambda image: self.extract_one_file(*image),
+            iterable=images,
+            logger=self.logger,
+            stage=f"{self.__class__.__name__}.extract_many_images"
+        )
+
+    def extract_store(self, store_path: str, folder: str = None) -> list[MsdSong] | list[MsdArtist]:
+        """Extract multiple objects from the consolidated store written by compact_msd(), 
+        reading its songs sequentially instead of opening one file per track
+
+        Parameters
+        ----------
+        store_path : str
+            H5 file of the store
+        folder : str, optional
+            Only extract the songs of this folder, for example "A/B", by default all of them
+
+        Returns
+        -------
+        list[MsdSong] | list[MsdArtist]
+            List of MsdSong objects or MsdArtist objects
+        """
+        # Imported here, the store module imports this one
+        from src.msd.store import read_store
+
+        data = []
+        for rows, terms in read_store(store_path, folder, with_terms=self.store_terms):
+            data += iter_execute(
+                func=lambda i: self.store_record(rows[i], terms[i]),
+                iterable=range(len(rows)),
+                logger=self.logger,
+                stage=f"{self.__class__.__name__}.extract_store"
+            )
+        return data
+
     def output_json(
             self, 
             data: list[MsdSong | MsdArtist] | MsdSong | MsdArtist, 
             output_path: str,
-            new_line_delimited: bool = True
+            new_line_delimited: bool = True,
+            max_bytes: int = None,
+            max_records: int = None,
+            on_part: Callable = None,
+            remote_path: str = None
         ):
         """Write a JSON representation of the objects
 
@@ -65,21 +199,34 @@ class BaseExtractor(ABC):
             Full destination path.
         new_line_delimited : bool
             if True, write JSON in new-line delimited format
+        max_bytes, max_records : int, optional
+            Write the records to part files of at most this many bytes / records, see write_json()
+        on_part : Callable[[Dataset], None], optional
+            Called with every part once it is written, for example to upload it
+        remote_path : str, optional
+            Where output_path would be uploaded, the remote paths of the parts are derived from it
+
+        Returns
+        -------
+        list[Dataset] | None
+            Handles to the parts, if the records were written to parts
         """
-        write_json(data, output_path, new_line_delimited, self.logger)
+        return write_json(data, output_path, new_line_delimited, self.logger, max_bytes, max_records, on_part, remote_path)
                         
 
 class SongExtractor(BaseExtractor):
     def __init__(self, logger: Logger = None) -> None:
         super().__init__(logger)
 
-    def extract_one_file(self, file_path: str) -> list[MsdSong]:
+    def extract_one_file(self, file_path: str, image: bytes = None) -> list[MsdSong]:
         """Extract song data from one MSD's H5 file and
 
         Parameters
         ----------
         file_path : str
             Path to one H5 file
+        image : bytes, optional
+            Content of the file, if it is already in memory. See open_h5()
 
         Returns
         -------
@@ -87,7 +234,7 @@ class SongExtractor(BaseExtractor):
             An object representing a song extracted from MSD dataset
         """
 
-        with tables.open_file(file_path, 'r') as file:
+        with open_h5(file_path, image) as file:
 
             def extract_func(row):
                 song_id = file.root.metadata.songs.cols.song_id[row].decode('utf-8')
@@ -110,21 +257,49 @@ class SongExtractor(BaseExtractor):
                 return MsdSong(**data)
 
             nrows = file.root.metadata.songs.nrows
-            result = iter_execute(extract_func, range(nrows))
+            result = iter_execute(extract_func, range(nrows), stage=f"{self.__class__.__name__}.extract_one_file")
 
         return result
 
+    def store_record(self, row: np.void, terms: list[str]) -> MsdSong:
+        """Song of one row of the consolidated store"""
+        return MsdSong(
+            id          = row['song_id'].decode('utf-8'),
+            name        = row['title'].decode('utf-8'),
+            release     = row['release'].decode('utf-8'),
+            genre       = row['genre'].decode('utf-8'),
+            artist_id   = row['artist_id'].decode('utf-8'),
+            artist_name = row['artist_name'].decode('utf-8'),
+            year        = int(row['year'])
+        )
+
 class ArtistExtractor(BaseExtractor):
+    store_terms = True
+
     def __init__(self, logger: Logger = None) -> None:
         super().__init__(logger)
 
-    def extract_one_file(self, input_path: str) -> MsdArtist:
+    def store_record(self, row: np.void, terms: list[str]) -> MsdArtist:
+        """Artist of one row of the consolidated store"""
+        latitude, longitude = row['artist_latitude'], row['artist_longitude']
+        return MsdArtist(
+            id          = row['artist_id'].decode('utf-8'),
+            name        = row['artist_name'].decode('utf-8'),
+            location    = row['artist_location'].decode('utf-8'),
+            latitude    = None if np.isnan(latitude) else latitude,
+            longitude   = None if np.isnan(longitude) else longitude,
+            tags        = terms
+        )
+
+    def extract_one_file(self, input_path: str, image: bytes = None) -> MsdArtist:
         """Extract artist data from one MSD's H5 file
 
         Parameters
         ----------
         input_path : str
             Path to one H5 file
+        image : bytes, optional
+            Content of the file, if it is already in memory. See open_h5()
 
         Returns
         -------
@@ -132,7 +307,7 @@ class ArtistExtractor(BaseExtractor):
             An object representing a song extracted from MSD dataset
         """
 
-        with tables.open_file(input_path, 'r') as file:
+        with open_h5(input_path, image) as file:
 
             def extract_func(row):            
                 id = file.root.metadata.songs.cols.artist_id[row].decode('utf-8')
@@ -153,6 +328,6 @@ class ArtistExtractor(BaseExtractor):
                 return MsdArtist(**data)
 
             nrows = file.root.metadata.songs.nrows
-            result = iter_execute(extract_func, range(nrows))
+            result = iter_execute(extract_func, range(nrows), stage=f"{self.__class__.__name__}.extract_one_file")
         
         return result
@@ -0,0 +1,151 @@
+import os
+from glob import glob
+from logging import Logger
+from pathlib import PurePosixPath
+import tables
+import numpy as np
+
+from src.utils.custom_logger import init_logger
+from src.utils.helper import iter_execute
+from src.msd.msd import open_h5, iter_h5_images, track_folder
+
+
+class StoreSong(tables.IsDescription):
+    """One row of the songs table of the consolidated store. The text columns have the
+    widths of the MSD files. The artist terms of a song are the `terms_count` strings of
+    the artist_terms array starting at `terms_start`."""
+    track_id            = tables.StringCol(32, pos=0)
+    folder              = tables.StringCol(8, pos=1)
+    song_id             = tables.StringCol(32, pos=2)
+    title               = tables.StringCol(1024, pos=3)
+    release             = tables.StringCol(1024, pos=4)
+    genre               = tables.StringCol(1024, pos=5)
+    year                = tables.Int32Col(pos=6)
+    artist_id           = tables.StringCol(32, pos=7)
+    artist_name         = tables.StringCol(1024, pos=8)
+    artist_location     = tables.StringCol(1024, pos=9)
+    artist_latitude     = tables.Float64Col(pos=10)
+    artist_longitude    = tables.Float64Col(pos=11)
+    terms_start         = tables.Int64Col(pos=12)
+    terms_count         = tables.Int32Col(pos=13)
+
+
+def compact_msd(
+        input_path: str,
+        output_path: str,
+        filters: tables.Filters = None,
+        logger: Logger = None
+    ) -> int:
+    """Merge the per-track MSD files into one consolidated store: a chunked, compressed
+    songs table with the metadata/songs and musicbrainz/songs columns read by the
+    extractors, and a flat artist_terms array the songs point into. song_id, artist_id
+    and folder are indexed. Tracks are stored in the order of their folders, so that the
+    songs of a folder are read sequentially.
+
+    The store is written next to `output_path` and moved into place once complete.
+
+    Parameters
+    ----------
+    input_path : str
+        Folder of the H5 files, or the MSD archive (.tar.gz) to stream them from
+    output_path : str
+        H5 file of the store
+    filters : tables.Filters, optional
+        Compression of the store, by default blosc:zstd level 5 with shuffle
+    logger : Logger, optional
+
+    Returns
+    -------
+    int
+        Number of songs in the store
+    """
+    logger = logger or init_logger("compact_msd")
+    filters = filters or tables.Filters(complevel=5, complib='blosc:zstd', shuffle=True)
+
+    if os.path.isfile(input_path):
+        images = iter_h5_images(input_path)
+    else:
+        images = ((path, None) for path in sorted(glob(f"{input_path}/**/*.h5", recursive=True)))
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with tables.open_file(f"{output_path}.tmp", 'w', filters=filters) as store:
+        songs = store.create_table('/', 'songs', StoreSong, "MSD songs", expectedrows=1_000_000)
+        terms = store.create_earray('/', 'artist_terms', tables.StringAtom(256), (0,), "Artist terms of the songs", expectedrows=10_000_000)
+        row = songs.row
+
+        def compact_one(image: tuple[str, bytes]) -> int:
+            file_path, content = image
+            with open_h5(file_path, content) as file:
+                metadata = file.root.metadata.songs.read()
+                years = file.root.musicbrainz.songs.cols.year[:]
+                artist_terms = file.root.metadata.artist_terms[:]
+
+            for i in range(len(metadata)):
+                for column in ['song_id', 'title', 'release', 'genre', 'artist_id', 'artist_name',
+                               'artist_location', 'artist_latitude', 'artist_longitude']:
+                    row[column] = metadata[column][i]
+                row['track_id'] = PurePosixPath(file_path).stem
+                row['folder'] = track_folder(file_path)
+                row['year'] = years[i]
+                row['terms_start'] = terms.nrows
+                row['terms_count'] = len(artist_terms)
+                row.append()
+
+                if len(artist_terms) > 0:
+                    terms.append(artist_terms)
+
+            return len(metadata)
+
+        num_songs = sum(iter_execute(compact_one, images, logger=logger, stage="compact_msd"))
+        songs.flush()
+
+        for column in [songs.cols.song_id, songs.cols.artist_id, songs.cols.folder]:
+            column.create_csindex()
+
+        store.root._v_attrs.source = input_path
+
+    os.replace(f"{output_path}.tmp", output_path)
+    logger.info(f"Compacted {num_songs} songs into {output_path} ({os.path.getsize(output_path) / 2**20:.1f} MB)")
+    return num_songs
+
+
+def read_store(store_path: str, folder: str = None, chunk_rows: int = 10_000, with_terms: bool = True):
+    """Read the songs of a consolidated store sequentially, chunk by chunk, with the artist
+    terms of each song
+
+    Parameters
+    ----------
+    store_path : str
+        Store written by compact_msd()
+    folder : str, optional
+        Only read the songs of this folder, for example "A/B", through the folder index.
+        By default read all the songs
+    chunk_rows : int, optional
+        Number of songs read at a time, by default 10000
+    with_terms : bool, optional
+        If False, don't read the artist terms, by default True
+
+    Yields
+    ------
+    tuple[np.ndarray, list[list[str]]]
+        Structured array of songs (StoreSong columns), and the terms of each song
+    """
+    with tables.open_file(store_path, 'r') as store:
+        songs, terms = store.root.songs, store.root.artist_terms
+
+        if folder is None:
+            chunks = (songs.read(start, start + chunk_rows) for start in range(0, songs.nrows, chunk_rows))
+        else:
+            chunks = [songs.read_where('folder == value', condvars={'value': folder.encode('utf-8')})]
+
+        for rows in chunks:
+            if len(rows) == 0:
+                continue
+            if not with_terms:
+                yield rows, [[] for _ in range(len(rows))]
+                continue
+
+            # The terms of the songs of a chunk are next to each other, read them at once
+            first, last = rows['terms_start'].min(), (rows['terms_start'] + rows['terms_count']).max()
+            chunk_terms = np.char.decode(terms[first:last], 'utf-8').tolist() if last > first else []
+            yield rows, [chunk_terms[start - first:start - first + count] for start, count in zip(rows['terms_start'], rows['terms_count'])]
@@ -0,0 +1,180 @@
+import os
+import string
+import random
+from logging import Logger
+import tables
+import numpy as np
+
+from src.utils.custom_logger import init_logger
+
+
+# Same layout as the tables of the real MSD files
+metadata_songs_dtype = np.dtype([
+    ('analyzer_version', 'S32'),
+    ('artist_7digitalid', 'i4'),
+    ('artist_familiarity', 'f8'),
+    ('artist_hotttnesss', 'f8'),
+    ('artist_id', 'S32'),
+    ('artist_latitude', 'f8'),
+    ('artist_location', 'S1024'),
+    ('artist_longitude', 'f8'),
+    ('artist_mbid', 'S40'),
+    ('artist_name', 'S1024'),
+    ('artist_playmeid', 'i4'),
+    ('genre', 'S1024'),
+    ('idx_artist_terms', 'i4'),
+    ('idx_similar_artists', 'i4'),
+    ('release', 'S1024'),
+    ('release_7digitalid', 'i4'),
+    ('song_hotttnesss', 'f8'),
+    ('song_id', 'S32'),
+    ('title', 'S1024'),
+    ('track_7digitalid', 'i4'),
+])
+
+musicbrainz_songs_dtype = np.dtype([
+    ('idx_artist_mbtags', 'i4'),
+    ('year', 'i4'),
+])
+
+filters = tables.Filters(complevel=1, complib='zlib', shuffle=True)
+
+words = [
+    'love', 'night', 'blue', 'fire', 'dream', 'heart', 'rain', 'city', 'gold', 'river',
+    'shadow', 'light', 'road', 'summer', 'storm', 'angel', 'wild', 'echo', 'silver', 'dance'
+]
+
+terms = [
+    'rock', 'pop', 'soul', 'blues', 'jazz', 'hip hop', 'electronic', 'folk', 'punk', 'metal',
+    'country', 'reggae', 'classic rock', 'indie', 'ambient', 'funk', 'latin', 'house', '80s', 'female vocalist'
+]
+
+
+class SyntheticMsdGenerator:
+    """Generate synthetic H5 files with the layout of the Million Song Dataset: one file
+    per track, stored in {root}/{A}/{B}/{C}/TR{A}{B}{C}XXXXXXXXXXXXX.h5, with the
+    metadata/songs, metadata/artist_terms and musicbrainz/songs tables the extractors read.
+    """
+
+    def __init__(
+            self,
+            seed: int = 0,
+            num_artists: int = None,
+            with_analysis: bool = False,
+            logger: Logger = None
+        ) -> None:
+        """
+        Parameters
+        ----------
+        seed : int, optional
+            Seed of the random generator, the same seed gives the same files, by default 0
+        num_artists : int, optional
+            Number of distinct artists, by default one for every 10 tracks
+        with_analysis : bool, optional
+            If True, also write segments_pitches & segments_timbre arrays, so files have
+            roughly the size of the real ones, by default False
+        logger : Logger, optional
+        """
+        self.seed = seed
+        self.num_artists = num_artists
+        self.with_analysis = with_analysis
+        self.logger = logger or init_logger(self.__class__.__name__)
+
+    def _random_id(self, rng: random.Random, prefix: str, length: int = 16) -> str:
+        return prefix + ''.join(rng.choices(string.ascii_uppercase + string.digits, k=length))
+
+    def _random_name(self, rng: random.Random, num_words: int) -> str:
+        return ' '.join(rng.choices(words, k=num_words)).title()
+
+    def generate_many(self, output_dir: str, num_files: int, first_letters: str = string.ascii_uppercase) -> list[str]:
+        """Write `num_files` synthetic track files under `output_dir`
+
+        Parameters
+        ----------
+        output_dir : str
+            Root folder of the generated dataset
+        num_files : int
+            Number of track files to write
+        first_letters : str, optional
+            Letters used for the first level of folders, by default A-Z
+
+        Returns
+        -------
+        list[str]
+            Paths of the written files
+        """
+        rng = random.Random(self.seed)
+        num_artists = self.num_artists or max(1, num_files // 10)
+
+        artists = [
+            {
+                'artist_id': self._random_id(rng, 'AR'),
+                'artist_name': self._random_name(rng, rng.randint(1, 3)),
+                'artist_location': rng.choice(['Memphis, TN', 'London, England', 'Paris', '', 'Tokyo, Japan']),
+                'artist_latitude': rng.choice([rng.uniform(-90, 90), float('nan')]),
+                'artist_longitude': rng.choice([rng.uniform(-180, 180), float('nan')]),
+                'terms': rng.sample(terms, rng.randint(0, 10)),
+            }
+            for _ in range(num_artists)
+        ]
+
+        file_paths = []
+
+        for i in range(num_files):
+            letters = rng.choice(first_letters) + ''.join(rng.choices(string.ascii_uppercase, k=2))
+            track_id = self._random_id(rng, f"TR{letters}", 13)
+            file_path = os.path.join(output_dir, letters[0], letters[1], letters[2], f"{track_id}.h5")
+
+            self.generate_one(file_path, rng, rng.choice(artists))
+            file_paths.append(file_path)
+
+            if (i + 1) % 10000 == 0:
+                self.logger.info(f"Generated {i + 1} of {num_files} files")
+
+        return file_paths
+
+    def generate_one(self, file_path: str, rng: random.Random, artist: dict):
+        """Write one synthetic track file
+
+        Parameters
+        ----------
+        file_path : str
+            Destination of the H5 file
+        rng : random.Random
+            Random generator used to draw the song data
+        artist : dict
+            Artist of the song
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        song = np.zeros(1, dtype=metadata_songs_dtype)
+        song['artist_id'] = artist['artist_id'].encode('utf-8')
+        song['artist_name'] = artist['artist_name'].encode('utf-8')
+        song['artist_location'] = artist['artist_location'].encode('utf-8')
+        song['artist_latitude'] = artist['artist_latitude']
+        song['artist_longitude'] = artist['artist_longitude']
+        song['song_id'] = self._random_id(rng, 'SO').encode('utf-8')
+        song['title'] = self._random_name(rng, rng.randint(1, 5)).encode('utf-8')
+        song['release'] = self._random_name(rng, rng.randint(1, 4)).encode('utf-8')
+        song['song_hotttnesss'] = rng.random()
+
+        musicbrainz = np.zeros(1, dtype=musicbrainz_songs_dtype)
+        musicbrainz['year'] = rng.choice([0, rng.randint(1950, 2010)])
+
+        with tables.open_file(file_path, 'w', filters=filters) as file:
+            metadata = file.create_group('/', 'metadata')
+            file.create_table(metadata, 'songs', obj=song)
+            artist_terms = file.create_earray(metadata, 'artist_terms', tables.StringAtom(256), (0,))
+            if artist['terms']:
+                artist_terms.append(np.array([term.encode('utf-8') for term in artist['terms']], dtype='S256'))
+
+            musicbrainz_group = file.create_group('/', 'musicbrainz')
+            file.create_table(musicbrainz_group, 'songs', obj=musicbrainz)
+
+            if self.with_analysis:
+                analysis = file.create_group('/', 'analysis')
+                num_segments = rng.randint(200, 900)
+                np_rng = np.random.default_rng(rng.randint(0, 2**32 - 1))
+                for name in ['segments_pitches', 'segments_timbre']:
+                    array = file.create_earray(analysis, name, tables.Float64Atom(), (0, 12))
+                    array.append(np_rng.random((num_segments, 12)))
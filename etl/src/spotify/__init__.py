@@ -1 +1,13 @@
-from src.spotify.spotify import ArtistFetcher, SongFetcher, SpotifyClient
\ No newline at end of file
+from src.utils.lazy import lazy_exports
+
+exports = {
+    'AlbumFetcher'          : 'src.spotify.spotify',
+    'ArtistFetcher'         : 'src.spotify.spotify',
+    'AudioFeaturesFetcher'  : 'src.spotify.spotify',
+    'EntityStore'           : 'src.spotify.store',
+    'SongFetcher'           : 'src.spotify.spotify',
+    'SpotifyClient'         : 'src.spotify.spotify',
+}
+
+__all__ = list(exports)
+__getattr__, __dir__ = lazy_exports(__name__, exports)
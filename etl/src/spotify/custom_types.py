@@ -22,3 +22,59 @@ class SpotifyArtist(BaseModel):
     total_followers     : Optional[int]
     popularity          : Optional[float]
     genres              : Optional[list[str]]
+
+
+class SpotifyAlbum(BaseModel):
+    """Class to represent the album data fetched from Spotify"""
+    id                      : str
+    name                    : str
+    url                     : str
+    album_type              : Optional[str]
+    release_date            : Optional[str]
+    release_date_precision  : Optional[str]
+    total_tracks            : Optional[int]
+    label                   : Optional[str]
+    popularity              : Optional[float]
+    genres                  : Optional[list[str]]
+    external_ids            : Optional[dict]
+    artists                 : list[dict]
+
+
+class SpotifyAudioFeatures(BaseModel):
+    """Class to represent the audio features of a track fetched from Spotify"""
+    id                  : str
+    danceability        : Optional[float]
+    energy              : Optional[float]
+    key                 : Optional[int]
+    loudness            : Optional[float]
+    mode                : Optional[int]
+    speechiness         : Optional[float]
+    acousticness        : Optional[float]
+    instrumentalness    : Optional[float]
+    liveness            : Optional[float]
+    valence             : Optional[float]
+    tempo               : Optional[float]
+    duration_ms         : Optional[int]
+    time_signature      : Optional[int]
+
+
+# Audio features of a track and their NumPy types. Audio features are numerous and flat, 
+# so the fetched features are returned in structured arrays instead of one model per track, 
+# see AudioFeaturesFetcher. The order is the column order of the staging table, which 
+# COPY ... CSV relies on
+audio_features_columns = [
+    ('id'               , 'S22'),
+    ('danceability'     , 'f4'),
+    ('energy'           , 'f4'),
+    ('key'              , 'i1'),
+    ('loudness'         , 'f4'),
+    ('mode'             , 'i1'),
+    ('speechiness'      , 'f4'),
+    ('acousticness'     , 'f4'),
+    ('instrumentalness' , 'f4'),
+    ('liveness'         , 'f4'),
+    ('valence'          , 'f4'),
+    ('tempo'            , 'f4'),
+    ('duration_ms'      , 'i4'),
+    ('time_signature'   , 'i1'),
+]
@@ -1,18 +1,25 @@
 from abc import ABC, abstractmethod
 from logging import Logger
+from typing import Callable, Iterable
 
 from requests import Session, HTTPError
 from requests.adapters import HTTPAdapter, Retry
 from base64 import b64encode
-from datetime import datetime
+from threading import Lock
+from datetime import datetime, timedelta
 import pytz
+import numpy as np
 
 from src.utils.custom_logger import init_logger
 from src.utils.helper import iter_execute, write_json
+from src.utils.dataset import chunked
+from src.utils.metrics import add_to_active_stages
 from src.mapping.custom_types import IngegratedSongMetadata, IntegratedArtistMetadata
 from src.msd.custom_types import MsdArtist, MsdSong
-from src.spotify.custom_types import SpotifySong, SpotifyArtist
+from src.spotify.custom_types import SpotifySong, SpotifyArtist, SpotifyAlbum, SpotifyAudioFeatures, audio_features_columns
 from src.mapping.custom_types import MappedSong, MappedArtist
+from src.mapping.similarity import score_tracks, select_candidates
+from src.spotify.store import EntityStore
 
 
 class SpotifyClient:
@@ -22,6 +29,7 @@ class SpotifyClient:
         self.auth_url = 'https://accounts.spotify.com/api/token'
         self.client_id = client_id
         self.client_secret = client_secret
+        self._auth_lock = Lock()
 
         self.session = self.get_session()
         self.authenticate()
@@ -91,9 +99,11 @@ class SpotifyClient:
 
     def check_authentication(self):
         """Check if the access token is still in valid time time. if not, regenerate the access token.
+        The check is locked so that concurrent fetchers sharing this client refresh the token only once.
         """
-        if (datetime.now(pytz.utc) - self.access_token_created_at).total_seconds() >= 3600:
-            self.authenticate()
+        with self._auth_lock:
+            if (datetime.now(pytz.utc) - self.access_token_created_at).total_seconds() >= 3600:
+                self.authenticate()
 
     def check_connection(self):
         """Check if the client can connect to Spotify's server
@@ -111,17 +121,43 @@ class SpotifyClient:
 
 
 class BaseFetcher(ABC):
-    """Abstract class for various fetchers"""
+    """Abstract class for various fetchers, which fetch Spotify entities by their IDs"""
 
-    def __init__(self, client: SpotifyClient, logger: Logger = None) -> None:
+    # Kind of the fetched entities in the entity store, key of the entities in the
+    # response of `fetch_url`, and model of the entities. Set by the subclasses.
+    entity_kind: str = None
+    response_key: str = None
+    entity_model: type[SpotifySong | SpotifyArtist | SpotifyAlbum | SpotifyAudioFeatures] = None
+
+    def __init__(
+            self, 
+            client: SpotifyClient, 
+            logger: Logger = None, 
+            store: EntityStore = None, 
+            max_age: timedelta = None
+        ) -> None:
+        """
+        Parameters
+        ----------
+        client : SpotifyClient
+        logger : Logger, optional
+        store : EntityStore, optional
+            Store of the entities fetched before. If given, only the IDs missing from the store
+            or older than `max_age` are requested, and the fetched entities are added to it
+        max_age : timedelta, optional
+            Staleness window of the stored entities, by default they never go stale
+        """
         self.client = client
         if logger is None:
             self.logger = init_logger(self.__class__.__name__)
         else:
             self.logger = logger
+        self.store = store
+        self.max_age = max_age
     
     def _fetch_data(self, url, params):
         response = self.client.session.get(url=url, params=params)
+        add_to_active_stages(api_calls=1)
         try:
             response.raise_for_status()
         except HTTPError as e:
@@ -130,40 +166,121 @@ class BaseFetcher(ABC):
         else:
             return response.json()
 
+    @abstractmethod
+    def parse_entity(self, data: dict) -> SpotifySong | SpotifyArtist | SpotifyAlbum | SpotifyAudioFeatures:
+        """Convert one entity of the API response to `entity_model`"""
+        pass
+
+    def fetch_entities(self, ids: list[str]) -> list[SpotifySong | SpotifyArtist | SpotifyAlbum | SpotifyAudioFeatures]:
+        """Get the entities of some Spotify IDs, in the same order. With an entity store, 
+        fresh entities are read from the store and only the others are requested.
+
+        Parameters
+        ----------
+        ids : list[str]
+
+        Returns
+        -------
+        list[SpotifySong | SpotifyArtist | SpotifyAlbum | SpotifyAudioFeatures]
+            Entities that could be found
+        """
+        if len(ids) == 0:
+            return []
+
+        entities = {}
+        if self.store is not None:
+            entities = {id: self.entity_model(**data) for id, data in self.store.get_many(self.entity_kind, ids, self.max_age).items()}
+
+        missing_ids = [id for id in dict.fromkeys(ids) if id not in entities]
+        add_to_active_stages(store_hits=len(ids) - len(missing_ids))
+
+        if len(missing_ids) > 0:
+            self.client.check_authentication()
+            fetch_results = self._fetch_data(self.fetch_url, {'ids': ','.join(missing_ids)})
+
+            if fetch_results is not None:
+                fetched = [self.parse_entity(data) for data in fetch_results[self.response_key] if data is not None]
+                entities.update({entity.id: entity for entity in fetched})
+                if self.store is not None:
+                    self.store.put_many(self.entity_kind, fetched)
+
+        return [entities[id] for id in ids if id in entities]
+
     def output_json(
             self, 
             data: list[MappedArtist | MappedSong | SpotifyArtist | SpotifySong], 
             output_path: str,
-            new_line_delimited: bool = False
+            new_line_delimited: bool = False,
+            max_bytes: int = None,
+            max_records: int = None,
+            on_part: Callable = None,
+            remote_path: str = None
         ):
-        write_json(data, output_path, new_line_delimited, self.logger)
+        return write_json(data, output_path, new_line_delimited, self.logger, max_bytes, max_records, on_part, remote_path)
         
                 
     @abstractmethod
-    def search_one(self):
+    def fetch_one(self):
         pass
 
     @abstractmethod
-    def search_many(self):
+    def fetch_many(self):
         pass
 
+
+class BaseSearchFetcher(BaseFetcher):
+    """Abstract class for the fetchers that first search Spotify for the MSD entities,
+    to find the IDs to fetch"""
+
     @abstractmethod
-    def fetch_one(self):
+    def search_one(self):
         pass
 
     @abstractmethod
-    def fetch_many(self):
+    def search_many(self):
         pass
 
-class SongFetcher(BaseFetcher):
 
-    def __init__(self, client: SpotifyClient, logger: Logger = None) -> None:
-        super().__init__(client, logger)
+class SongFetcher(BaseSearchFetcher):
+
+    entity_kind = 'song'
+    response_key = 'tracks'
+    entity_model = SpotifySong
+
+    def __init__(
+            self, 
+            client: SpotifyClient, 
+            logger: Logger = None, 
+            min_score: float = None, 
+            top_k: int = None,
+            store: EntityStore = None,
+            max_age: timedelta = None
+        ) -> None:
+        """
+        Parameters
+        ----------
+        client : SpotifyClient
+        logger : Logger, optional
+        min_score : float, optional
+            Only keep search hits whose similarity score with the MSD song is at least this, 
+            by default keep all hits
+        top_k : int, optional
+            Only keep the best `top_k` search hits of each song, by default keep all hits
+        store : EntityStore, optional
+            Store of the songs fetched before, only missing or stale songs are requested
+        max_age : timedelta, optional
+            Staleness window of the stored songs, by default they never go stale
+        """
+        super().__init__(client, logger, store, max_age)
         self.search_url = "https://api.spotify.com/v1/search"
         self.fetch_url = "https://api.spotify.com/v1/tracks"
+        self.min_score = min_score
+        self.top_k = top_k
 
     def search_one(self, msd_song: MsdSong, limit=10) -> MappedSong:
         """Receive a MsdSong object and search for the song in Spotify by using its name and artist.
+        Hits are scored against the title, artist, release and year of the MSD song, and only 
+        those passing `min_score` / `top_k` are kept, best first, so fewer songs are fetched.
 
         Parameters
         ----------
@@ -187,9 +304,13 @@ class SongFetcher(BaseFetcher):
 
         result = self._fetch_data(self.search_url, params)
         if result is not None:
+            tracks = result['tracks']['items']
+            scores = score_tracks(msd_song, tracks)
+            selected = select_candidates(scores, self.min_score, self.top_k)
             matched_results = {
                 'msd_song_id': msd_song.id,
-                'spotify_song_ids': [i['id'] for i in result['tracks']['items']]
+                'spotify_song_ids': [tracks[i]['id'] for i in selected],
+                'spotify_song_scores': [round(float(scores[i]), 4) for i in selected]
             }
             return MappedSong(**matched_results)
         else:
@@ -214,7 +335,8 @@ class SongFetcher(BaseFetcher):
             iterable=msd_songs_list, 
             logger=self.logger,
             logging_interval=10,
-            message_template="Processed {} of {} songs ({}%)"
+            message_template="Processed {} of {} songs ({}%)",
+            stage="SongFetcher.search_many"
         )
 
         return results
@@ -236,9 +358,25 @@ class SongFetcher(BaseFetcher):
         result = self._fetch_data(self.fetch_url, params)
         return result
 
+    def parse_entity(self, track: dict) -> SpotifySong:
+        data = {
+            'id'                : track['id'],
+            'name'              : track['name'],
+            'url'               : track['external_urls']['spotify'],
+            'external_ids'      : track['external_ids'],
+            'popularity'        : track['popularity'],
+            'available_markets' : track['available_markets'],
+            'album_id'          : track['album']['id'],
+            'artists'           : [{'artist_id': artist['id'], 'artist_name': artist['name']}
+                                    for artist in track['artists']],
+            'duration_ms'       : track['duration_ms']
+        }
+        return SpotifySong(**data)
+
     def fetch_many(self, mapped_songs: list[MappedSong]) -> list[SpotifySong]:
         """Iterate through the list of MappedSong objects, and return full song metadata, including
-        both the MSD song ID and the Spotify song metadata
+        both the MSD song ID and the Spotify song metadata. Songs found in the entity store 
+        are not requested again.
 
         Parameters
         ----------
@@ -250,45 +388,34 @@ class SongFetcher(BaseFetcher):
         """
 
         def fetch_func(item: MappedSong) -> list:
-            result = []
-
-            if len(item.spotify_song_ids) > 0:
-            
-                params = {'ids': ','.join(item.spotify_song_ids)}
-                fetch_results = self._fetch_data(self.fetch_url, params)
-
-                for track in fetch_results['tracks']:
-                    data = {
-                        'id'                : track['id'],
-                        'name'              : track['name'],
-                        'url'               : track['external_urls']['spotify'],
-                        'external_ids'      : track['external_ids'],
-                        'popularity'        : track['popularity'],
-                        'available_markets' : track['available_markets'],
-                        'album_id'          : track['album']['id'],
-                        'artists'           : [{'artist_id': artist['id'], 'artist_name': artist['name']}
-                                                for artist in track['artists']],
-                        'duration_ms'       : track['duration_ms']
-                    }
-                    result.append(SpotifySong(**data))
-
-            return result
+            return self.fetch_entities(item.spotify_song_ids)
         
         results = iter_execute(
             func=fetch_func, 
             iterable=mapped_songs, 
             logger=self.logger,
             logging_interval=10,
-            message_template="Processing {} of {} songs ({}))"
+            message_template="Processing {} of {} songs ({}))",
+            stage="SongFetcher.fetch_many"
         )
 
         return results
 
 
-class ArtistFetcher(BaseFetcher):
+class ArtistFetcher(BaseSearchFetcher):
+
+    entity_kind = 'artist'
+    response_key = 'artists'
+    entity_model = SpotifyArtist
 
-    def __init__(self, client: SpotifyClient, logger: Logger = None) -> None:
-        super().__init__(client, logger)
+    def __init__(
+            self, 
+            client: SpotifyClient, 
+            logger: Logger = None, 
+            store: EntityStore = None, 
+            max_age: timedelta = None
+        ) -> None:
+        super().__init__(client, logger, store, max_age)
         self.search_url = "https://api.spotify.com/v1/search"
         self.fetch_url = "https://api.spotify.com/v1/artists"
 
@@ -341,7 +468,8 @@ class ArtistFetcher(BaseFetcher):
             iterable=msd_artists_list,
             logger=self.logger,
             logging_interval=10,
-            message_template="Processed {} of {} artists ({}%)"
+            message_template="Processed {} of {} artists ({}%)",
+            stage="ArtistFetcher.search_many"
         )
         return results
 
@@ -362,9 +490,21 @@ class ArtistFetcher(BaseFetcher):
         result = self._fetch_data(self.fetch_url, params)
         return result
 
+    def parse_entity(self, artist: dict) -> SpotifyArtist:
+        data = {
+            'id'                : artist['id'],
+            'name'              : artist['name'],
+            'url'               : artist['external_urls']['spotify'],
+            'total_followers'   : artist['followers']['total'],
+            'popularity'        : artist['popularity'],
+            'genres'            : artist['genres'],
+        }
+        return SpotifyArtist(**data)
+
     def fetch_many(self, artist_search_results: list[MappedArtist]) -> list[SpotifyArtist]:
         """Iterate through the list of MappedArtist objects and return a list of IntegratedArtistMetadata,
-        containing both data from MSD and Spotify    
+        containing both data from MSD and Spotify. Artists found in the entity store are not 
+        requested again.
 
         Parameters
         ----------
@@ -375,40 +515,190 @@ class ArtistFetcher(BaseFetcher):
         list[IntegratedArtistMetadata]
         """
         def fetch_func(item: MappedArtist) -> list:
-            
-            result = []
+            return self.fetch_entities(item.spotify_artist_ids)
 
-            if len(item.spotify_artist_ids) > 0:
+        results = iter_execute(
+            func=fetch_func, 
+            iterable=artist_search_results,
+            logger=self.logger,
+            logging_interval=10,
+            message_template="Processing {} of total {} artists ({}%)",
+            stage="ArtistFetcher.fetch_many"
+        )
 
-                params = {"ids": ','.join(item.spotify_artist_ids)}
-                fetch_results = self._fetch_data(self.fetch_url, params)
+        return results
+    
 
-                for artist in fetch_results['artists']:
-                    data = {
-                        'id'                : artist['id'],
-                        'name'              : artist['name'],
-                        'url'               : artist['external_urls']['spotify'],
-                        'total_followers'   : artist['followers']['total'],
-                        'popularity'        : artist['popularity'],
-                        'genres'            : artist['genres'],
-                    }
-                    result.append(SpotifyArtist(**data))
+class AlbumFetcher(BaseFetcher):
+    """Resolve the album IDs of fetched songs to full album metadata. Albums are not searched,
+    their IDs come from SpotifySong.album_id."""
 
-            return result
+    entity_kind = 'album'
+    response_key = 'albums'
+    entity_model = SpotifyAlbum
+
+    # Maximum number of IDs accepted by the albums endpoint
+    batch_size = 20
+
+    def __init__(
+            self, 
+            client: SpotifyClient, 
+            logger: Logger = None, 
+            store: EntityStore = None, 
+            max_age: timedelta = None
+        ) -> None:
+        super().__init__(client, logger, store, max_age)
+        self.fetch_url = "https://api.spotify.com/v1/albums"
+
+    def fetch_one(self, spotify_album_id: str) -> dict:
+        """Fetch one album from Spotify using the album's Spotify ID
+
+        Parameters
+        ----------
+        spotify_album_id : str
+
+        Returns
+        -------
+        dict
+            dict containing info about one album
+        """
+        self.client.check_authentication()
+        params = {"ids": spotify_album_id}
+        result = self._fetch_data(self.fetch_url, params)
+        return result
+
+    def parse_entity(self, album: dict) -> SpotifyAlbum:
+        data = {
+            'id'                        : album['id'],
+            'name'                      : album['name'],
+            'url'                       : album['external_urls']['spotify'],
+            'album_type'                : album.get('album_type'),
+            'release_date'              : album.get('release_date'),
+            'release_date_precision'    : album.get('release_date_precision'),
+            'total_tracks'              : album.get('total_tracks'),
+            'label'                     : album.get('label'),
+            'popularity'                : album.get('popularity'),
+            'genres'                    : album.get('genres'),
+            'external_ids'              : album.get('external_ids'),
+            'artists'                   : [{'artist_id': artist['id'], 'artist_name': artist['name']}
+                                            for artist in album.get('artists') or []],
+        }
+        return SpotifyAlbum(**data)
+
+    def fetch_many(self, spotify_songs: Iterable[SpotifySong]) -> list[SpotifyAlbum]:
+        """Fetch the albums of a list of songs. Album IDs are deduplicated across all the songs,
+        and requested `batch_size` at a time, so each album is requested at most once.
+
+        Parameters
+        ----------
+        spotify_songs : Iterable[SpotifySong]
+            Fetched songs, can be a generator
+
+        Returns
+        -------
+        list[SpotifyAlbum]
+        """
+        album_ids = list(dict.fromkeys(song.album_id for song in spotify_songs if song.album_id))
+        batches = list(chunked(album_ids, self.batch_size))
+
+        self.logger.info(f"Fetching {len(album_ids)} albums in {len(batches)} batches")
 
         results = iter_execute(
-            func=fetch_func, 
-            iterable=artist_search_results,
+            func=self.fetch_entities, 
+            iterable=batches,
             logger=self.logger,
             logging_interval=10,
-            message_template="Processing {} of total {} artists ({}%)"
+            message_template="Processed {} of {} album batches ({}%)",
+            stage="AlbumFetcher.fetch_many"
         )
 
         return results
-    
 
-class AlbumFetcher():
-    pass
+class AudioFeaturesFetcher(BaseFetcher):
+    """Fetch the audio features (tempo, energy, danceability...) of songs. Features are 
+    requested 100 IDs at a time, the maximum of the endpoint, and returned as a NumPy 
+    structured array with the columns of `audio_features_columns` instead of one object per song.
+    """
+
+    entity_kind = 'audio_features'
+    response_key = 'audio_features'
+    entity_model = SpotifyAudioFeatures
+
+    # Maximum number of IDs accepted by the audio features endpoint
+    batch_size = 100
+    dtype = np.dtype(audio_features_columns)
+
+    def __init__(
+            self, 
+            client: SpotifyClient, 
+            logger: Logger = None, 
+            store: EntityStore = None, 
+            max_age: timedelta = None
+        ) -> None:
+        super().__init__(client, logger, store, max_age)
+        self.fetch_url = "https://api.spotify.com/v1/audio-features"
+
+    def fetch_one(self, spotify_song_id: str) -> dict:
+        """Fetch the audio features of one song from Spotify
+
+        Parameters
+        ----------
+        spotify_song_id : str
+
+        Returns
+        -------
+        dict
+            dict containing the audio features of one song
+        """
+        self.client.check_authentication()
+        params = {"ids": spotify_song_id}
+        result = self._fetch_data(self.fetch_url, params)
+        return result
+
+    def parse_entity(self, features: dict) -> SpotifyAudioFeatures:
+        """Keep only the columns of the array, so the entity store holds the same data"""
+        return SpotifyAudioFeatures(**{name: features.get(name) for name in self.dtype.names})
+
+    def to_array(self, features: list[SpotifyAudioFeatures]) -> np.ma.MaskedArray:
+        """Convert audio features to a structured masked array, where missing values are masked.
+        Integers have no NaN, and a placeholder like -1 would be a real value (a key of -1 
+        means that no key was detected)"""
+        array = np.ma.masked_all(len(features), dtype=self.dtype)
+
+        for name in self.dtype.names:
+            values = [getattr(item, name) for item in features]
+            present = np.array([value is not None for value in values], dtype=bool)
+            array[name][present] = [value for value in values if value is not None]
+
+        return array
+
+    def fetch_many(self, spotify_song_ids: Iterable[str]) -> np.ma.MaskedArray:
+        """Fetch the audio features of songs. IDs are deduplicated, and requested 
+        `batch_size` at a time. Songs without audio features are left out.
+
+        Parameters
+        ----------
+        spotify_song_ids : Iterable[str]
+            Spotify song IDs, can be a generator
+
+        Returns
+        -------
+        np.ma.MaskedArray
+            Structured array with one row per song and the columns of `audio_features_columns`,
+            where missing features are masked
+        """
+        song_ids = list(dict.fromkeys(id for id in spotify_song_ids if id))
+        batches = list(chunked(song_ids, self.batch_size))
+
+        self.logger.info(f"Fetching audio features of {len(song_ids)} songs in {len(batches)} batches")
+
+        results = iter_execute(
+            func=lambda batch: self.to_array(self.fetch_entities(batch)), 
+            iterable=batches,
+            logger=self.logger,
+            logging_interval=10,
+            message_template="Processed {} of {} audio features batches ({}%)",
+            stage="AudioFeaturesFetcher.fetch_many"
+        )
 
-class AudioFeaturesFetcher():
-    pass
\ No newline at end of file
+        return np.ma.concatenate(results) if len(results) > 0 else np.ma.masked_all(0, dtype=self.dtype)
\ No newline at end of file
@@ -0,0 +1,151 @@
+import os
+import json
+import zlib
+import time
+import sqlite3
+from threading import Lock
+from logging import Logger
+from datetime import timedelta
+from pydantic import BaseModel
+
+from src.utils.custom_logger import init_logger
+from src.utils.dataset import Dataset, DatasetWriter
+
+
+class EntityStore:
+    """Local key-value store of the Spotify entities fetched so far (SpotifySong, SpotifyArtist...),
+    keyed by kind and Spotify ID. Records are stored as zlib-compressed JSON in a SQLite file,
+    with the time they were fetched, so fetchers only request the IDs that are missing or stale.
+    Thread-safe, so one store can be shared by fetches running concurrently.
+    """
+
+    create_table = """
+    CREATE TABLE IF NOT EXISTS entities (
+        kind        TEXT NOT NULL,
+        id          TEXT NOT NULL,
+        fetched_at  REAL NOT NULL,
+        data        BLOB NOT NULL,
+        PRIMARY KEY (kind, id)
+    ) WITHOUT ROWID
+    """
+
+    def __init__(self, path: str, logger: Logger = None) -> None:
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite file, created if it doesn't exist
+        logger : Logger, optional
+        """
+        self.logger = logger or init_logger(self.__class__.__name__)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        self._lock = Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(self.create_table)
+
+    @staticmethod
+    def _encode(record: BaseModel | dict) -> bytes:
+        data = record.dict() if isinstance(record, BaseModel) else record
+        return zlib.compress(json.dumps(data, separators=(',', ':'), default=str).encode('utf-8'))
+
+    @staticmethod
+    def _decode(data: bytes) -> dict:
+        return json.loads(zlib.decompress(data))
+
+    def get_many(self, kind: str, ids: list[str], max_age: timedelta = None) -> dict[str, dict]:
+        """Get the stored records of some IDs
+
+        Parameters
+        ----------
+        kind : str
+            Kind of entity, for example 'song' or 'artist'
+        ids : list[str]
+            Spotify IDs
+        max_age : timedelta, optional
+            Ignore records fetched longer ago than this, by default return all records
+
+        Returns
+        -------
+        dict[str, dict]
+            Mapping of ID to record, for the IDs that are stored and fresh
+        """
+        if len(ids) == 0:
+            return {}
+
+        min_fetched_at = time.time() - max_age.total_seconds() if max_age is not None else 0
+        placeholders = ', '.join('?' * len(ids))
+
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT id, data FROM entities WHERE kind = ? AND fetched_at >= ? AND id IN ({placeholders})",
+                (kind, min_fetched_at, *ids)
+            ).fetchall()
+
+        return {id: self._decode(data) for id, data in rows}
+
+    def put_many(self, kind: str, records: list[BaseModel | dict]):
+        """Insert or refresh records. Every record must have an `id`
+
+        Parameters
+        ----------
+        kind : str
+        records : list[BaseModel | dict]
+        """
+        fetched_at = time.time()
+        rows = [
+            (kind, record.id if isinstance(record, BaseModel) else record['id'], fetched_at, self._encode(record))
+            for record in records
+        ]
+
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO entities (kind, id, fetched_at, data) VALUES (?, ?, ?, ?)", rows)
+
+    def count(self, kind: str) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT count(*) FROM entities WHERE kind = ?", (kind,)).fetchone()[0]
+
+    def export(self, kind: str, output_path: str, remote_path: str = None, chunk_rows: int = 10000) -> Dataset:
+        """Write all the stored records of a kind to a new-line delimited JSON file,
+        for example to load the full entity set into a staging table. Records are read 
+        `chunk_rows` at a time in ID order, so that the whole set is never in memory and
+        other threads can use the store between two chunks.
+
+        Parameters
+        ----------
+        kind : str
+        output_path : str
+            Local file to write
+        remote_path : str, optional
+            Where the file will be uploaded, recorded in the handle
+        chunk_rows : int, optional
+            Number of records read at a time, by default 10000
+
+        Returns
+        -------
+        Dataset
+            Handle to the written file
+        """
+        last_id = ''
+
+        with DatasetWriter(output_path, remote_path) as writer:
+            while True:
+                with self._lock:
+                    rows = self.conn.execute(
+                        "SELECT id, data FROM entities WHERE kind = ? AND id > ? ORDER BY id LIMIT ?", 
+                        (kind, last_id, chunk_rows)
+                    ).fetchall()
+                if len(rows) == 0:
+                    break
+
+                writer.write(self._decode(data) for _, data in rows)
+                last_id = rows[-1][0]
+
+        self.logger.info(f"Exported {writer.dataset.rows} {kind} records to {output_path}")
+        return writer.dataset
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,12 @@
+from src.utils.lazy import lazy_exports
+
+exports = {
+    'PhysicalDesignTuner'   : 'src.tuning.physical_design',
+    'TableDesign'           : 'src.tuning.physical_design',
+    'table_definitions'     : 'src.tuning.physical_design',
+    'tuned_ddl'             : 'src.tuning.physical_design',
+    'load_designs'          : 'src.tuning.physical_design',
+}
+
+__all__ = list(exports)
+__getattr__, __dir__ = lazy_exports(__name__, exports)
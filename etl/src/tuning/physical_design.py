@@ -0,0 +1,493 @@
+import re
+import json
+import os
+from logging import Logger
+from typing import Optional
+from pydantic import BaseModel
+
+from src.aws.redshift import RedshiftClient
+from src.etl_queries import TuningQueries
+from src.utils.custom_logger import init_logger
+
+tuning = TuningQueries()
+
+create_pattern = re.compile(
+    r"^\s*(?P<header>CREATE\s+(?:TABLE|MATERIALIZED\s+VIEW)\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<table>\w+\.\w+))",
+    re.IGNORECASE
+)
+table_attribute_pattern = re.compile(
+    r"\s*\b(?:DISTSTYLE\s+\w+|DISTKEY\s*\([^)]*\)|(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\))",
+    re.IGNORECASE
+)
+# A CTE: "name AS (SELECT ..."
+cte_pattern = re.compile(r"\b(?P<name>\w+)\s+AS\s*\(\s*SELECT\b", re.IGNORECASE)
+# A table in a FROM or JOIN clause, with its alias if it has one
+source_pattern = re.compile(r"\b(?:FROM|JOIN)\s+(?P<source>\w+(?:\.\w+)?)(?:\s+(?:AS\s+)?(?P<alias>\w+))?", re.IGNORECASE)
+join_pattern = re.compile(r"\b(?P<left>\w+)\.(?P<left_column>\w+)\s*=\s*(?P<right>\w+)\.(?P<right_column>\w+)")
+filter_pattern = re.compile(
+    r"\b(?:WHERE|AND|OR)\s+(?P<alias>\w+)\.(?P<column>\w+)\s*(?:IS\b|IN\b|BETWEEN\b|LIKE\b|<>|!=|<=|>=|<|>|=(?!\s*\w+\.\w))",
+    re.IGNORECASE
+)
+partition_pattern = re.compile(r"\bPARTITION\s+BY\s+(?P<column>\w+)", re.IGNORECASE)
+
+# Words that can follow a table in a FROM or JOIN clause, and are not an alias
+keywords = {'where', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'join', 'on', 'group', 'order', 'limit', 'having', 'union'}
+
+# Join steps of a Redshift plan that move rows between nodes. DS_DIST_NONE and DS_DIST_ALL_NONE are collocated
+redistribution_pattern = re.compile(r"\bDS_(?:BCAST_INNER|DIST_ALL_INNER|DIST_BOTH|DIST_INNER|DIST_OUTER)\b")
+cost_pattern = re.compile(r"cost=[\d.]+\.\.(?P<total>[\d.]+)")
+
+
+class KeyUsage(BaseModel):
+    """How often the columns of a table are used as join keys, filters and window partitions"""
+    joins: dict[str, int] = {}
+    filters: dict[str, int] = {}
+    partitions: dict[str, int] = {}
+
+    def add(self, usage: str, column: str):
+        counts = getattr(self, usage)
+        counts[column] = counts.get(column, 0) + 1
+
+
+class TableDesign(BaseModel):
+    """Distribution style, sort key and column encodings of a table"""
+    table: str
+    diststyle: str
+    distkey: Optional[str]
+    sortkey: list[str] = []
+    encodings: dict[str, str] = {}
+
+
+def table_definitions(*query_objects) -> dict[str, str]:
+    """Collect the queries creating a table from etl_queries classes, for example
+    `table_definitions(StagingMsdQueries(), AnalyticsQueries())`
+
+    Returns
+    -------
+    dict[str, str]
+        Mapping of table name to its CREATE TABLE query. The first query is kept
+        if a table has several, for example a table and a materialized view
+    """
+    definitions = {}
+    for query_object in query_objects:
+        for query in vars(type(query_object)).values():
+            if isinstance(query, str) and (match := create_pattern.match(query)):
+                definitions.setdefault(match['table'], query)
+    return definitions
+
+
+def _split_top_level(text: str, separator: str = ',') -> list[str]:
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def _closing_paren(text: str, start: int) -> int:
+    """Position of the parenthesis closing the one at `start`"""
+    depth = 0
+    for i in range(start, len(text)):
+        depth += {'(': 1, ')': -1}.get(text[i], 0)
+        if depth == 0:
+            return i
+    raise ValueError(f"Unbalanced parentheses in {text[start:start + 80]}...")
+
+
+def _top_level_keywords(text: str, keyword: str) -> list[int]:
+    """Positions of a keyword outside of any parentheses"""
+    depth_at = []
+    depth = 0
+    for char in text:
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        depth_at.append(depth)
+    return [match.start() for match in re.finditer(rf"\b{keyword}\b", text, re.IGNORECASE) if depth_at[match.start()] == 0]
+
+
+def table_columns(query: str) -> list[str]:
+    """Columns of the table created by a CREATE TABLE query, from its column list,
+    or from the outer select list of a CREATE TABLE AS / materialized view
+    """
+    match = create_pattern.match(query)
+    rest = query[match.end():]
+
+    if rest.lstrip().startswith('('):
+        start = rest.index('(')
+        column_list = rest[start + 1:_closing_paren(rest, start)]
+        return [item.split()[0] for item in _split_top_level(column_list) if item.strip()]
+
+    select = _top_level_keywords(rest, 'select')[-1]
+    select_list = rest[select + len('select'):min(position for position in _top_level_keywords(rest, 'from') if position > select)]
+    columns = []
+    for item in _split_top_level(select_list):
+        item = item.strip()
+        if item.endswith('*'):
+            continue
+        alias = re.search(r"\bas\s+(\w+)$", item, re.IGNORECASE)
+        columns.append(alias[1] if alias else re.search(r"(\w+)$", item)[1])
+    return columns
+
+
+def key_usage(queries: list[str], columns: dict[str, list[str]]) -> dict[str, KeyUsage]:
+    """Find the join keys, filtered columns and window partitions of the tables read by some queries.
+
+    Aliases are resolved to tables, through CTEs: a column of a CTE is attributed to the
+    table the CTE selects from, if the table has a column of that name (it is not computed).
+
+    Parameters
+    ----------
+    queries : list[str]
+        Queries to inspect, for example the templates of AnalyticsQueries
+    columns : dict[str, list[str]]
+        Columns of the tables, see table_columns()
+
+    Returns
+    -------
+    dict[str, KeyUsage]
+        Usage of the columns of every table that has join keys, filters or partitions
+    """
+    usage: dict[str, KeyUsage] = {}
+
+    for query in queries:
+        sources = {}
+        ctes = {}
+
+        for match in cte_pattern.finditer(query):
+            start = query.rindex('(', match.start(), match.end())
+            body = query[start:_closing_paren(query, start)]
+            source = source_pattern.search(body)
+            if source:
+                ctes[match['name']] = (source['source'], body)
+
+        for match in source_pattern.finditer(query):
+            source, alias = match['source'], match['alias']
+            if alias is None or alias.lower() in keywords:
+                # Without alias, a table is referenced by its name
+                alias = source.split('.')[-1]
+            sources.setdefault(alias, source)
+
+        def resolve(alias: str, column: str) -> str:
+            name, through_cte = sources.get(alias, alias), False
+            while name in ctes:
+                name, through_cte = sources.get(ctes[name][0], ctes[name][0]), True
+            if '.' not in name or name not in columns:
+                return None
+            if through_cte and column not in columns[name]:
+                return None
+            return name
+
+        def add(table: str, usage_type: str, column: str):
+            if table is not None:
+                usage.setdefault(table, KeyUsage()).add(usage_type, column)
+
+        for match in join_pattern.finditer(query):
+            add(resolve(match['left'], match['left_column']), 'joins', match['left_column'])
+            add(resolve(match['right'], match['right_column']), 'joins', match['right_column'])
+
+        for match in filter_pattern.finditer(query):
+            add(resolve(match['alias'], match['column']), 'filters', match['column'])
+
+        for name, (source, body) in ctes.items():
+            for match in partition_pattern.finditer(body):
+                add(resolve(name, match['column']), 'partitions', match['column'])
+
+    return usage
+
+
+def _most_used(counts: dict[str, int], columns: list[str]) -> list[str]:
+    """Columns by decreasing count, ties in table order"""
+    return sorted(counts, key=lambda column: (-counts[column], columns.index(column) if column in columns else len(columns)))
+
+
+def propose_design(
+        table: str,
+        columns: list[str],
+        usage: KeyUsage = None,
+        encodings: dict[str, str] = None,
+        rows: int = None,
+        all_max_rows: int = 0
+    ) -> TableDesign:
+    """Propose the physical design of a table:
+
+    - Distribution on the most joined column, so both sides of the join are collocated, or
+      the most used window partition. Joined tables of at most `all_max_rows` rows are copied
+      to every node instead, and tables that are neither joined nor partitioned are spread evenly
+    - Compound sort key on the filtered columns, then the distribution key of joined tables, 
+      so filters skip blocks and joins on the key can be merge joins
+    - Column encodings recommended by ANALYZE COMPRESSION. The leading sort key column is
+      left uncompressed, so range-restricted scans don't decode more rows than they need
+
+    Parameters
+    ----------
+    table : str
+    columns : list[str]
+        Columns of the table
+    usage : KeyUsage, optional
+        Keys of the table in the queries that read it, see key_usage()
+    encodings : dict[str, str], optional
+        Encodings recommended by ANALYZE COMPRESSION
+    rows : int, optional
+        Number of rows of the table, if known
+    all_max_rows : int, optional
+        Joined tables up to this size are distributed to all nodes, by default 0 (never)
+
+    Returns
+    -------
+    TableDesign
+    """
+    usage = usage or KeyUsage()
+    distkey = (_most_used(usage.joins, columns) or _most_used(usage.partitions, columns) or [None])[0]
+
+    if distkey is None:
+        diststyle = 'EVEN'
+    elif usage.joins and all_max_rows > 0 and rows is not None and rows <= all_max_rows:
+        diststyle, distkey = 'ALL', None
+    else:
+        diststyle = 'KEY'
+
+    sortkey = _most_used(usage.filters, columns)
+    if distkey is not None and usage.joins and distkey not in sortkey:
+        sortkey.append(distkey)
+
+    encodings = {column: encoding for column, encoding in (encodings or {}).items() if column in columns}
+    if sortkey and sortkey[0] in encodings:
+        encodings[sortkey[0]] = 'raw'
+
+    return TableDesign(table=table, diststyle=diststyle, distkey=distkey, sortkey=sortkey, encodings=encodings)
+
+
+def table_attributes(design: TableDesign) -> list[str]:
+    attributes = [f"DISTSTYLE {design.diststyle}"]
+    if design.distkey:
+        attributes.append(f"DISTKEY({design.distkey})")
+    if design.sortkey:
+        attributes.append(f"COMPOUND SORTKEY({', '.join(design.sortkey)})")
+    return attributes
+
+
+def tuned_ddl(query: str, design: TableDesign) -> str:
+    """Rewrite a CREATE TABLE, CREATE TABLE AS or CREATE MATERIALIZED VIEW query with the
+    distribution style and sort key of a design, replacing the ones it has. Column encodings
+    are added to the column list of CREATE TABLE queries, see encoding_statements() for the others.
+    Applying the same design twice gives the same query.
+
+    Parameters
+    ----------
+    query : str
+    design : TableDesign
+
+    Returns
+    -------
+    str
+        The rewritten query
+    """
+    header = create_pattern.match(query)
+    position = header.end()
+    has_column_list = query[position:].lstrip().startswith('(')
+
+    if has_column_list:
+        start = query.index('(', position)
+        end = _closing_paren(query, start)
+        column_list = query[start:end]
+
+        for column, encoding in design.encodings.items():
+            column_list = re.sub(
+                rf"(?m)^(\s*{column}\s+[^,\n]*?)(?:\s+ENCODE\s+\w+)?(\s*,?\s*)$",
+                rf"\g<1> ENCODE {encoding}\g<2>", column_list, count=1
+            )
+        query = query[:start] + column_list + query[end:]
+        position = start + len(column_list) + 1
+
+    # Table attributes go between the table name (or column list) and AS
+    as_match = re.search(r"\bAS\b", query[position:], re.IGNORECASE) if not has_column_list else None
+    attributes_end = position + as_match.start() if as_match else len(query)
+    remainder = table_attribute_pattern.sub('', query[position:attributes_end])
+    indent = '\n    '
+
+    return query[:position] + indent + indent.join(table_attributes(design)) + remainder + query[attributes_end:]
+
+
+def ctas_select(query: str) -> str:
+    """The query after AS of a CREATE TABLE AS or CREATE MATERIALIZED VIEW query, to
+    refill the table it created without dropping it"""
+    header = create_pattern.match(query)
+    as_match = re.search(r"\bAS\b", query[header.end():], re.IGNORECASE)
+    return query[header.end() + as_match.end():]
+
+
+def encoding_statements(design: TableDesign) -> list[str]:
+    """ALTER statements setting the encodings of a design on an existing table, for tables
+    created with CREATE TABLE AS, which can't declare encodings. Sort key columns are skipped,
+    Redshift leaves them uncompressed.
+    """
+    return [
+        tuning.alter_encode.format(table=design.table, column=column, encoding=encoding)
+        for column, encoding in design.encodings.items() if column not in design.sortkey
+    ]
+
+
+def alter_statements(design: TableDesign) -> list[str]:
+    """ALTER statements applying a design to an existing table, without recreating it"""
+    if design.diststyle == 'KEY':
+        statements = [tuning.alter_diststyle_key.format(table=design.table, column=design.distkey)]
+    else:
+        statements = [tuning.alter_diststyle.format(table=design.table, diststyle=design.diststyle)]
+
+    if design.sortkey:
+        statements.append(tuning.alter_sortkey.format(table=design.table, columns=', '.join(design.sortkey)))
+
+    return statements + encoding_statements(design)
+
+
+def plan_cost(plan: list[str]) -> float:
+    """Total cost of the top step of a Redshift plan, None if the plan has no costs"""
+    for line in plan:
+        if match := cost_pattern.search(line):
+            return float(match['total'])
+    return None
+
+
+def plan_redistributions(plan: list[str]) -> list[str]:
+    """Join steps of a Redshift plan that redistribute or broadcast rows"""
+    return [match[0] for line in plan for match in redistribution_pattern.finditer(line)]
+
+
+def save_designs(designs: dict[str, TableDesign], path: str):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({table: design.dict() for table, design in designs.items()}, f, indent=4)
+
+
+def load_designs(path: str) -> dict[str, TableDesign]:
+    """Read the designs written by save_designs(), empty if the file doesn't exist"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return {table: TableDesign(**design) for table, design in json.load(f).items()}
+
+
+class PhysicalDesignTuner:
+    """Propose distribution styles, sort keys and column encodings for the tables of the ETL,
+    from the keys used by its queries and ANALYZE COMPRESSION, apply them to the existing
+    tables and measure their effect on table sizes and query plans.
+    """
+
+    def __init__(
+            self,
+            client: RedshiftClient,
+            definitions: dict[str, str],
+            queries: list[str],
+            logger: Logger = None,
+            all_max_rows: int = 0
+        ) -> None:
+        """
+        Parameters
+        ----------
+        client : RedshiftClient
+        definitions : dict[str, str]
+            Mapping of table name to the query creating it, see table_definitions()
+        queries : list[str]
+            Queries whose join keys and filters the design is tuned for
+        logger : Logger, optional
+        all_max_rows : int, optional
+            Joined tables up to this size are distributed to all nodes, by default 0 (never)
+        """
+        self.logger = logger or init_logger(self.__class__.__name__)
+        self.client = client
+        self.definitions = definitions
+        self.queries = queries
+        self.all_max_rows = all_max_rows
+        self.columns = {table: table_columns(query) for table, query in definitions.items()}
+
+    def propose(self) -> dict[str, TableDesign]:
+        """Propose a design for every table, see propose_design()"""
+        usage = key_usage(self.queries, self.columns)
+        info = self.client.table_info(list(self.definitions))
+        designs = {}
+
+        for table in self.definitions:
+            designs[table] = propose_design(
+                table, self.columns[table], usage.get(table), self.client.analyze_compression(table),
+                info.get(table, {}).get('tbl_rows'), self.all_max_rows
+            )
+            self.logger.info(f"{table}: {' '.join(table_attributes(designs[table]))}")
+
+        return designs
+
+    def apply(self, designs: dict[str, TableDesign], views: list[str] = None):
+        """Apply designs to the existing tables. Materialized views can't be altered, they get
+        their design when they are created again with tuned_ddl()
+
+        Parameters
+        ----------
+        designs : dict[str, TableDesign]
+        views : list[str], optional
+            Names of the tables that are materialized views, by default None
+        """
+        for table, design in designs.items():
+            if table in (views or []):
+                continue
+            self.logger.info(f"Applying the design of {table}...")
+            for statement in alter_statements(design):
+                self.client.execute_query(statement, label=f"tune {table}")
+
+    def measure(self, probes: dict[str, str]) -> dict:
+        """Measure the size of the tables, and the cost and redistribution steps of some queries
+
+        Parameters
+        ----------
+        probes : dict[str, str]
+            Mapping of name to a query to explain
+
+        Returns
+        -------
+        dict
+            'tables': table info by table name, 'queries': cost and redistributions by query name
+        """
+        queries = {}
+        for name, query in probes.items():
+            plan = self.client.explain(query)
+            queries[name] = {'cost': plan_cost(plan), 'redistributions': plan_redistributions(plan), 'plan': plan}
+
+        return {'tables': self.client.table_info(list(self.definitions)), 'queries': queries}
+
+    def report(self, before: dict, after: dict, designs: dict[str, TableDesign], output_path: str) -> dict:
+        """Write the designs with the measurements before and after applying them to a JSON file,
+        and log the changes of size and cost
+
+        Returns
+        -------
+        dict
+            The report
+        """
+        report = {
+            'tables': {
+                table: {
+                    'design': design.dict(),
+                    'before': before['tables'].get(table),
+                    'after' : after['tables'].get(table),
+                }
+                for table, design in designs.items()
+            },
+            'queries': {name: {'before': before['queries'][name], 'after': after['queries'][name]} for name in before['queries']},
+        }
+
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=4, default=str)
+
+        for table, entry in report['tables'].items():
+            size_before, size_after = [(entry[when] or {}).get('size') for when in ('before', 'after')]
+            self.logger.info(f"{table}: {size_before} MB -> {size_after} MB")
+
+        for name, entry in report['queries'].items():
+            self.logger.info(
+                f"{name}: cost {entry['before']['cost']} -> {entry['after']['cost']}, "
+                f"{len(entry['before']['redistributions'])} -> {len(entry['after']['redistributions'])} redistribution steps"
+            )
+
+        self.logger.info(f"Physical design report written to {output_path}")
+        return report
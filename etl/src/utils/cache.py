@@ -0,0 +1,16 @@
+import json
+from hashlib import sha256
+
+
+def fingerprint(*parts) -> str:
+    """Compute a stable content hash of the given parts. Parts can be anything that 
+    serializes to JSON (strings, numbers, lists, dicts...), so the same inputs always 
+    give the same fingerprint, across processes and flow runs.
+
+    Returns
+    -------
+    str
+        Hex digest of the parts
+    """
+    content = json.dumps(parts, sort_keys=True, default=str)
+    return sha256(content.encode('utf-8')).hexdigest()
@@ -0,0 +1,338 @@
+import os
+import csv
+import json
+from hashlib import sha256
+from itertools import islice
+from glob import glob, escape
+from typing import Callable, Iterable, Iterator, Optional
+from pydantic import BaseModel
+
+from src.utils import metrics
+
+
+class Dataset(BaseModel):
+    """Reference to records stored in a new-line delimited JSON file, or a CSV file with 
+    a header for columnar data. Tasks exchange these handles instead of the records 
+    themselves, and consumers stream the records from the file."""
+    path        : str
+    format      : str = 'ndjson'
+    rows        : int
+    checksum    : str
+    remote_path : Optional[str]
+
+
+class DatasetWriter:
+    """Write records to a new-line delimited JSON file chunk by chunk, counting the rows
+    and hashing the content on the way. Meant to be used as a context manager:
+
+        with DatasetWriter(output_path) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        dataset = writer.dataset
+
+    An interrupted write can be resumed: the records before `resume_position` (returned by 
+    flush()) are kept, anything written after is discarded, and new records are appended.
+    """
+
+    def __init__(self, output_path: str, remote_path: str = None, resume_position: int = 0) -> None:
+        """
+        Parameters
+        ----------
+        output_path : str
+            Local file to write. An empty file is written if there are no records
+        remote_path : str, optional
+            Where the file will be uploaded, recorded in the handle, by default None
+        resume_position : int, optional
+            Keep this many bytes of an existing output file, by default 0 (overwrite it)
+        """
+        self.output_path = output_path
+        self.remote_path = remote_path
+        self.resume_position = resume_position
+        self.rows = 0
+        self.bytes = resume_position
+        self.dataset: Dataset = None
+        self._hash = sha256()
+        self._file = None
+
+    def __enter__(self) -> "DatasetWriter":
+        os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+
+        if self.resume_position > 0:
+            self._file = open(self.output_path, 'r+b')
+            kept = self._file.read(self.resume_position)
+            if len(kept) < self.resume_position:
+                raise ValueError(f"Can't resume {self.output_path} at {self.resume_position}, it has {len(kept)} bytes")
+            self._hash.update(kept)
+            self.rows = kept.count(b'\n')
+            self._file.truncate(self.resume_position)
+            self._file.seek(self.resume_position)
+        else:
+            self._file = open(self.output_path, 'wb')
+        return self
+
+    @staticmethod
+    def encode(record: BaseModel | dict) -> bytes:
+        """Line of the file for one record"""
+        return (json.dumps(record.dict() if isinstance(record, BaseModel) else record, default=str) + '\n').encode('utf-8')
+
+    def write_line(self, line: bytes):
+        self._file.write(line)
+        self._hash.update(line)
+        self.rows += 1
+        self.bytes += len(line)
+
+    def write(self, records: Iterable[BaseModel | dict]):
+        for record in records:
+            self.write_line(self.encode(record))
+
+    def flush(self) -> int:
+        """Flush the records written so far to the file
+
+        Returns
+        -------
+        int
+            Position reached in the file, to resume from
+        """
+        self._file.flush()
+        return self._file.tell()
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._file.close()
+
+        if exc_type is None:
+            self.dataset = Dataset(
+                path        = self.output_path,
+                rows        = self.rows,
+                checksum    = self._hash.hexdigest(),
+                remote_path = self.remote_path
+            )
+            metrics.add_to_active_stages(records=self.rows, bytes_written=os.path.getsize(self.output_path))
+
+
+class RotatingDatasetWriter:
+    """Write records to a sequence of new-line delimited JSON part files, closing a part 
+    before it would exceed `max_bytes` or `max_records` and starting the next one. Parts 
+    are named after the output path with a stable sequence number, for example songs.json 
+    is written to songs.part-00000.json, songs.part-00001.json, ... so the same records 
+    always give the same parts.
+
+    Every part is sealed (closed and hashed) as soon as the next record doesn't fit in it, 
+    and passed to `on_part`, so that it can be uploaded or loaded while the next parts are 
+    still being written:
+
+        with RotatingDatasetWriter(output_path, max_bytes=64 * 2**20, on_part=upload) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        parts = writer.parts
+
+    Parts left by a previous, longer run of the same output path are deleted on exit.
+    """
+
+    def __init__(
+            self, 
+            output_path: str, 
+            remote_path: str = None, 
+            max_bytes: int = None, 
+            max_records: int = None,
+            on_part: Callable[[Dataset], None] = None
+        ) -> None:
+        """
+        Parameters
+        ----------
+        output_path : str
+            Local file the part paths are derived from
+        remote_path : str, optional
+            Where the file will be uploaded, the remote paths of the parts are derived 
+            from it the same way, by default None
+        max_bytes : int, optional
+            Size limit of the parts, by default no limit. A record larger than that 
+            gets a part of its own
+        max_records : int, optional
+            Number of records per part, by default no limit
+        on_part : Callable[[Dataset], None], optional
+            Called with the handle of every part once it is sealed
+        """
+        self.output_path = output_path
+        self.remote_path = remote_path
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.on_part = on_part
+        self.parts: list[Dataset] = []
+        self._part: DatasetWriter = None
+
+    @staticmethod
+    def part_path(path: str, sequence: int) -> str:
+        """Path of a part: the sequence number goes before the extension of `path`"""
+        root, extension = os.path.splitext(path)
+        return f"{root}.part-{sequence:05d}{extension}"
+
+    def __enter__(self) -> "RotatingDatasetWriter":
+        return self
+
+    def _full(self, line: bytes) -> bool:
+        """Whether the current part can't take this line. A part always takes its first line"""
+        return self._part.rows > 0 and (
+            (self.max_bytes is not None and self._part.bytes + len(line) > self.max_bytes)
+            or (self.max_records is not None and self._part.rows >= self.max_records)
+        )
+
+    def _open_part(self):
+        sequence = len(self.parts)
+        self._part = DatasetWriter(
+            self.part_path(self.output_path, sequence),
+            self.part_path(self.remote_path, sequence) if self.remote_path is not None else None
+        ).__enter__()
+
+    def _seal_part(self):
+        self._part.__exit__(None, None, None)
+        self.parts.append(self._part.dataset)
+        self._part = None
+
+        if self.on_part is not None:
+            self.on_part(self.parts[-1])
+
+    def write(self, records: Iterable[BaseModel | dict]):
+        for record in records:
+            line = DatasetWriter.encode(record)
+            if self._part is not None and self._full(line):
+                self._seal_part()
+            if self._part is None:
+                self._open_part()
+            self._part.write_line(line)
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            if self._part is not None:
+                self._part.__exit__(exc_type, exc, traceback)
+            return
+
+        # Write one empty part if there are no records, so that the output always has a first part
+        if self._part is None and len(self.parts) == 0:
+            self._open_part()
+        if self._part is not None:
+            self._seal_part()
+
+        # Parts left by a previous run that wrote more of them
+        root, extension = os.path.splitext(self.output_path)
+        for path in glob(f"{escape(root)}.part-*{extension}"):
+            if path not in [part.path for part in self.parts]:
+                os.remove(path)
+
+
+def write_columns(array, output_path: str, remote_path: str = None, chunk_size: int = 100000) -> Dataset:
+    """Write a NumPy structured array to a CSV file with a header, one column per field, 
+    without creating an object per row. Byte strings are decoded, NaNs and masked values 
+    are written as empty fields so that COPY loads them as NULL.
+
+    Parameters
+    ----------
+    array : np.ndarray | np.ma.MaskedArray
+        Structured array, its field names are the CSV columns
+    output_path : str
+        Local file to write
+    remote_path : str, optional
+        Where the file will be uploaded, recorded in the handle, by default None
+    chunk_size : int, optional
+        Number of rows formatted at a time, by default 100000
+
+    Returns
+    -------
+    Dataset
+        Handle to the written file, in the 'csv' format
+    """
+    import numpy as np
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    file_hash = sha256()
+
+    def format_column(values) -> list[str]:
+        missing = np.ma.getmaskarray(values)
+        values = np.ma.getdata(values)
+
+        if values.dtype.kind == 'S':
+            text = np.char.decode(values, 'utf-8')
+        elif values.dtype.kind == 'f':
+            missing = missing | np.isnan(values)
+            text = np.char.mod('%.6g', values)
+        else:
+            text = values.astype(str)
+
+        return np.where(missing, '', text).tolist()
+
+    with open(output_path, 'w') as f:
+        header = ','.join(array.dtype.names) + '\n'
+        f.write(header)
+        file_hash.update(header.encode('utf-8'))
+
+        for start in range(0, len(array), chunk_size):
+            chunk = array[start:start + chunk_size]
+            columns = [format_column(chunk[name]) for name in array.dtype.names]
+            text = ''.join(','.join(row) + '\n' for row in zip(*columns))
+            f.write(text)
+            file_hash.update(text.encode('utf-8'))
+
+    metrics.add_to_active_stages(records=len(array), bytes_written=os.path.getsize(output_path))
+
+    return Dataset(
+        path        = output_path,
+        format      = 'csv',
+        rows        = len(array),
+        checksum    = file_hash.hexdigest(),
+        remote_path = remote_path
+    )
+
+
+def verify_dataset(dataset: Dataset) -> bool:
+    """Whether the file of a dataset still exists, with the content it was written with.
+    Handles can outlive their file, for example when they are returned from the task cache."""
+    if not os.path.isfile(dataset.path):
+        return False
+
+    file_hash = sha256()
+    with open(dataset.path, 'rb') as f:
+        while block := f.read(2**20):
+            file_hash.update(block)
+    return file_hash.hexdigest() == dataset.checksum
+
+
+def read_dataset(dataset: Dataset, model: type[BaseModel] = None) -> Iterator[BaseModel | dict]:
+    """Stream the records of a dataset, one line at a time. Empty fields of CSV datasets
+    are read as None. The file is verified first, see verify_dataset().
+
+    Parameters
+    ----------
+    dataset : Dataset
+    model : type[BaseModel], optional
+        If given, records are parsed into this model, otherwise they are returned as dicts
+
+    Yields
+    ------
+    BaseModel | dict
+
+    Raises
+    ------
+    ValueError
+        If the file is missing or was changed since the dataset was written
+    """
+    if not verify_dataset(dataset):
+        raise ValueError(f"{dataset.path} is missing or changed since it was written, run again without the cache")
+
+    if dataset.format == 'csv':
+        with open(dataset.path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                record = {key: value if value != '' else None for key, value in row.items()}
+                yield model(**record) if model is not None else record
+        return
+
+    with open(dataset.path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield model(**record) if model is not None else record
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of at most `size` items, without materializing it"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import shutil
+from hashlib import sha256
+from logging import Logger
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from pydantic import BaseModel
+
+from src.utils.custom_logger import init_logger
+from src.utils.metrics import add_to_active_stages
+
+
+class DownloadResult(BaseModel):
+    """Summary of a finished download"""
+    path                : str
+    bytes               : int
+    checksum            : str
+    seconds             : float
+    bytes_per_second    : float
+    resumed_bytes       : int
+
+
+class RangedDownloader:
+    """Download a file over HTTP with parallel range requests. The file is split into chunks
+    of `chunk_size` bytes, downloaded by `num_workers` threads to part files in a
+    `{output_path}.parts` folder. A chunk interrupted by a dropped connection is continued
+    from the bytes already in its part file, both when it is retried and when the download
+    is started again later. Once all the chunks are there, they are joined into the output
+    file, whose size and SHA-256 are checked before it is moved into place.
+
+    Servers that don't accept range requests, or don't send the size of the file, are
+    downloaded in one request, started over on every retry.
+    """
+
+    def __init__(
+            self,
+            num_workers: int = 4,
+            chunk_size: int = 32 * 2**20,
+            retries: int = 5,
+            retry_delay_seconds: float = 1,
+            timeout: float = 60,
+            logger: Logger = None
+        ) -> None:
+        """
+        Parameters
+        ----------
+        num_workers : int, optional
+            Number of chunks downloaded at the same time, by default 4
+        chunk_size : int, optional
+            Size of the chunks, by default 32 MB
+        retries : int, optional
+            Number of times a chunk is continued after an error, by default 5
+        retry_delay_seconds : float, optional
+            Delay before the first retry, doubled at every retry, by default 1
+        timeout : float, optional
+            Seconds to wait for the server to connect or send data, by default 60
+        logger : Logger, optional
+        """
+        # Imported on first use, so that importing this module stays cheap
+        import requests
+
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.retry_delay_seconds = retry_delay_seconds
+        self.timeout = timeout
+        self.logger = logger or init_logger(self.__class__.__name__)
+        self.session = requests.Session()
+        self._lock = Lock()
+        self._downloaded = 0
+        self._chunks_done = 0
+
+    def probe(self, url: str) -> tuple[Optional[int], bool]:
+        """Size of the file, if the server sends it, and whether it accepts range requests"""
+        response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+        size = response.headers.get('Content-Length')
+        accept_ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return (int(size) if size is not None else None), accept_ranges
+
+    def download(self, url: str, output_path: str, checksum: str = None) -> DownloadResult:
+        """Download a file, continuing the chunks of a previous attempt if there are any
+
+        Parameters
+        ----------
+        url : str
+        output_path : str
+            Local file to write, only created once the download is complete and verified
+        checksum : str, optional
+            Expected SHA-256 of the file, as a hex string, by default not checked
+
+        Returns
+        -------
+        DownloadResult
+
+        Raises
+        ------
+        ValueError
+            If the size or the checksum of the downloaded file is not the expected one.
+            The chunks of the wrong size, or all the chunks if the checksum is wrong, are 
+            deleted, so that the next attempt downloads them again
+        """
+        start = time.perf_counter()
+        size, accept_ranges = self.probe(url)
+        parts_dir = f"{output_path}.parts"
+
+        # Chunks of a previous attempt are only continued if they were cut the same way
+        manifest = {'url': url, 'size': size, 'chunk_size': self.chunk_size}
+        manifest_path = f"{parts_dir}/manifest.json"
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                if json.load(f) != manifest:
+                    shutil.rmtree(parts_dir)
+        os.makedirs(parts_dir, exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+        if size is not None and accept_ranges:
+            chunks = [(offset, min(offset + self.chunk_size, size) - 1) for offset in range(0, size, self.chunk_size)]
+        else:
+            self.logger.warning(f"{url} doesn't support range requests, downloading it in one request")
+            chunks = [None]
+
+        part_paths = [f"{parts_dir}/{index:05d}" for index in range(len(chunks))]
+        resumed_bytes = sum(os.path.getsize(path) for path, chunk in zip(part_paths, chunks) if chunk is not None and os.path.exists(path))
+        if resumed_bytes > 0:
+            self.logger.info(f"Resuming the download of {url}, {resumed_bytes} bytes already downloaded")
+
+        self._downloaded, self._chunks_done = 0, 0
+        self.logger.info(f"Downloading {url} ({size or 'unknown'} bytes, {len(chunks)} chunks)...")
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            list(executor.map(lambda args: self._download_chunk(url, *args, len(chunks), start), zip(chunks, part_paths)))
+
+        # Join the chunks, hashing them on the way
+        file_hash, total = sha256(), 0
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        with open(f"{output_path}.tmp", 'wb') as output:
+            for path in part_paths:
+                with open(path, 'rb') as part:
+                    while block := part.read(2**20):
+                        output.write(block)
+                        file_hash.update(block)
+                        total += len(block)
+
+        error, bad_parts = None, []
+        if size is not None and total != size:
+            error = f"{url} has {size} bytes, {total} were downloaded"
+            bad_parts = [
+                path for path, chunk in zip(part_paths, chunks) 
+                if chunk is not None and os.path.getsize(path) != chunk[1] - chunk[0] + 1
+            ]
+        elif checksum is not None and file_hash.hexdigest() != checksum.lower():
+            error = f"SHA-256 of {url} is {file_hash.hexdigest()}, expected {checksum}"
+
+        # Chunks of the wrong size are downloaded again by the next attempt, the others are kept.
+        # A wrong checksum can't be traced to a chunk, all of them are downloaded again
+        if bad_parts:
+            for path in bad_parts:
+                os.remove(path)
+        else:
+            shutil.rmtree(parts_dir)
+        if error is not None:
+            os.remove(f"{output_path}.tmp")
+            raise ValueError(error)
+        os.replace(f"{output_path}.tmp", output_path)
+
+        seconds = time.perf_counter() - start
+        result = DownloadResult(
+            path                = output_path,
+            bytes               = total,
+            checksum            = file_hash.hexdigest(),
+            seconds             = seconds,
+            bytes_per_second    = self._downloaded / seconds if seconds > 0 else 0.0,
+            resumed_bytes       = resumed_bytes
+        )
+        add_to_active_stages(bytes_written=total)
+        self.logger.info(
+            f"Downloaded {output_path}: {total} bytes in {seconds:.1f}s "
+            f"({result.bytes_per_second / 2**20:.2f} MB/s), SHA-256 {result.checksum}"
+        )
+        return result
+
+    def _download_chunk(self, url: str, chunk: Optional[tuple[int, int]], part_path: str, num_chunks: int, start: float):
+        """Download one chunk (first and last byte, both included) to its part file, starting
+        after the bytes already in it. No chunk means the whole file, from the start.
+
+        A chunk is only done once its part file has the length of the chunk: a response ending
+        early, which the HTTP client doesn't always detect, is continued like a dropped 
+        connection, and a part file longer than its chunk is downloaded again."""
+        length = chunk[1] - chunk[0] + 1 if chunk is not None else None
+        for attempt in range(self.retries + 1):
+            have = os.path.getsize(part_path) if chunk is not None and os.path.exists(part_path) else 0
+            if have == length:
+                self._chunk_done(num_chunks, start)
+                return
+            if chunk is not None and have > length:
+                os.remove(part_path)
+                have = 0
+
+            headers = {'Range': f"bytes={chunk[0] + have}-{chunk[1]}"} if chunk is not None else {}
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    if chunk is not None and response.status_code != 206:
+                        raise ValueError(f"{url} ignored the range request of chunk {part_path}")
+
+                    with open(part_path, 'ab' if chunk is not None else 'wb') as f:
+                        for block in response.iter_content(2**16):
+                            f.write(block)
+                            with self._lock:
+                                self._downloaded += len(block)
+
+                received = os.path.getsize(part_path) if chunk is not None else None
+                if received != length:
+                    raise IOError(f"Chunk {os.path.basename(part_path)} has {received} bytes, expected {length}")
+                self._chunk_done(num_chunks, start)
+                return
+
+            except ValueError:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                self.logger.warning(f"Chunk {os.path.basename(part_path)} interrupted ({e}), continuing it")
+                time.sleep(self.retry_delay_seconds * 2 ** attempt)
+
+    def _chunk_done(self, num_chunks: int, start: float):
+        """Log the progress and throughput of the download so far"""
+        with self._lock:
+            self._chunks_done += 1
+            done, downloaded = self._chunks_done, self._downloaded
+        seconds = time.perf_counter() - start
+        self.logger.info(f"{done}/{num_chunks} chunks, {downloaded / 2**20 / seconds if seconds > 0 else 0:.2f} MB/s")
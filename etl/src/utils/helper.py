@@ -1,9 +1,11 @@
-from typing import Callable
+from typing import Callable, Iterable
 from logging import Logger
 from pydantic import BaseModel
 import json
 import os
+import time
 from logging import Logger
+from src.utils import metrics, progress
 
 def generate_intervals(total_num: int, interval: int = 10) -> list[int]:
     """Generate a list of index points to log the progress of an iterative process.
@@ -24,48 +26,88 @@ def generate_intervals(total_num: int, interval: int = 10) -> list[int]:
 
 def iter_execute(
         func: Callable, 
-        iterable: list, 
+        iterable: Iterable, 
         logger: Logger = None, 
         logging_interval: int = 20, 
-        message_template: str = "Processed {} of {} items ({}%)") -> list:
+        message_template: str = "Processed {} of {} items ({}%)",
+        stage: str = None,
+        hooks: list[progress.ProgressHook] = None) -> list:
     """Iterate throught an iterable and execute the function
 
     Parameters
     ----------
     func : Callable
         A function to be executed against the iterable
-    iterable : list
-        a list of input objects for the function
+    iterable : Iterable
+        Input objects for the function. Progress percentages need it to have a length
     logger : Logger
+        If given, progress is logged with a RateLogger hook
     loggin_interval : int
         Represents the interval that the logging message will be printed. 
         By default, the logger will print a message once every 20% of the total iterations.
     message_template : str
         Template of the logging message.
+    stage : str
+        Name of the loop in the stage metrics report. By default, the name of the function.
+    hooks : list[progress.ProgressHook], optional
+        Hooks observing the loop, in addition to the RateLogger and the global hooks
 
     Returns
     -------
     list
-        List containing the results of the func call.
+        List containing the results of the func call. List results are concatenated, 
+        NumPy arrays are kept as one item but count as one record per row.
     """
+    stage = stage or func.__qualname__
+    hooks = list(hooks or []) + progress.global_hooks
+
+    if logger is not None:
+        hooks.append(progress.RateLogger(logger, logging_interval, message_template))
 
     results = []
-    iter_num = len(iterable)
-    logging_points = generate_intervals(iter_num, logging_interval)
-    
-    for i, item in enumerate(iterable, start=1):
-        result = func(item)
-        
-        if result is not None:
-            if isinstance(result, list):
+    total = len(iterable) if hasattr(iterable, '__len__') else None
+    count, records = 0, 0
+
+    for hook in hooks:
+        hook.on_start(stage, total)
+
+    with metrics.stage_metrics.measure(stage) as tracker:
+        loop_start = time.perf_counter()
+
+        for count, item in enumerate(iterable, start=1):
+            start = time.perf_counter()
+
+            try:
+                result = func(item)
+            except Exception as e:
+                for hook in hooks:
+                    hook.on_error(stage, count, e)
+                raise e
+
+            latency = time.perf_counter() - start
+            
+            if result is None:
+                result_size = 0
+            elif isinstance(result, list):
                 results += result
+                result_size = len(result)
+            elif getattr(result, 'ndim', 0) > 0:
+                # A NumPy array is kept whole, and counts one record per row
+                results.append(result)
+                result_size = len(result)
             else:
                 results.append(result)
+                result_size = 1
+
+            records += result_size
+            for hook in hooks:
+                hook.on_item(stage, count, latency, result_size)
 
-        if logger is not None:
-            if i in logging_points:
-                pct = round(i / iter_num * 100, 0)
-                logger.info(message_template.format(i, iter_num, pct))
+        tracker.records = records
+
+    elapsed = time.perf_counter() - loop_start
+    for hook in hooks:
+        hook.on_finish(stage, count, elapsed)
     
     return results
 
@@ -74,7 +116,11 @@ def write_json(
         data: list[BaseModel] | BaseModel, 
         output_path: str, 
         new_line_delimited: bool = False,
-        logger = Logger
+        logger = Logger,
+        max_bytes: int = None,
+        max_records: int = None,
+        on_part: Callable = None,
+        remote_path: str = None
     ):
         """Write a JSON representation of the objects
 
@@ -85,16 +131,41 @@ def write_json(
             Full destination path.
         new_line_delimited: bool
             If True, write JSON in new-line delimited format
+        max_bytes, max_records : int, optional
+            If one of them is given (or on_part), new-line delimited records are written to 
+            part files of at most this many bytes / records, named after output_path with a 
+            sequence number. See RotatingDatasetWriter
+        on_part : Callable[[Dataset], None], optional
+            Called with the handle of every part once it is written, for example to upload it
+        remote_path : str, optional
+            Where output_path would be uploaded, the remote paths of the parts are derived from it
+
+        Returns
+        -------
+        list[Dataset] | None
+            Handles to the parts, if the records were written to parts
         """
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        rotate = new_line_delimited and (max_bytes is not None or max_records is not None or on_part is not None)
 
         if isinstance(data, BaseModel):
             with open(output_path, 'w') as f:
-                json.dump(data.dict(), f)
+                json.dump(data.dict(), f, default=str)
+
+            metrics.add_to_active_stages(bytes_written=os.path.getsize(output_path))
         
         elif isinstance(data, list):
 
-            if len(data) == 0:
+            if rotate:
+                # Imported here, the dataset module imports metrics which imports this module
+                from src.utils.dataset import RotatingDatasetWriter
+
+                # Also without records, so that the parts of a previous run are replaced
+                with RotatingDatasetWriter(output_path, remote_path, max_bytes, max_records, on_part) as writer:
+                    writer.write(data)
+                return writer.parts
+
+            elif len(data) == 0:
                 if logger is not None:
                     logger.warn(f"No data to write.")
                 
@@ -104,7 +175,9 @@ def write_json(
                 with open(output_path, 'w') as f:
                     if new_line_delimited:
                         for line in json_data:
-                            json.dump(line, f)
+                            json.dump(line, f, default=str)
                             f.write('\n')
                     else:
-                        json.dump(json_data, f)
\ No newline at end of file
+                        json.dump(json_data, f, default=str)
+
+                metrics.add_to_active_stages(bytes_written=os.path.getsize(output_path))
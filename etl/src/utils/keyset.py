@@ -0,0 +1,150 @@
+import os
+import json
+from typing import Iterator
+from pydantic import BaseModel
+
+
+class KeyRange(BaseModel):
+    """Range of keys processed by one worker: keys greater than `lower` (excluded) and
+    up to `upper` (included). Ranges of a plan don't overlap and cover all the keys."""
+    index   : int
+    lower   : str
+    upper   : str
+    keys    : int
+
+
+def plan_key_ranges(client, query: str, num_ranges: int) -> list[KeyRange]:
+    """Split the keys of a table into `num_ranges` ranges of about the same number of keys.
+    The same keys always give the same ranges. If there are fewer keys than ranges,
+    the last ranges are empty.
+
+    Parameters
+    ----------
+    client : RedshiftClient
+    query : str
+        Query returning the bucket number, the greatest key and the number of keys of every
+        bucket, in key order. See SearchInputQueries.key_ranges
+    num_ranges : int
+
+    Returns
+    -------
+    list[KeyRange]
+    """
+    buckets = client.execute_query(query, label="plan key ranges")
+    if buckets is None:
+        raise RuntimeError(f"Failed to plan key ranges with {query}")
+
+    ranges, lower = [], ''
+    for index in range(num_ranges):
+        upper, keys = (buckets[index][1], buckets[index][2]) if index < len(buckets) else (lower, 0)
+        ranges.append(KeyRange(index=index, lower=lower, upper=upper, keys=keys))
+        lower = upper
+    return ranges
+
+
+class KeysetCursor:
+    """Progress of a worker through its key range: the last key processed, the number of rows
+    read so far and the position reached in the output file. Saved to a JSON file after every
+    page, so that a restarted worker continues after its last key instead of starting over.
+    """
+
+    def __init__(self, path: str = None, scope: str = None) -> None:
+        """
+        Parameters
+        ----------
+        path : str, optional
+            File to save the cursor to, by default None (in memory only)
+        scope : str, optional
+            What the cursor is for, for example a fingerprint of the query, range and input.
+            A saved cursor is only resumed if it has the same scope
+        """
+        self.path = path
+        self.scope = scope
+        self.reset()
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            if state.get('scope') == scope:
+                self.last_key, self.rows, self.position = state['last_key'], state['rows'], state['position']
+
+    def reset(self):
+        self.last_key: str = None
+        self.rows = 0
+        self.position = 0
+
+    def advance(self, last_key: str, rows: int):
+        """Record that the rows up to `last_key` were processed, with the current `position`"""
+        self.last_key = last_key
+        self.rows += rows
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        state = {'scope': self.scope, 'last_key': self.last_key, 'rows': self.rows, 'position': self.position}
+        with open(f"{self.path}.tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def remove(self):
+        """Delete the saved cursor, once the range is done"""
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def iter_pages(
+        client,
+        query: str,
+        key_range: KeyRange,
+        page_size: int = 1000,
+        max_rows: int = None,
+        cursor: KeysetCursor = None,
+        label: str = None
+    ) -> Iterator[list[tuple]]:
+    """Read the rows of a key range page by page with keyset pagination: every page starts after
+    the last key of the previous one, so pages are read from the index in key order without
+    OFFSET, and the rows read don't depend on the page size.
+
+    The cursor is advanced when the next page is requested, that is once the consumer is done
+    with the previous one. Set `cursor.position` before that to record the output written so far.
+
+    Parameters
+    ----------
+    client : RedshiftClient
+    query : str
+        Query with 3 parameters: last key (excluded), upper bound (included) and page size,
+        returning rows whose first column is the key, in key order. See SearchInputQueries
+    key_range : KeyRange
+    page_size : int, optional
+        Number of rows per page, by default 1000
+    max_rows : int, optional
+        Stop after this many rows, by default read the whole range
+    cursor : KeysetCursor, optional
+        Cursor to resume from and advance, by default start from the lower bound of the range
+    label : str, optional
+        Name of the page query in the metrics
+
+    Yields
+    ------
+    list[tuple]
+        Rows of a page
+    """
+    cursor = cursor or KeysetCursor()
+
+    while max_rows is None or cursor.rows < max_rows:
+        limit = page_size if max_rows is None else min(page_size, max_rows - cursor.rows)
+        last_key = cursor.last_key if cursor.last_key is not None else key_range.lower
+        page = client.execute_query(query, params=(last_key, key_range.upper, limit), label=label)
+
+        if page is None:
+            raise RuntimeError(f"Failed to read the page after {last_key!r} of range {key_range.index}")
+        if len(page) == 0:
+            return
+
+        yield page
+        cursor.advance(page[-1][0], len(page))
+
+        if len(page) < limit:
+            return
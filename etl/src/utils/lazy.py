@@ -0,0 +1,30 @@
+import importlib
+from typing import Callable
+
+
+def lazy_exports(package_name: str, exports: dict[str, str]) -> tuple[Callable, Callable]:
+    """Build the module-level __getattr__ and __dir__ of a package (PEP 562), so that 
+    names re-exported by its __init__ are only imported on first access. Importing a 
+    light submodule, like custom_types, then doesn't load the heavy ones.
+
+    Parameters
+    ----------
+    package_name : str
+        __name__ of the package
+    exports : dict[str, str]
+        Mapping of exported name to the module defining it
+
+    Returns
+    -------
+    tuple[Callable, Callable]
+        __getattr__ and __dir__ functions of the package
+    """
+    def __getattr__(name: str):
+        if name not in exports:
+            raise AttributeError(f"module {package_name!r} has no attribute {name!r}")
+        return getattr(importlib.import_module(exports[name]), name)
+
+    def __dir__() -> list[str]:
+        return sorted(exports)
+
+    return __getattr__, __dir__
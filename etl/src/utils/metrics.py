@@ -0,0 +1,245 @@
+import time
+import inspect
+import functools
+from threading import Lock
+from datetime import datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Callable
+from pydantic import BaseModel
+
+from src.utils import helper
+
+
+class QueryMetric(BaseModel):
+    """Class to represent the measurements of one query executed against the database"""
+    label           : str
+    query_id        : Optional[int]
+    started_at      : datetime
+    elapsed_seconds : float
+    rows            : Optional[int]
+    succeeded       : bool
+
+
+class QueryMetricsRegistry:
+    """In-process registry of query measurements, shared by all the tasks of a flow run"""
+
+    def __init__(self) -> None:
+        self._metrics: list[QueryMetric] = []
+        self._lock = Lock()
+
+    def record(self, metric: QueryMetric) -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    @property
+    def metrics(self) -> list[QueryMetric]:
+        with self._lock:
+            return list(self._metrics)
+
+    def summary(self) -> dict[str, dict]:
+        """Aggregate the measurements by label.
+
+        Returns
+        -------
+        dict[str, dict]
+            Mapping of label to number of calls, total and max elapsed seconds and total rows,
+            sorted by total elapsed seconds, slowest first.
+        """
+        summary = {}
+
+        for metric in self.metrics:
+            item = summary.setdefault(metric.label, {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'rows': 0})
+            item['calls'] += 1
+            item['total_seconds'] += metric.elapsed_seconds
+            item['max_seconds'] = max(item['max_seconds'], metric.elapsed_seconds)
+            item['rows'] += metric.rows or 0
+
+        return dict(sorted(summary.items(), key=lambda kv: kv[1]['total_seconds'], reverse=True))
+
+    def write_report(self, output_path: str, logger=None) -> None:
+        """Write all measurements of the run to a new-line delimited JSON file
+
+        Parameters
+        ----------
+        output_path : str
+            Full destination path.
+        """
+        helper.write_json(self.metrics, output_path, new_line_delimited=True, logger=logger)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._metrics = []
+
+
+class StageMetric(BaseModel):
+    """Class to represent the aggregated measurements of one pipeline stage"""
+    stage               : str
+    calls               : int = 0
+    wall_seconds        : float = 0
+    cpu_seconds         : float = 0
+    records             : int = 0
+    records_per_second  : Optional[float]
+    bytes_written       : int = 0
+    bytes_uploaded      : int = 0
+    api_calls           : int = 0
+    store_hits          : int = 0
+
+
+class StageTracker:
+    """Counters of one running stage. Created by StageMetricsRegistry.measure()"""
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.records = 0
+        self.bytes_written = 0
+        self.bytes_uploaded = 0
+        self.api_calls = 0
+        self.store_hits = 0
+
+
+# Stages running in the current thread / task, innermost last. Counters like API calls are
+# added to every active stage, so a task's totals include the loops running inside it.
+_active_stages: ContextVar[tuple[StageTracker, ...]] = ContextVar('active_stages', default=())
+
+
+def add_to_active_stages(
+        records: int = 0, 
+        bytes_written: int = 0, 
+        bytes_uploaded: int = 0, 
+        api_calls: int = 0, 
+        store_hits: int = 0
+    ):
+    """Add counts to all the stages currently measured in this context"""
+    for tracker in _active_stages.get():
+        tracker.records += records
+        tracker.bytes_written += bytes_written
+        tracker.bytes_uploaded += bytes_uploaded
+        tracker.api_calls += api_calls
+        tracker.store_hits += store_hits
+
+
+class StageMetricsRegistry:
+    """In-process registry of per-stage measurements. Runs of the same stage are 
+    aggregated, so measuring a loop that runs once per file keeps one entry.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, StageMetric] = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def measure(self, stage: str):
+        """Measure wall time and CPU time of the enclosed block, and collect the counters 
+        added with add_to_active_stages() while it runs.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage
+
+        Yields
+        ------
+        StageTracker
+            Counters of the stage, can also be incremented directly
+        """
+        tracker = StageTracker(stage)
+        token = _active_stages.set(_active_stages.get() + (tracker,))
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+
+        try:
+            yield tracker
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            _active_stages.reset(token)
+            self._add(tracker, wall, cpu)
+
+    def _add(self, tracker: StageTracker, wall: float, cpu: float):
+        with self._lock:
+            metric = self._metrics.setdefault(tracker.stage, StageMetric(stage=tracker.stage))
+            metric.calls += 1
+            metric.wall_seconds += wall
+            metric.cpu_seconds += cpu
+            metric.records += tracker.records
+            metric.bytes_written += tracker.bytes_written
+            metric.bytes_uploaded += tracker.bytes_uploaded
+            metric.api_calls += tracker.api_calls
+            metric.store_hits += tracker.store_hits
+            metric.records_per_second = metric.records / metric.wall_seconds if metric.wall_seconds > 0 else None
+
+    @property
+    def metrics(self) -> list[StageMetric]:
+        with self._lock:
+            return sorted((metric.copy() for metric in self._metrics.values()), 
+                          key=lambda metric: metric.wall_seconds, reverse=True)
+
+    def write_report(self, output_path: str, logger=None) -> None:
+        """Write the measurements of all stages to a JSON file
+
+        Parameters
+        ----------
+        output_path : str
+            Full destination path.
+        """
+        helper.write_json(self.metrics, output_path, new_line_delimited=False, logger=logger)
+
+    def create_artifact(self, key: str, logger=None) -> bool:
+        """Publish the measurements as a Prefect table artifact. Artifacts need Prefect 2.10+,
+        with older versions, like the 2.7 of requirements.txt, the table is logged instead
+        and the report of write_report() is the only output.
+
+        Parameters
+        ----------
+        key : str
+            Key of the artifact, lower case letters, numbers and dashes
+
+        Returns
+        -------
+        bool
+            True if the artifact was created
+        """
+        table = [metric.dict() for metric in self.metrics]
+
+        try:
+            from prefect.artifacts import create_table_artifact
+        except ImportError:
+            if logger is not None:
+                logger.warning("Prefect artifacts are not available, logging the stage report instead.")
+                for row in table:
+                    logger.info(row)
+            return False
+
+        create_table_artifact(key=key, table=table, description="Time and volume per pipeline stage")
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._metrics = {}
+
+
+stage_metrics = StageMetricsRegistry()
+
+
+def measure_stage(func: Callable) -> Callable:
+    """Decorator measuring every call of a function as a stage of the default registry.
+    The stage is named after the function, plus its `table_name` or `object_name` 
+    argument if it has one. If the function returns a list, its length is counted as records.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+        detail = arguments.get('table_name') or arguments.get('object_name')
+        stage = f"{func.__name__} {detail}" if detail else func.__name__
+
+        with stage_metrics.measure(stage) as tracker:
+            result = func(*args, **kwargs)
+            if isinstance(result, list):
+                tracker.records += len(result)
+
+        return result
+
+    return wrapper
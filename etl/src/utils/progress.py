@@ -0,0 +1,242 @@
+import os
+import time
+import atexit
+import bisect
+from threading import Lock
+from logging import Logger
+from datetime import timedelta
+
+
+class ProgressHook:
+    """Interface of the hooks called by iter_execute() while it runs a loop. Every method
+    receives the name of the stage, so one hook can observe several loops at the same time.
+    Subclasses override the events they need.
+    """
+
+    def on_start(self, stage: str, total: int | None):
+        """Called before the first item. `total` is None if the iterable has no length"""
+        pass
+
+    def on_item(self, stage: str, index: int, latency: float, result_size: int):
+        """Called after each item, with its 1-based index, the seconds it took and the
+        number of results it returned"""
+        pass
+
+    def on_error(self, stage: str, index: int, error: Exception):
+        """Called when an item raises, before the exception is propagated"""
+        pass
+
+    def on_finish(self, stage: str, count: int, elapsed: float):
+        """Called after the last item, with the number of processed items and the total seconds"""
+        pass
+
+
+class RateLogger(ProgressHook):
+    """Log the progress of a loop at percentage checkpoints, with its rate and ETA"""
+
+    def __init__(
+            self,
+            logger: Logger,
+            logging_interval: int = 20,
+            message_template: str = "Processed {} of {} items ({}%)"
+        ) -> None:
+        """
+        Parameters
+        ----------
+        logger : Logger
+        logging_interval : int, optional
+            Percent interval between two messages, by default 20
+        message_template : str, optional
+            Template of the message, formatted with the index, total and percentage
+        """
+        self.logger = logger
+        self.logging_interval = logging_interval
+        self.message_template = message_template
+
+    def on_start(self, stage: str, total: int | None):
+        self.total = total
+        self.start = time.perf_counter()
+        self.checkpoint = 0
+        self._advance(0)
+
+    def _advance(self, index: int):
+        """Move to the first checkpoint after `index`. Checkpoints are the same points as
+        helper.generate_intervals(), but computed one at a time instead of searched in a list."""
+        self.next_index = None
+        if not self.total:
+            return
+
+        while self.checkpoint * self.logging_interval < 100:
+            self.checkpoint += 1
+            point = int(round(min(self.checkpoint * self.logging_interval, 100) / 100 * self.total))
+            if point > index:
+                self.next_index = point
+                return
+
+    def on_item(self, stage: str, index: int, latency: float, result_size: int):
+        if self.next_index is None or index < self.next_index:
+            return
+
+        elapsed = time.perf_counter() - self.start
+        rate = index / elapsed if elapsed > 0 else float('inf')
+        eta = timedelta(seconds=round((self.total - index) / rate)) if 0 < rate < float('inf') else timedelta(0)
+        pct = round(index / self.total * 100, 0)
+
+        self.logger.info(f"{self.message_template.format(index, self.total, pct)} - {rate:.1f} items/s, ETA {eta}")
+        self._advance(index)
+
+
+class LatencyHistogram(ProgressHook):
+    """Cumulative histogram of the per-item latency of every stage, plus item, result and
+    error counters. Thread-safe, so it can be shared by loops running concurrently.
+    """
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: tuple[float, ...] = default_buckets) -> None:
+        """
+        Parameters
+        ----------
+        buckets : tuple[float, ...], optional
+            Upper bounds of the buckets in seconds, by default the Prometheus defaults
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.stages: dict[str, dict] = {}
+        self._lock = Lock()
+
+    def _stage(self, stage: str) -> dict:
+        return self.stages.setdefault(stage, {
+            'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'items': 0, 'results': 0,
+            'errors': 0, 'last_duration': None
+        })
+
+    def on_item(self, stage: str, index: int, latency: float, result_size: int):
+        with self._lock:
+            data = self._stage(stage)
+            data['counts'][bisect.bisect_left(self.buckets, latency)] += 1
+            data['sum'] += latency
+            data['items'] += 1
+            data['results'] += result_size
+
+    def on_error(self, stage: str, index: int, error: Exception):
+        with self._lock:
+            self._stage(stage)['errors'] += 1
+
+    def on_finish(self, stage: str, count: int, elapsed: float):
+        with self._lock:
+            self._stage(stage)['last_duration'] = elapsed
+
+    def quantile(self, stage: str, q: float) -> float:
+        """Upper bound of the bucket containing the q-quantile of the latency of a stage,
+        inf if it is above the last bucket, None if the stage has no items"""
+        with self._lock:
+            data = self.stages.get(stage)
+            if not data or data['items'] == 0:
+                return None
+            rank, cumulative = q * data['items'], 0
+            for bound, count in zip(self.buckets + (float('inf'),), data['counts']):
+                cumulative += count
+                if cumulative >= rank:
+                    return bound
+
+
+class PrometheusTextfileExporter(LatencyHistogram):
+    """Write the latency histogram and counters of every stage to a file in the Prometheus
+    text format, for the node_exporter textfile collector. The file is rewritten as items
+    are processed and loops finish, at most every `min_interval_seconds`, so that long loops 
+    are visible while they run without rewriting the file for every short inner loop (one 
+    per H5 file during extraction). The last counts are written when the process exits.
+    """
+
+    def __init__(
+            self,
+            output_path: str,
+            namespace: str = 'music_etl',
+            buckets: tuple[float, ...] = LatencyHistogram.default_buckets,
+            min_interval_seconds: float = 10
+        ) -> None:
+        """
+        Parameters
+        ----------
+        output_path : str
+            Destination file, should end with .prom to be picked up by node_exporter
+        namespace : str, optional
+            Prefix of the metric names, by default 'music_etl'
+        buckets : tuple[float, ...], optional
+            Upper bounds of the latency buckets in seconds
+        min_interval_seconds : float, optional
+            Minimum time between two writes, by default 10
+        """
+        super().__init__(buckets)
+        self.output_path = output_path
+        self.namespace = namespace
+        self.min_interval_seconds = min_interval_seconds
+        self._last_write = None
+        self._write_lock = Lock()
+        atexit.register(self.write)
+
+    def on_item(self, stage: str, index: int, latency: float, result_size: int):
+        super().on_item(stage, index, latency, result_size)
+        self._write_if_due()
+
+    def on_finish(self, stage: str, count: int, elapsed: float):
+        super().on_finish(stage, count, elapsed)
+        self._write_if_due()
+
+    def _write_if_due(self):
+        """Write unless the file was written less than `min_interval_seconds` ago"""
+        if self._last_write is None or time.monotonic() - self._last_write >= self.min_interval_seconds:
+            self.write()
+
+    def render(self) -> str:
+        """Render all the metrics in the Prometheus text format"""
+        name = self.namespace
+        lines = []
+
+        with self._lock:
+            stages = {stage: {**data, 'counts': list(data['counts'])} for stage, data in self.stages.items()}
+
+        for metric, metric_type, help_text, key in [
+            ('items_total', 'counter', 'Items processed by the loop', 'items'),
+            ('results_total', 'counter', 'Results returned by the items of the loop', 'results'),
+            ('errors_total', 'counter', 'Items that raised an error', 'errors'),
+            ('last_duration_seconds', 'gauge', 'Duration of the last run of the loop', 'last_duration'),
+        ]:
+            lines += [f"# HELP {name}_{metric} {help_text}", f"# TYPE {name}_{metric} {metric_type}"]
+            lines += [f'{name}_{metric}{{stage="{stage}"}} {data[key]}'
+                      for stage, data in stages.items() if data[key] is not None]
+
+        lines += [f"# HELP {name}_item_latency_seconds Latency of one item of the loop",
+                  f"# TYPE {name}_item_latency_seconds histogram"]
+
+        for stage, data in stages.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), data['counts']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'{name}_item_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_item_latency_seconds_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'{name}_item_latency_seconds_count{{stage="{stage}"}} {data["items"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Write the metrics atomically, so the collector never reads a partial file. 
+        Loops running in other threads wait for the write in progress"""
+        with self._write_lock:
+            os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+            temp_path = f"{self.output_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(temp_path, self.output_path)
+            self._last_write = time.monotonic()
+
+
+# Hooks called by every iter_execute() loop, in addition to the ones passed to it
+global_hooks: list[ProgressHook] = []
+
+
+def add_global_hook(hook: ProgressHook):
+    """Observe every iter_execute() loop of the process with this hook"""
+    if hook not in global_hooks:
+        global_hooks.append(hook)
@@ -0,0 +1,14 @@
+"""Unit tests for the cache module"""
+
+from src.utils.cache import fingerprint
+
+
+class TestFingerprint():
+
+    def test_stable(self):
+        """Assert that the same inputs give the same fingerprint, regardless of dict ordering"""
+        assert fingerprint("query", {'a': 1, 'b': [1, 2]}) == fingerprint("query", {'b': [1, 2], 'a': 1})
+
+    def test_changes_with_input(self):
+        """Assert that a change in any input changes the fingerprint"""
+        assert fingerprint("query", {'etag': '"abc"'}) != fingerprint("query", {'etag': '"abd"'})
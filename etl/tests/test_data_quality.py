@@ -0,0 +1,114 @@
+"""Unit tests for data_quality module"""
+
+import pytest
+
+from src import etl_queries as queries
+from src.local import LocalRedshiftClient
+from src.data_quality import tests as dq
+from src.data_quality.data_quality import DataQualityOperator
+from src.data_quality.tests import (
+    batched_query, has_data_test, catalog_has_data_test, unique_test, not_null_test, is_batchable, scoped, scanning
+)
+
+
+class TestBatchedQuery():
+
+    def test_batched_query(self):
+        """Assert that all checks on one table are compiled into a single select, in order"""
+        tests = [
+            has_data_test('msd_songs_has_data', 'msd.songs'),
+            unique_test('msd_songs_id_unique', 'msd.songs', 'id'),
+        ]
+        query = batched_query('msd.songs', tests)
+
+        assert query.count('from msd.songs') == 1
+        assert query.index('count(*) = 0') < query.index('count(distinct id)')
+
+    def test_catalog_test_is_not_batchable(self):
+        """Assert that catalog checks are not compiled into table scans"""
+        test = catalog_has_data_test('msd_songs_has_data', 'msd.songs')
+        assert not is_batchable(test)
+        assert 'stv_tbl_perm' in test.query
+
+    def test_scoped(self):
+        """Assert that scoped() restricts scan checks to the given rows, and leaves catalog checks alone"""
+        tests = scoped([
+            unique_test('msd_songs_id_unique', 'msd.songs', 'id'),
+            catalog_has_data_test('msd_songs_has_data', 'msd.songs'),
+        ], "year = 2010")
+
+        assert 'where year = 2010' in tests[0].query
+        assert 'where year = 2010' in batched_query('msd.songs', tests[:1])
+        assert tests[1].scope is None
+
+    def test_scanning(self):
+        """Assert that scanning() turns the catalog checks of the given tables into scan checks"""
+        tests = scanning([
+            catalog_has_data_test('analytics_songs_has_data', 'analytics.songs'),
+            catalog_has_data_test('msd_songs_has_data', 'msd.songs'),
+        ], ['analytics.songs'])
+
+        assert [test.check for test in tests] == ['has_data', 'catalog_has_data']
+        assert is_batchable(tests[0])
+
+    def test_custom_query_is_not_batchable(self):
+        """Assert that tests without a check type fall back to running on their own"""
+        test = dq.Test(name='custom', query='select 1 where false', expected_result=0)
+        assert not is_batchable(test)
+
+
+@pytest.fixture
+def redshift(tmp_path):
+    """Local database with a valid staging.msd_artists, and a staging.spotify_artists with a duplicate ID"""
+    client = LocalRedshiftClient(str(tmp_path))
+    client.execute_query(queries.StagingMsdQueries.create_table_artists)
+    client.execute_query(queries.StagingSpotifyQueries.create_table_artists)
+    client.insert_records('staging.msd_artists', [{'id': f"AR{i}", 'name': f"Artist {i}"} for i in range(3)])
+    client.insert_records('staging.spotify_artists', [{'id': id, 'name': f"Spotify {id}"} for id in ['sp0', 'sp1', 'sp1']])
+    yield client
+    client.close()
+
+
+class TestDataQualityOperator():
+
+    tests = [
+        has_data_test('msd_artists_has_data', 'staging.msd_artists'),
+        unique_test('spotify_artists_id_unique', 'staging.spotify_artists', 'id'),
+        unique_test('msd_artists_id_unique', 'staging.msd_artists', 'id'),
+        not_null_test('spotify_artists_id_not_null', 'staging.spotify_artists', 'id'),
+        catalog_has_data_test('spotify_artists_has_data', 'staging.spotify_artists'),
+    ]
+
+    def test_run_batched_tests(self, redshift, monkeypatch):
+        """Assert that the tests of each table run as one query on their own connection, 
+        and that only the tests of the failing table are reported"""
+        groups = []
+        run_table_tests = DataQualityOperator.run_table_tests
+
+        def spy(operator, client, table, tests):
+            results = run_table_tests(operator, client, table, tests)
+            groups.append((client, table, results))
+            return results
+
+        monkeypatch.setattr(DataQualityOperator, 'run_table_tests', spy)
+
+        with pytest.raises(ValueError, match="1 failed data test\\(s\\): spotify_artists_id_unique$"):
+            DataQualityOperator(redshift).run_batched_tests(self.tests)
+
+        assert sorted((table, results) for _, table, results in groups) == [
+            ('staging.msd_artists', {'msd_artists_has_data': True, 'msd_artists_id_unique': True}),
+            ('staging.spotify_artists', {'spotify_artists_id_unique': False, 'spotify_artists_id_not_null': True}),
+        ]
+
+        clients = [client for client, _, _ in groups]
+        assert clients[0] is not clients[1]
+        assert all(client is not redshift and client._connections == [] for client in clients)
+
+    def test_catalog_fallback(self, redshift):
+        """Assert that a catalog check without catalog rows for its table scans the table instead"""
+        operator = DataQualityOperator(redshift)
+        hidden = dict(query="select null as cnt", expected_result=0, check='catalog_has_data')
+
+        assert operator.run_test(dq.Test(name='msd_artists_has_data', table='staging.msd_artists', **hidden))
+        redshift.execute_query("DELETE FROM staging.msd_artists")
+        assert not operator.run_test(dq.Test(name='msd_artists_has_data', table='staging.msd_artists', **hidden))
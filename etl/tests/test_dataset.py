@@ -0,0 +1,124 @@
+"""Unit tests for the dataset module"""
+
+import os
+import pytest
+import numpy as np
+
+from src.utils.dataset import DatasetWriter, RotatingDatasetWriter, read_dataset, verify_dataset, write_columns, chunked
+from src.utils.helper import write_json
+from src.mapping.custom_types import MappedSong
+
+
+class TestDataset():
+
+    def test_round_trip(self, tmp_path):
+        """Assert that records written chunk by chunk are streamed back, and counted in the handle"""
+        records = [MappedSong(msd_song_id=f"SO{i}", spotify_song_ids=[f"id{i}"]) for i in range(5)]
+
+        with DatasetWriter(str(tmp_path / "mapped/part-0000.json"), "mapped/part-0000.json") as writer:
+            for chunk in chunked(records, 2):
+                writer.write(chunk)
+
+        dataset = writer.dataset
+        assert dataset.rows == 5
+        assert dataset.remote_path == "mapped/part-0000.json"
+        assert list(read_dataset(dataset, MappedSong)) == records
+
+    def test_checksum(self, tmp_path):
+        """Assert that the checksum only depends on the content of the file"""
+        datasets = []
+        for name in ['a.json', 'b.json']:
+            with DatasetWriter(str(tmp_path / name)) as writer:
+                writer.write([{'id': 1}, {'id': 2}])
+            datasets.append(writer.dataset)
+
+        with DatasetWriter(str(tmp_path / "c.json")) as writer:
+            writer.write([{'id': 1}])
+
+        assert datasets[0].checksum == datasets[1].checksum != writer.dataset.checksum
+
+    def test_verify(self, tmp_path):
+        """Assert that a handle whose file was changed or deleted is not read"""
+        with DatasetWriter(str(tmp_path / "part.json")) as writer:
+            writer.write([{'id': 1}])
+        assert verify_dataset(writer.dataset)
+
+        (tmp_path / "part.json").write_text('{"id": 2}\n')
+        assert not verify_dataset(writer.dataset)
+        with pytest.raises(ValueError):
+            list(read_dataset(writer.dataset))
+
+        os.remove(tmp_path / "part.json")
+        assert not verify_dataset(writer.dataset)
+
+    def test_empty(self, tmp_path):
+        """Assert that an empty file is written for a partition without records"""
+        with DatasetWriter(str(tmp_path / "empty.json")) as writer:
+            pass
+
+        assert writer.dataset.rows == 0
+        assert (tmp_path / "empty.json").read_text() == ""
+        assert list(read_dataset(writer.dataset)) == []
+
+    def test_columns(self, tmp_path):
+        """Assert that a structured array is written as CSV columns, with NaN as an empty field"""
+        array = np.array([(b'a', 1.5, 3), (b'b', np.nan, -1)], dtype=[('id', 'S4'), ('tempo', 'f4'), ('key', 'i1')])
+        dataset = write_columns(array, str(tmp_path / "features.csv"))
+
+        assert (dataset.format, dataset.rows) == ('csv', 2)
+        assert (tmp_path / "features.csv").read_text() == "id,tempo,key\na,1.5,3\nb,,-1\n"
+        assert list(read_dataset(dataset)) == [{'id': 'a', 'tempo': '1.5', 'key': '3'}, {'id': 'b', 'tempo': None, 'key': '-1'}]
+
+    def test_masked_columns(self, tmp_path):
+        """Assert that masked values are written as empty fields, so a missing integer is not loaded as a value"""
+        array = np.ma.masked_all(2, dtype=[('id', 'S4'), ('mode', 'i1')])
+        array['id'] = [b'a', b'b']
+        array['mode'][0] = -1
+        write_columns(array, str(tmp_path / "features.csv"))
+
+        assert (tmp_path / "features.csv").read_text() == "id,mode\na,-1\nb,\n"
+
+
+class TestRotatingDatasetWriter():
+
+    records = [{'id': f"SO{i}"} for i in range(5)]
+
+    def test_rotation(self, tmp_path):
+        """Assert that parts are sealed at the record limit with stable names, and passed to the callback when sealed"""
+        sealed = []
+        with RotatingDatasetWriter(str(tmp_path / "songs.json"), "msd/songs.json", max_records=2, on_part=sealed.append) as writer:
+            writer.write(self.records[:3])
+            assert [part.rows for part in sealed] == [2]
+            writer.write(self.records[3:])
+
+        assert sealed == writer.parts
+        assert [part.rows for part in writer.parts] == [2, 2, 1]
+        assert [part.remote_path for part in writer.parts] == [f"msd/songs.part-0000{i}.json" for i in range(3)]
+        assert [record for part in writer.parts for record in read_dataset(part)] == self.records
+
+    def test_size_limit(self, tmp_path):
+        """Assert that a part is sealed once it reaches the byte limit"""
+        with RotatingDatasetWriter(str(tmp_path / "songs.json"), max_bytes=30) as writer:
+            writer.write(self.records)
+
+        assert [part.rows for part in writer.parts] == [2, 2, 1]
+        assert all(os.path.getsize(part.path) <= 30 for part in writer.parts)
+
+    def test_stale_parts(self, tmp_path):
+        """Assert that parts of a previous, longer run are deleted, and an empty output still has a first part"""
+        with RotatingDatasetWriter(str(tmp_path / "songs.json"), max_records=1) as writer:
+            writer.write(self.records)
+        with RotatingDatasetWriter(str(tmp_path / "songs.json"), max_records=1) as writer:
+            pass
+
+        assert [part.rows for part in writer.parts] == [0]
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["songs.part-00000.json"]
+
+    def test_write_json_without_records(self, tmp_path):
+        """Assert that writing no records to parts replaces the parts of a previous run"""
+        songs = [MappedSong(msd_song_id=f"SO{i}", spotify_song_ids=[]) for i in range(3)]
+        write_json(songs, str(tmp_path / "songs.json"), new_line_delimited=True, max_records=1)
+        parts = write_json([], str(tmp_path / "songs.json"), new_line_delimited=True, max_records=1)
+
+        assert [part.rows for part in parts] == [0]
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["songs.part-00000.json"]
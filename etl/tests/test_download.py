@@ -0,0 +1,136 @@
+"""Unit tests for the ranged downloader, against a local HTTP server"""
+
+import os
+import re
+import logging
+from hashlib import sha256
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pytest import fixture, raises
+
+from src.utils.download import RangedDownloader
+
+
+content = os.urandom(1_000_000)
+logger = logging.getLogger("test_download")
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve `content`, with range requests if the server accepts them. The first `drops`
+    responses are cut after half of their bytes, like a dropped connection. The next `shorts`
+    responses only send half of their bytes, with a matching Content-Length, so that the
+    HTTP client sees a complete response."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get('Range', ''))
+        first, last = (int(match[1]), int(match[2])) if match and self.server.accept_ranges else (0, len(content) - 1)
+        body = content[first:last + 1]
+        self.server.requests.append((first, last))
+
+        if self.server.drops == 0 and self.server.shorts > 0:
+            self.server.shorts -= 1
+            body = body[:len(body) // 2]
+
+        self.send_response(206 if match and self.server.accept_ranges else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.server.drops > 0:
+            self.server.drops -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.accept_ranges, server.drops, server.shorts, server.requests = True, 0, 0, []
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@fixture
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/millionsongsubset.tar.gz"
+
+
+@fixture
+def downloader():
+    return RangedDownloader(num_workers=4, chunk_size=2**18, retry_delay_seconds=0, timeout=5, logger=logger)
+
+
+class TestRangedDownloader():
+
+    def test_parallel_ranges(self, tmp_path, server, url, downloader):
+        """Assert that the file is downloaded in chunks, joined and verified"""
+        output_path = str(tmp_path / "subset.tar.gz")
+        result = downloader.download(url, output_path, sha256(content).hexdigest())
+
+        assert open(output_path, 'rb').read() == content
+        assert (result.bytes, result.resumed_bytes) == (len(content), 0)
+        assert len(server.requests) == 4
+        assert not os.path.exists(f"{output_path}.parts")
+
+    def test_dropped_connections(self, tmp_path, server, url, downloader):
+        """Assert that interrupted chunks are continued from the bytes already received"""
+        server.drops = 3
+        output_path = str(tmp_path / "subset.tar.gz")
+        downloader.download(url, output_path)
+
+        assert open(output_path, 'rb').read() == content
+        assert len(server.requests) == 4 + 3
+        assert sum(last - first + 1 for first, last in server.requests) < len(content) + 3 * 2**18
+
+    def test_short_responses(self, tmp_path, server, url, downloader):
+        """Assert that a chunk is continued until it has all its bytes, even if the response looked complete"""
+        server.shorts = 2
+        output_path = str(tmp_path / "subset.tar.gz")
+        downloader.download(url, output_path)
+
+        assert open(output_path, 'rb').read() == content
+        assert len(server.requests) == 4 + 2
+
+    def test_resume(self, tmp_path, server, url, downloader):
+        """Assert that the chunks of a previous attempt are continued, not downloaded again"""
+        output_path = str(tmp_path / "subset.tar.gz")
+        server.drops, downloader.retries = 4, 0
+        with raises(Exception):
+            downloader.download(url, output_path)
+
+        server.requests = []
+        result = downloader.download(url, output_path)
+
+        assert open(output_path, 'rb').read() == content
+        assert result.resumed_bytes > 0
+        assert sum(last - first + 1 for first, last in server.requests) == len(content) - result.resumed_bytes
+
+    def test_checksum_mismatch(self, tmp_path, url, downloader):
+        """Assert that a file with the wrong checksum is not kept, nor its chunks"""
+        output_path = str(tmp_path / "subset.tar.gz")
+        with raises(ValueError):
+            downloader.download(url, output_path, sha256(b"other").hexdigest())
+
+        assert os.listdir(tmp_path) == []
+
+    def test_no_ranges(self, tmp_path, server, url, downloader):
+        """Assert that servers without range requests are downloaded in one request"""
+        server.accept_ranges = False
+        output_path = str(tmp_path / "subset.tar.gz")
+        downloader.download(url, output_path)
+
+        assert open(output_path, 'rb').read() == content
+        assert server.requests == [(0, len(content) - 1)]
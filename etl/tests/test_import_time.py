@@ -0,0 +1,51 @@
+"""Regression tests for the import time of the packages and the flow entry points"""
+
+import os
+import sys
+import json
+import subprocess
+from pathlib import Path
+import pytest
+
+
+etl_dir = Path(__file__).parents[1]
+
+light_modules = [
+    'src', 'src.etl_queries', 'src.msd', 'src.msd.custom_types', 'src.spotify', 'src.spotify.custom_types',
+    'src.mapping.custom_types', 'src.data_quality', 'src.aws.redshift', 'src.aws.s3', 'src.local', 'src.tuning', 'src.utils.metrics'
+]
+heavy_modules = ['tables', 'boto3', 'redshift_connector', 'requests', 'prefect']
+
+flow_modules = ['flows.common_tasks', 'flows.music_etl', 'flows.extract_msd_data']
+
+
+def measure_import(modules: list[str]) -> dict:
+    """Import modules in a fresh interpreter, return the elapsed seconds and the heavy modules loaded"""
+    script = f"""
+import sys, time, json, importlib
+start = time.perf_counter()
+for module in {modules!r}:
+    importlib.import_module(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy_modules!r} if m in sys.modules]}}))
+"""
+    env = {**os.environ, 'PYTHONPATH': str(etl_dir)}
+    output = subprocess.run([sys.executable, '-c', script], cwd=etl_dir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestImportTime():
+
+    def test_src_is_lazy(self):
+        """Assert that importing the src packages doesn't load the heavy dependencies"""
+        assert measure_import(light_modules)['loaded'] == []
+
+    def test_src_import_time(self):
+        """Assert that importing the src packages stays under 1 second"""
+        assert measure_import(light_modules)['seconds'] < 1.0
+
+    def test_flows_import_time(self):
+        """Assert that importing the flow entry points stays under 5 seconds, without reading config.cfg"""
+        pytest.importorskip('prefect')
+        assert measure_import(flow_modules)['seconds'] < 5.0
@@ -0,0 +1,105 @@
+"""Unit tests for the keyset pagination of the search input"""
+
+import pytest
+
+from src import etl_queries as queries
+from src.local import LocalRedshiftClient
+from src.utils.keyset import KeyRange, KeysetCursor, plan_key_ranges, iter_pages
+from src.utils.dataset import DatasetWriter, read_dataset
+
+
+search = queries.SearchInputQueries()
+
+
+@pytest.fixture
+def redshift(tmp_path):
+    redshift = LocalRedshiftClient(str(tmp_path))
+    redshift.execute_query(queries.StagingMsdQueries.create_table_artists)
+    # Artists appear once per song, sometimes under another name
+    records = [{'id': f"AR{i:03d}", 'name': f"Artist {i}"} for i in range(50) for _ in range(2)]
+    records.append({'id': 'AR007', 'name': 'Another name'})
+    redshift.insert_records('staging.msd_artists', records)
+    yield redshift
+    redshift.close()
+
+
+def plan(redshift, num_ranges: int) -> list[KeyRange]:
+    return plan_key_ranges(redshift, search.key_ranges.format(table='staging.msd_artists', num_ranges=num_ranges), num_ranges)
+
+
+def read_all(redshift, key_range: KeyRange, **kwargs) -> list[str]:
+    return [row[0] for page in iter_pages(redshift, search.artists, key_range, **kwargs) for row in page]
+
+
+class TestPlanKeyRanges():
+
+    def test_ranges_cover_all_ids_once(self, redshift):
+        """Assert that the ranges are contiguous, about the same size, and read every ID exactly once"""
+        key_ranges = plan(redshift, 4)
+
+        assert [key_range.keys for key_range in key_ranges] == [13, 13, 12, 12]
+        assert all(previous.upper == following.lower for previous, following in zip(key_ranges, key_ranges[1:]))
+        assert [id for key_range in key_ranges for id in read_all(redshift, key_range)] == [f"AR{i:03d}" for i in range(50)]
+        assert plan(redshift, 4) == key_ranges
+
+    def test_more_ranges_than_ids(self, redshift):
+        """Assert that ranges beyond the number of IDs are empty"""
+        key_ranges = plan(redshift, 60)
+
+        assert len(key_ranges) == 60
+        assert read_all(redshift, key_ranges[-1]) == []
+
+
+class TestIterPages():
+
+    def test_pages(self, redshift):
+        """Assert that the rows read don't depend on the page size, and max_rows stops early"""
+        key_range = plan(redshift, 1)[0]
+
+        assert read_all(redshift, key_range, page_size=7) == read_all(redshift, key_range, page_size=100)
+        assert [len(page) for page in iter_pages(redshift, search.artists, key_range, page_size=4, max_rows=10)] == [4, 4, 2]
+
+    def test_duplicate_song_ids(self, redshift):
+        """Assert that songs appearing more than once are read once, whatever the page boundaries"""
+        redshift.execute_query(queries.StagingMsdQueries.create_table_songs)
+        redshift.insert_records('staging.msd_songs', [
+            {'id': f"SO{i:03d}", 'name': f"Song {i}", 'artist_id': 'AR001'} for i in range(10) for _ in range(3)
+        ])
+        key_range = KeyRange(index=0, lower='', upper='SO009', keys=10)
+
+        for page_size in [2, 3, 7]:
+            ids = [row[0] for page in iter_pages(redshift, search.songs, key_range, page_size=page_size) for row in page]
+            assert ids == [f"SO{i:03d}" for i in range(10)]
+
+    def test_resume(self, redshift, tmp_path):
+        """Assert that a restarted reader continues after the last key of its saved cursor"""
+        key_range = plan(redshift, 1)[0]
+        path = str(tmp_path / 'part.json.cursor')
+        pages = iter_pages(redshift, search.artists, key_range, page_size=10, cursor=KeysetCursor(path, 'scope'))
+        first = [next(pages), next(pages)]
+        pages.close()
+
+        resumed = read_all(redshift, key_range, page_size=10, cursor=KeysetCursor(path, 'scope'))
+
+        assert [row[0] for row in first[0]] + resumed == [f"AR{i:03d}" for i in range(50)]
+        assert KeysetCursor(path, 'other scope').last_key is None
+
+
+class TestResumedWriter():
+
+    def test_resume_position(self, tmp_path):
+        """Assert that records after the resume position are discarded, and the handle covers the whole file"""
+        path = str(tmp_path / 'part.json')
+        with DatasetWriter(path) as writer:
+            writer.write([{'id': 1}, {'id': 2}])
+            position = writer.flush()
+            writer.write([{'id': 'lost'}])
+
+        with DatasetWriter(path, resume_position=position) as writer:
+            writer.write([{'id': 3}])
+
+        with DatasetWriter(str(tmp_path / 'expected.json')) as expected:
+            expected.write([{'id': 1}, {'id': 2}, {'id': 3}])
+
+        assert [record['id'] for record in read_dataset(writer.dataset)] == [1, 2, 3]
+        assert (writer.dataset.rows, writer.dataset.checksum) == (3, expected.dataset.checksum)
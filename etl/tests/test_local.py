@@ -0,0 +1,213 @@
+"""Unit tests for the local backend"""
+
+import json
+import pytest
+
+from src import etl_queries as queries
+from src.local import LocalS3Client, LocalRedshiftClient, SyntheticSpotifyClient
+from src.local.sql import translate, fnv_hash
+from src.spotify import SongFetcher
+from src.msd.custom_types import MsdSong
+from src.data_quality.tests import catalog_has_data_query, unique_test, scoped
+from src.data_quality.data_quality import DataQualityOperator
+
+
+@pytest.fixture
+def local_clients(tmp_path):
+    s3 = LocalS3Client(str(tmp_path))
+    redshift = LocalRedshiftClient(str(tmp_path))
+    yield s3, redshift
+    redshift.close()
+
+
+class TestTranslate():
+
+    def test_table_options(self):
+        """Assert that Redshift-only column types and table options are removed"""
+        query = translate(queries.StagingMsdQueries.create_table_artists)
+        assert 'DISTKEY' not in query and 'DISTSTYLE' not in query
+        assert 'SUPER' not in query and 'VARCHAR(MAX)' not in query
+
+    def test_unnest(self):
+        """Assert that navigating a SUPER array in the FROM clause becomes json_each()"""
+        query = translate(queries.AnalyticsQueries.create_table_analytics_artists)
+        assert "json_each(mapped_artists.spotify_artist_ids) AS spotify_artist_id" in query
+        assert "CAST(spotify_artist_id.value AS VARCHAR)" in query
+
+    def test_catalog_count(self):
+        """Assert that the STV_TBL_PERM row count becomes a count on the table"""
+        assert translate(catalog_has_data_query('msd.songs')) == "select count(*) as cnt from msd.songs having cnt = 0 or cnt is null"
+
+    def test_fnv_hash(self):
+        """Assert that the hash is the signed 64-bit FNV-1a of the value, like Redshift's"""
+        assert fnv_hash('') == -3750763034362895579
+        assert fnv_hash(None) is None
+
+
+class TestLocalRedshiftClient():
+
+    def test_copy_and_unnest(self, local_clients, tmp_path):
+        """Assert that COPY loads the stored JSON files, and SUPER arrays can be unnested"""
+        s3, redshift = local_clients
+        records = [{'msd_song_id': 'SO1', 'spotify_song_ids': ['a', 'b']}, {'msd_song_id': 'SO2', 'spotify_song_ids': []}]
+        (tmp_path / 'part.json').write_text('\n'.join(json.dumps(record) for record in records))
+        s3.upload_file(str(tmp_path / 'part.json'), 'bucket', 'mapped/songs/part-0000.json')
+
+        redshift.execute_query(queries.StagingMappedQueries.create_table_songs)
+        redshift.execute_query(queries.LoadingQueries.copy_s3_to_redshift.format(
+            table='staging.mapped_songs', source_path='s3://bucket/mapped/songs/', iam_role='', region_name=''))
+
+        result = redshift.execute_query("""
+            SELECT msd_song_id, CAST(song_id AS VARCHAR)
+            FROM staging.mapped_songs as mapped_songs
+            , mapped_songs.spotify_song_ids AS song_id
+        """)
+        assert sorted(result) == [('SO1', 'a'), ('SO1', 'b')]
+
+    def test_fingerprint_dropped_with_table(self, local_clients):
+        """Assert that the fingerprint of a table disappears when the table is dropped"""
+        _, redshift = local_clients
+        redshift.execute_query(queries.StagingMsdQueries.create_table_songs)
+        redshift.set_table_fingerprint('staging.msd_songs', 'abc')
+        assert redshift.get_table_fingerprint('staging.msd_songs') == 'abc'
+
+        redshift.execute_query(queries.LoadingQueries.drop_table.format(table='staging.msd_songs'))
+        assert redshift.get_table_fingerprint('staging.msd_songs') is None
+
+    def test_raise_on_error(self, local_clients):
+        """Assert that a failed query returns None, or raises if asked to"""
+        _, redshift = local_clients
+        assert redshift.execute_query("select * from missing_table", return_result=True) is None
+        with pytest.raises(Exception):
+            redshift.execute_query("select * from missing_table", raise_on_error=True)
+        assert redshift.execute_query("select 1", return_result=True) == [(1,)]
+
+    def test_failed_insert_raises(self, local_clients):
+        """Assert that a failed batch of insert_records raises instead of being counted"""
+        _, redshift = local_clients
+        redshift.execute_query(queries.StagingMsdQueries.create_table_artists)
+        with pytest.raises(Exception):
+            redshift.insert_records('staging.msd_artists', [{'id': 'AR1', 'missing_column': 'x'}])
+        assert redshift.insert_records('staging.msd_artists', [{'id': 'AR1', 'name': 'Artist'}]) == 1
+
+    def test_unload(self, local_clients, tmp_path):
+        """Assert that UNLOAD writes one file per partition and a manifest listing them, with
+        the quotes of the query kept, and that a failed UNLOAD raises"""
+        _, redshift = local_clients
+        redshift.execute_query(queries.StagingMsdQueries.create_table_artists)
+        redshift.insert_records('staging.msd_artists', [
+            {'id': 'AR1', 'name': "Sinead O'Connor", 'location': 'Dublin'},
+            {'id': 'AR2', 'name': 'The Pogues', 'location': 'Dublin'},
+            {'id': 'AR3', 'name': 'Enya', 'location': None},
+            {'id': 'AR4', 'name': 'Excluded', 'location': 'Cork'},
+        ])
+
+        redshift.unload_to_s3(
+            "SELECT id, name, location FROM staging.msd_artists WHERE name <> 'Excluded'",
+            's3://bucket/analytics/artists/', iam_role='', region_name='', partition_by=['location']
+        )
+
+        output_dir = tmp_path / 's3/bucket/analytics/artists'
+        manifest = json.loads((output_dir / 'manifest').read_text())
+        assert sorted((entry['url'], entry['meta']['record_count']) for entry in manifest['entries']) == [
+            ('s3://bucket/analytics/artists/location=Dublin/0000_part_00.json', 2),
+            ('s3://bucket/analytics/artists/location=__HIVE_DEFAULT_PARTITION__/0000_part_00.json', 1),
+        ]
+        names = [json.loads(line)['name'] for line in (output_dir / 'location=Dublin/0000_part_00.json').read_text().splitlines()]
+        assert sorted(names) == ["Sinead O'Connor", 'The Pogues']
+
+        with pytest.raises(Exception):
+            redshift.unload_to_s3("SELECT * FROM staging.missing_table", 's3://bucket/missing/', iam_role='', region_name='')
+
+
+class TestSyntheticSpotifyClient():
+
+    def test_search_then_fetch(self):
+        """Assert that searches are deterministic and their results can be fetched"""
+        fetcher = SongFetcher(SyntheticSpotifyClient(seed=1))
+        songs = [MsdSong(id=f"SO{i}", name=f"Song {i}", artist_id="AR1", artist_name="Artist") for i in range(20)]
+
+        mapped = fetcher.search_many(songs)
+        assert [item.dict() for item in mapped] == [item.dict() for item in fetcher.search_many(songs)]
+
+        fetched = fetcher.fetch_many(mapped)
+        assert sorted(song.id for song in fetched) == sorted(id for item in mapped for id in item.spotify_song_ids)
+
+
+@pytest.fixture
+def mapped_artists(local_clients):
+    """Staging, msd, spotify and mapped artists tables, with a function replacing the mapped pairs"""
+    _, redshift = local_clients
+    redshift.execute_query(queries.StagingMsdQueries.create_table_artists)
+    redshift.execute_query(queries.StagingSpotifyQueries.create_table_artists)
+    redshift.insert_records('staging.msd_artists', [{'id': f"AR{i}", 'name': f"Artist {i}"} for i in range(3)])
+    redshift.insert_records('staging.spotify_artists', [{'id': f"sp{i}", 'name': f"Spotify {i}"} for i in range(5)])
+    redshift.execute_query(queries.AnalyticsQueries.create_table_msd_artists)
+    redshift.execute_query(queries.AnalyticsQueries.create_table_spotify_artists)
+
+    def replace(pairs: dict[str, list[str]]):
+        redshift.execute_query(queries.AnalyticsQueries.drop_table_mapped_artists)
+        redshift.execute_query(queries.StagingMappedQueries.drop_table_artists)
+        redshift.execute_query(queries.StagingMappedQueries.create_table_artists)
+        redshift.insert_records('staging.mapped_artists', [
+            {'msd_artist_id': msd_id, 'spotify_artist_ids': spotify_ids} for msd_id, spotify_ids in pairs.items()
+        ])
+        redshift.execute_query(queries.AnalyticsQueries.create_table_mapped_artists)
+
+    return redshift, replace
+
+
+class TestAnalyticsMaintenance():
+
+    select_pairs = "SELECT msd_artist_id, spotify_artist_id, msd_artist_name FROM analytics.artists"
+
+    def test_delta_matches_full_build(self, mapped_artists):
+        """Assert that applying the delta of the mapped pairs gives the same rows as a full build"""
+        redshift, replace = mapped_artists
+        replace({'AR0': ['sp0', 'sp1'], 'AR1': ['sp2']})
+        redshift.execute_query(queries.AnalyticsQueries.create_table_analytics_artists)
+
+        replace({'AR0': ['sp0'], 'AR1': ['sp2'], 'AR2': ['sp3', 'sp4']})
+        redshift.execute_query(queries.AnalyticsQueries.delete_removed_analytics_artists)
+        redshift.execute_query(queries.AnalyticsQueries.insert_new_analytics_artists)
+        delta = sorted(redshift.execute_query(self.select_pairs))
+
+        redshift.execute_query(queries.AnalyticsQueries.drop_table_analytics_artists)
+        redshift.execute_query(queries.AnalyticsQueries.create_table_analytics_artists)
+        assert delta == sorted(redshift.execute_query(self.select_pairs))
+        assert [pair[:2] for pair in delta] == [('AR0', 'sp0'), ('AR1', 'sp2'), ('AR2', 'sp3'), ('AR2', 'sp4')]
+
+    def test_refresh_view(self, mapped_artists):
+        """Assert that refreshing a materialized view recomputes it from its query"""
+        redshift, replace = mapped_artists
+        replace({'AR0': ['sp0']})
+        redshift.execute_query(queries.AnalyticsQueries.create_view_analytics_artists)
+
+        replace({'AR0': ['sp0'], 'AR1': ['sp1']})
+        redshift.execute_query(queries.AnalyticsQueries.refresh_view.format(view='analytics.artists'))
+        assert sorted(pair[:2] for pair in redshift.execute_query(self.select_pairs)) == [('AR0', 'sp0'), ('AR1', 'sp1')]
+
+    def test_delta_scope(self, mapped_artists):
+        """Assert that the keys of the inserted pairs are recorded, and that data tests scoped to 
+        them check the rows sharing a key with the delta, including the rows already there"""
+        redshift, replace = mapped_artists
+        replace({'AR0': ['sp0'], 'AR1': ['sp1']})
+        redshift.execute_query(queries.AnalyticsQueries.create_table_analytics_artists)
+
+        # sp0 is now also mapped to AR2, which makes spotify_artist_id not unique
+        replace({'AR0': ['sp0'], 'AR1': ['sp1'], 'AR2': ['sp0']})
+        for query in [
+            queries.AnalyticsQueries.drop_table_analytics_artists_delta,
+            queries.AnalyticsQueries.create_table_analytics_artists_delta,
+            queries.AnalyticsQueries.delete_removed_analytics_artists,
+            queries.AnalyticsQueries.insert_new_analytics_artists,
+        ]:
+            redshift.execute_query(query, raise_on_error=True)
+
+        assert redshift.execute_query("SELECT * FROM staging.analytics_artists_delta") == [('AR2', 'sp0')]
+
+        test = unique_test('analytics_spotify_artists_id_unique', 'analytics.artists', 'spotify_artist_id')
+        scoped_test = scoped([test], queries.AnalyticsQueries.delta_scope_analytics_artists)[0]
+        scanned = redshift.execute_query(f"SELECT msd_artist_id FROM analytics.artists WHERE {scoped_test.scope}")
+        assert sorted(scanned) == [('AR0',), ('AR2',)]
+        assert not DataQualityOperator(redshift).run_table_tests(redshift, 'analytics.artists', [scoped_test])[test.name]
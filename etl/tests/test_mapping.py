@@ -0,0 +1,64 @@
+"""Unit tests for the similarity scoring of Spotify search hits"""
+
+import numpy as np
+from pytest import fixture
+
+from src.mapping.similarity import normalize, similarity, score_tracks, select_candidates
+from src.msd.custom_types import MsdSong
+from src.local import SyntheticSpotifyClient
+from src.spotify import SongFetcher
+
+
+@fixture
+def msd_song():
+    return MsdSong(id='SO1', name='Setting Fire to Sleeping Giants', release='Miss Machine', year=2004,
+                   artist_id='AR1', artist_name='The Dillinger Escape Plan')
+
+
+def track(name: str, artist: str, album: str = 'Miss Machine', release_date: str = '2004-07-20') -> dict:
+    return {'id': name, 'name': name, 'artists': [{'name': artist}], 'album': {'name': album, 'release_date': release_date}}
+
+
+class TestSimilarity():
+
+    def test_normalize(self):
+        """Assert that case, punctuation, brackets and version suffixes are ignored"""
+        assert normalize("Hey Jude - Remastered 2015") == normalize("hey jude (Live)") == "hey jude"
+
+    def test_similarity(self):
+        """Assert that similarity is 1 for the same text and lower for different texts"""
+        result = similarity("Sleeping Giants", ["sleeping giants", "Sleeping Dogs", "Jump"])
+        assert np.isclose(result[0], 1.0)
+        assert result[0] > result[1] > result[2]
+
+    def test_score_order(self, msd_song: MsdSong):
+        """Assert that the original track scores above a namesake and a karaoke version"""
+        tracks = [
+            track('Setting Fire to Sleeping Giants (Karaoke Version)', 'Karaoke Hits'),
+            track('Setting Fire to Sleeping Giants', 'Someone Else', 'Covers', '2019-01-01'),
+            track('Setting Fire to Sleeping Giants - Remastered', 'The Dillinger Escape Plan'),
+        ]
+        scores = score_tracks(msd_song, tracks)
+        assert scores[2] > 0.8 > scores[1] > scores[0]
+
+    def test_select_candidates(self):
+        """Assert that candidates are filtered by score, limited to top k, and best first"""
+        scores = np.array([0.2, 0.9, 0.7, 0.8])
+        assert select_candidates(scores) == [1, 3, 2, 0]
+        assert select_candidates(scores, min_score=0.75) == [1, 3]
+        assert select_candidates(scores, min_score=0.5, top_k=2) == [1, 3]
+
+
+class TestSongFetcherFilter():
+
+    def test_search_keeps_best(self):
+        """Assert that search results keep at most top_k hits above the threshold, with their scores"""
+        songs = [MsdSong(id=f"SO{i}", name=f"Song {i}", artist_id="AR1", artist_name="Artist") for i in range(30)]
+        all_hits = SongFetcher(SyntheticSpotifyClient()).search_many(songs)
+        best_hits = SongFetcher(SyntheticSpotifyClient(), min_score=0.7, top_k=2).search_many(songs)
+
+        assert sum(len(item.spotify_song_ids) for item in best_hits) < sum(len(item.spotify_song_ids) for item in all_hits)
+        for item in best_hits:
+            assert len(item.spotify_song_ids) == len(item.spotify_song_scores) <= 2
+            assert all(score >= 0.7 for score in item.spotify_song_scores)
+            assert item.spotify_song_scores == sorted(item.spotify_song_scores, reverse=True)
@@ -0,0 +1,80 @@
+"""Unit tests for the metrics module"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pytest import fixture
+from src.utils.metrics import (
+    QueryMetric, QueryMetricsRegistry, StageMetricsRegistry, stage_metrics, add_to_active_stages
+)
+from src.utils.helper import iter_execute
+
+
+@fixture
+def registry():
+    registry = QueryMetricsRegistry()
+    for label, elapsed, rows in [('copy staging.msd_songs', 3.0, 100), ('create_table_msd_songs', 1.0, 50), 
+                                 ('copy staging.msd_songs', 2.0, 20)]:
+        registry.record(QueryMetric(label=label, query_id=1, started_at=datetime.now(), 
+                                    elapsed_seconds=elapsed, rows=rows, succeeded=True))
+    return registry
+
+
+class TestQueryMetricsRegistry():
+
+    def test_summary(self, registry: QueryMetricsRegistry):
+        """Assert that summary() aggregates by label and puts the slowest statement first"""
+        summary = registry.summary()
+        assert list(summary.keys()) == ['copy staging.msd_songs', 'create_table_msd_songs']
+        assert summary['copy staging.msd_songs'] == {'calls': 2, 'total_seconds': 5.0, 'max_seconds': 3.0, 'rows': 120}
+
+    def test_write_report(self, registry: QueryMetricsRegistry, tmp_path):
+        """Assert that write_report() writes one JSON line per query"""
+        output_path = f"{tmp_path}/reports/queries.json"
+        registry.write_report(output_path)
+
+        with open(output_path, 'r') as f:
+            lines = [json.loads(line) for line in f]
+        assert len(lines) == 3
+
+
+class TestStageMetricsRegistry():
+
+    def test_measure_aggregates_runs(self):
+        """Assert that runs of the same stage are aggregated, and nested stages both get the counters"""
+        registry = StageMetricsRegistry()
+
+        for _ in range(2):
+            with registry.measure('fetch') as tracker:
+                with registry.measure('fetch_loop'):
+                    add_to_active_stages(api_calls=3, bytes_written=10)
+                tracker.records += 5
+
+        metrics = {metric.stage: metric for metric in registry.metrics}
+        assert metrics['fetch'].calls == 2
+        assert metrics['fetch'].records == 10
+        assert metrics['fetch'].api_calls == 6
+        assert metrics['fetch_loop'].bytes_written == 20
+
+    def test_worker_threads(self):
+        """Assert that counters added in a worker thread go to the stage measured in that thread, 
+        like the uploads of extract_msd_data, and not to the stage that submitted the work"""
+        registry = StageMetricsRegistry()
+
+        def upload(size):
+            with registry.measure('upload'):
+                add_to_active_stages(bytes_uploaded=size)
+
+        with ThreadPoolExecutor(max_workers=2) as executor, registry.measure('write_json'):
+            for future in [executor.submit(upload, size) for size in [10, 20, 30]]:
+                future.result()
+
+        metrics = {metric.stage: metric for metric in registry.metrics}
+        assert (metrics['upload'].calls, metrics['upload'].bytes_uploaded) == (3, 60)
+        assert metrics['write_json'].bytes_uploaded == 0
+
+    def test_iter_execute_records(self):
+        """Assert that iter_execute() loops are reported with their number of results"""
+        iter_execute(lambda x: [x, x], range(3), stage='test_iter_execute_records')
+        metrics = {metric.stage: metric for metric in stage_metrics.metrics}
+        assert metrics['test_iter_execute_records'].records == 6
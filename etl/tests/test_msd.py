@@ -1,8 +1,12 @@
 """Unit tests for msd module"""
 
 from pytest import fixture
-from src.msd import SongExtractor, ArtistExtractor
+from src.msd import SongExtractor, ArtistExtractor, iter_h5_images, compact_msd
 from src.msd.custom_types import MsdSong, MsdArtist
+from src.msd.synthetic import SyntheticMsdGenerator
+from pathlib import Path
+import tarfile
+import tables
 import json
 
 @fixture
@@ -66,3 +70,82 @@ class TestArtistExtractor():
         output_artists = [MsdArtist(**data) for data in data_json]
         assert all([i in output_artists for i in artists])
 
+
+
+class TestSyntheticMsdGenerator():
+    def test_generate_many(self, tmp_path, song_extractor: SongExtractor, artist_extractor: ArtistExtractor):
+        """Assert that generated files follow the MSD folder layout and can be read by the extractors"""
+
+        file_paths = SyntheticMsdGenerator(seed=1).generate_many(str(tmp_path), 5, first_letters="AB")
+
+        for path in file_paths:
+            letters = Path(path).name[2:5]
+            assert Path(path).parent.relative_to(tmp_path) == Path(*letters)
+
+        songs = song_extractor.extract_many_files(f"{tmp_path}/**/*.h5")
+        artists = artist_extractor.extract_many_files(f"{tmp_path}/**/*.h5")
+        assert len(songs) == 5
+        assert len(artists) == 5
+
+
+class TestArchive():
+    def test_extract_many_images(self, tmp_path, song_extractor: SongExtractor, artist_extractor: ArtistExtractor):
+        """Assert that H5 files streamed out of an archive give the same objects as the files on disk"""
+
+        archive_path = tmp_path / "millionsongsubset.tar.gz"
+        with tarfile.open(archive_path, 'w:gz') as archive:
+            archive.add(f"{base_path}/input/song_01.h5", "MillionSongSubset/A/B/C/song_01.h5")
+            archive.add(f"{base_path}/input/song_02.h5", "MillionSongSubset/A/B/D/song_02.h5")
+            archive.add(f"{base_path}/output/songs.json", "MillionSongSubset/songs.json")
+
+        images = list(iter_h5_images(str(archive_path)))
+        assert [name for name, _ in images] == ["MillionSongSubset/A/B/C/song_01.h5", "MillionSongSubset/A/B/D/song_02.h5"]
+
+        for extractor in [song_extractor, artist_extractor]:
+            from_files = extractor.extract_many_files(f"{base_path}/input/song_0[12].h5")
+            assert sorted(extractor.extract_many_images(images), key=str) == sorted(from_files, key=str)
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["millionsongsubset.tar.gz"]
+
+    def test_folders(self, tmp_path, monkeypatch):
+        """Assert that only the files of the wanted folders are read, and the archive is left after the last one"""
+        archive_path = tmp_path / "millionsongsubset.tar.gz"
+        with tarfile.open(archive_path, 'w:gz') as archive:
+            for name in ["A/A/C/song_01.h5", "A/B/C/song_01.h5", "A/B/D/song_02.h5", "A/C/C/song_01.h5", "A/D/C/song_02.h5"]:
+                archive.add(f"{base_path}/input/{name[-10:]}", f"MillionSongSubset/{name}")
+
+        visited, read = [], []
+        next_member, extractfile = tarfile.TarFile.next, tarfile.TarFile.extractfile
+        monkeypatch.setattr(tarfile.TarFile, 'next', lambda archive: visited.append(1) or next_member(archive))
+        monkeypatch.setattr(tarfile.TarFile, 'extractfile', lambda archive, member: read.append(member.name) or extractfile(archive, member))
+
+        images = list(iter_h5_images(str(archive_path), folders=["A/B"]))
+        assert [name for name, _ in images] == read == ["MillionSongSubset/A/B/C/song_01.h5", "MillionSongSubset/A/B/D/song_02.h5"]
+
+        # The last member (A/D) is never reached
+        members_read = len(visited)
+        visited.clear()
+        list(iter_h5_images(str(archive_path)))
+        assert members_read < len(visited)
+
+
+class TestStore():
+    def test_extract_store(self, tmp_path, song_extractor: SongExtractor, artist_extractor: ArtistExtractor):
+        """Assert that the consolidated store gives the same objects as the per-track files, by folder"""
+
+        input_dir = tmp_path / "MillionSongSubset"
+        file_paths = SyntheticMsdGenerator(seed=2).generate_many(str(input_dir), 20, first_letters="AB")
+        store_path = str(tmp_path / "msd_store.h5")
+
+        assert compact_msd(str(input_dir), store_path) == 20
+
+        for extractor in [song_extractor, artist_extractor]:
+            from_files = extractor.extract_many_files(f"{input_dir}/**/*.h5")
+            assert sorted(extractor.extract_store(store_path), key=str) == sorted(from_files, key=str)
+
+        folder = "/".join(Path(file_paths[0]).name[2:4])
+        folder_songs = song_extractor.extract_store(store_path, folder)
+        assert len(folder_songs) == len([path for path in file_paths if Path(path).name[2:4] == folder.replace("/", "")])
+        assert {song.id for song in folder_songs} <= {song.id for song in song_extractor.extract_store(store_path)}
+
+        with tables.open_file(store_path) as store:
+            assert store.root.songs.cols.song_id.is_indexed and store.root.songs.cols.artist_id.is_indexed
@@ -0,0 +1,121 @@
+"""Unit tests for the progress hooks of iter_execute()"""
+
+import logging
+import pytest
+
+from src.utils.helper import iter_execute, generate_intervals
+from src.utils.progress import ProgressHook, RateLogger, LatencyHistogram, PrometheusTextfileExporter
+
+
+class RecordingHook(ProgressHook):
+    def __init__(self) -> None:
+        self.events = []
+
+    def on_start(self, stage, total):
+        self.events.append(('start', stage, total))
+
+    def on_item(self, stage, index, latency, result_size):
+        self.events.append(('item', index, result_size))
+
+    def on_error(self, stage, index, error):
+        self.events.append(('error', index, str(error)))
+
+    def on_finish(self, stage, count, elapsed):
+        self.events.append(('finish', count))
+
+
+class TestHooks():
+
+    def test_events(self):
+        """Assert that hooks see the start, every item with its number of results, and the end"""
+        hook = RecordingHook()
+        iter_execute(lambda x: [x] * x, [0, 1, 2], stage='test_events', hooks=[hook])
+        assert hook.events == [('start', 'test_events', 3), ('item', 1, 0), ('item', 2, 1), ('item', 3, 2), ('finish', 3)]
+
+    def test_array_results(self):
+        """Assert that a NumPy array result is kept whole and counts one record per row"""
+        import numpy as np
+        hook = RecordingHook()
+        results = iter_execute(lambda x: np.arange(x), [2, 3], stage='test_array_results', hooks=[hook])
+
+        assert [len(result) for result in results] == [2, 3]
+        assert [event[2] for event in hook.events if event[0] == 'item'] == [2, 3]
+
+    def test_error(self):
+        """Assert that hooks are told about a failing item before the error is raised"""
+        hook = RecordingHook()
+
+        def func(x):
+            if x == 2:
+                raise ValueError("bad item")
+            return x
+
+        with pytest.raises(ValueError):
+            iter_execute(func, [1, 2, 3], stage='test_error', hooks=[hook])
+        assert hook.events[-1] == ('error', 2, "bad item")
+
+    def test_rate_logger_checkpoints(self, caplog):
+        """Assert that progress is logged at the same points as generate_intervals(), with a rate and ETA"""
+        logger = logging.getLogger('test_rate_logger')
+        with caplog.at_level(logging.INFO, logger='test_rate_logger'):
+            iter_execute(lambda x: x, range(50), logger=logger, logging_interval=20)
+
+        messages = [record.getMessage() for record in caplog.records]
+        assert [int(message.split()[1]) for message in messages] == generate_intervals(50, 20)
+        assert all('items/s, ETA' in message for message in messages)
+
+    def test_histogram(self):
+        """Assert that latencies are counted in their bucket"""
+        histogram = LatencyHistogram(buckets=(0.1, 1.0))
+        for latency in [0.05, 0.5, 0.5, 5.0]:
+            histogram.on_item('stage', 1, latency, 1)
+
+        assert histogram.stages['stage']['counts'] == [1, 2, 1]
+        assert histogram.quantile('stage', 0.5) == 1.0
+        assert histogram.quantile('stage', 1.0) == float('inf')
+
+
+class TestPrometheusTextfileExporter():
+
+    def test_write(self, tmp_path):
+        """Assert that the textfile contains the counters and a cumulative histogram of every stage"""
+        output_path = tmp_path / "music_etl.prom"
+        exporter = PrometheusTextfileExporter(str(output_path), buckets=(0.1, 1.0), min_interval_seconds=0)
+        iter_execute(lambda x: [x], range(3), stage='SongFetcher.search_many', hooks=[exporter])
+
+        content = output_path.read_text()
+        assert 'music_etl_items_total{stage="SongFetcher.search_many"} 3' in content
+        assert 'music_etl_item_latency_seconds_bucket{stage="SongFetcher.search_many",le="+Inf"} 3' in content
+        assert 'music_etl_item_latency_seconds_count{stage="SongFetcher.search_many"} 3' in content
+
+    def test_write_while_running(self, tmp_path):
+        """Assert that the textfile is written while a loop runs, at most every min_interval_seconds"""
+        output_path = tmp_path / "music_etl.prom"
+        exporter = PrometheusTextfileExporter(str(output_path), min_interval_seconds=3600)
+        seen = []
+
+        def func(x):
+            seen.append(output_path.read_text() if output_path.exists() else None)
+            return x
+
+        iter_execute(func, range(3), stage='AlbumFetcher.fetch_many', hooks=[exporter])
+
+        assert seen[0] is None
+        assert seen[1] == seen[2] and 'music_etl_items_total{stage="AlbumFetcher.fetch_many"} 1' in seen[1]
+
+    def test_short_loops(self, tmp_path, monkeypatch):
+        """Assert that many short loops, like the one run for every H5 file, don't rewrite the 
+        textfile each time they finish, and that the final write (at exit) has all the counts"""
+        output_path = tmp_path / "music_etl.prom"
+        exporter = PrometheusTextfileExporter(str(output_path), min_interval_seconds=3600)
+        writes = []
+        write = exporter.write
+        monkeypatch.setattr(exporter, 'write', lambda: writes.append(write()))
+
+        for _ in range(100):
+            iter_execute(lambda x: x, range(2), stage='SongExtractor.extract_one_file', hooks=[exporter])
+
+        assert len(writes) == 1
+
+        write()
+        assert 'music_etl_items_total{stage="SongExtractor.extract_one_file"} 200' in output_path.read_text()
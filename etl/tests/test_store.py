@@ -0,0 +1,151 @@
+"""Unit tests for the local store of Spotify entities"""
+
+import time
+from datetime import timedelta
+from pytest import fixture
+
+from src.spotify import EntityStore, SongFetcher, ArtistFetcher, AlbumFetcher, AudioFeaturesFetcher
+from src.spotify.custom_types import SpotifyArtist, SpotifyAudioFeatures
+from src.mapping.custom_types import MappedSong, MappedArtist
+from src.local import SyntheticSpotifyClient
+from src.utils.dataset import read_dataset
+
+
+class CountingSession:
+    """Wrap a session and record the IDs of every fetch request"""
+
+    def __init__(self, session) -> None:
+        self.session = session
+        self.requested_ids = []
+
+    def get(self, url, params=None):
+        if 'ids' in (params or {}):
+            self.requested_ids.append(params['ids'].split(','))
+        return self.session.get(url, params)
+
+
+@fixture
+def store(tmp_path):
+    store = EntityStore(str(tmp_path / 'entities.db'))
+    yield store
+    store.close()
+
+
+@fixture
+def client():
+    client = SyntheticSpotifyClient(seed=1)
+    client.session = CountingSession(client.session)
+    return client
+
+
+def artist(id: str) -> SpotifyArtist:
+    return SpotifyArtist(id=id, name=f"Artist {id}", url=f"https://open.spotify.com/artist/{id}", genres=['rock'])
+
+
+class TestEntityStore():
+
+    def test_round_trip(self, store: EntityStore):
+        """Assert that stored records are returned by ID and kind"""
+        store.put_many('artist', [artist('a'), artist('b')])
+
+        assert store.get_many('artist', ['a', 'b', 'c']) == {'a': artist('a').dict(), 'b': artist('b').dict()}
+        assert store.get_many('song', ['a']) == {}
+        assert store.count('artist') == 2
+
+    def test_stale_records(self, store: EntityStore):
+        """Assert that records older than max_age are not returned, and fresh again once replaced"""
+        store.put_many('artist', [artist('a')])
+        store.conn.execute("UPDATE entities SET fetched_at = ?", (time.time() - 3 * 86400,))
+
+        assert store.get_many('artist', ['a'], max_age=timedelta(days=2)) == {}
+        assert 'a' in store.get_many('artist', ['a'], max_age=timedelta(days=4))
+
+        store.put_many('artist', [artist('a')])
+        assert 'a' in store.get_many('artist', ['a'], max_age=timedelta(days=2))
+
+    def test_export(self, store: EntityStore, tmp_path):
+        """Assert that export writes every record of a kind"""
+        store.put_many('artist', [artist('b'), artist('a')])
+        dataset = store.export('artist', str(tmp_path / 'export' / 'artists.json'))
+
+        assert dataset.rows == 2
+        assert [record.id for record in read_dataset(dataset, SpotifyArtist)] == ['a', 'b']
+
+    def test_export_in_chunks(self, store: EntityStore, tmp_path):
+        """Assert that records read in chunks are all exported once, in ID order"""
+        store.put_many('artist', [artist(id) for id in 'edcba'])
+        dataset = store.export('artist', str(tmp_path / 'artists.json'), chunk_rows=2)
+
+        assert [record.id for record in read_dataset(dataset, SpotifyArtist)] == list('abcde')
+
+
+class TestDeltaFetch():
+
+    def test_only_missing_ids_are_requested(self, client, store: EntityStore):
+        """Assert that a second fetch only requests the IDs that are not in the store"""
+        fetcher = SongFetcher(client, store=store, max_age=timedelta(days=1))
+
+        first = fetcher.fetch_many([MappedSong(msd_song_id='SO1', spotify_song_ids=['t1', 't2'])])
+        second = fetcher.fetch_many([MappedSong(msd_song_id='SO2', spotify_song_ids=['t2', 't3', 't1'])])
+
+        assert client.session.requested_ids == [['t1', 't2'], ['t3']]
+        assert [song.id for song in first] == ['t1', 't2']
+        assert [song.id for song in second] == ['t2', 't3', 't1']
+        assert second[0] == first[1]
+
+    def test_same_result_as_without_store(self, client, store: EntityStore):
+        """Assert that artists read from the store are the same as freshly fetched ones"""
+        items = [MappedArtist(msd_artist_id='AR1', spotify_artist_ids=['a1', 'a2'])]
+
+        expected = ArtistFetcher(client).fetch_many(items)
+        ArtistFetcher(client, store=store).fetch_many(items)
+        client.session.requested_ids = []
+
+        assert ArtistFetcher(client, store=store).fetch_many(items) == expected
+        assert client.session.requested_ids == []
+
+
+class TestAlbumFetcher():
+
+    def test_albums_are_deduplicated_and_batched(self, client, store: EntityStore):
+        """Assert that album IDs shared by songs are requested once, in batches of at most 20"""
+        songs = SongFetcher(client).fetch_many([MappedSong(msd_song_id='SO1', spotify_song_ids=[f"t{i}" for i in range(30)])])
+        songs = songs + songs
+        album_ids = list(dict.fromkeys(song.album_id for song in songs))
+        client.session.requested_ids = []
+
+        albums = AlbumFetcher(client, store=store).fetch_many(iter(songs))
+
+        assert [album.id for album in albums] == album_ids
+        assert [len(ids) for ids in client.session.requested_ids] == [20, 10]
+        assert store.count('album') == 30
+
+
+class TestAudioFeaturesFetcher():
+
+    def test_batches_and_array(self, client, store: EntityStore):
+        """Assert that features are requested 100 IDs at a time and returned as one structured array"""
+        ids = [f"t{i}" for i in range(250)]
+        features = AudioFeaturesFetcher(client, store=store).fetch_many(iter(ids + ids[:10]))
+
+        assert [len(batch) for batch in client.session.requested_ids] == [100, 100, 50]
+        assert features.dtype.names[:3] == ('id', 'danceability', 'energy')
+        assert features['id'].astype(str).tolist() == ids
+        assert ((features['danceability'] >= 0) & (features['danceability'] <= 1)).all()
+
+    def test_store(self, client, store: EntityStore):
+        """Assert that features read from the store are the same as fetched ones"""
+        expected = AudioFeaturesFetcher(client, store=store).fetch_many(['t1', 't2'])
+        client.session.requested_ids = []
+
+        assert (AudioFeaturesFetcher(client, store=store).fetch_many(['t2', 't1'])[::-1] == expected).all()
+        assert client.session.requested_ids == []
+
+    def test_missing_features(self, client, store: EntityStore):
+        """Assert that missing features are masked instead of being given a placeholder value"""
+        store.put_many('audio_features', [SpotifyAudioFeatures(id='t1', key=-1, tempo=120.0)])
+        features = AudioFeaturesFetcher(client, store=store).fetch_many(['t1'])
+
+        assert client.session.requested_ids == []
+        assert features['key'].tolist() == [-1] and features['tempo'].tolist() == [120.0]
+        assert features['mode'].mask.all() and features['duration_ms'].mask.all()
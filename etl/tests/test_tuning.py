@@ -0,0 +1,160 @@
+"""Unit tests for the physical design tuning"""
+
+import pytest
+
+from src import etl_queries as queries
+from src.local import LocalRedshiftClient
+from src.tuning.physical_design import (
+    KeyUsage, PhysicalDesignTuner, table_definitions, table_columns, key_usage, propose_design,
+    tuned_ddl, ctas_select, alter_statements, encoding_statements, plan_cost, plan_redistributions
+)
+
+
+analytics_queries = [query for query in vars(queries.AnalyticsQueries).values() if isinstance(query, str)]
+
+
+@pytest.fixture
+def definitions():
+    return table_definitions(
+        queries.StagingMsdQueries(), queries.StagingMappedQueries(), queries.StagingSpotifyQueries(), queries.AnalyticsQueries()
+    )
+
+
+@pytest.fixture
+def columns(definitions):
+    return {table: table_columns(query) for table, query in definitions.items()}
+
+
+class TestKeyUsage():
+
+    def test_columns(self, columns):
+        """Assert that columns are read from column lists and from the select list of CREATE TABLE AS"""
+        assert columns['staging.mapped_songs'] == ['msd_song_id', 'spotify_song_ids', 'spotify_song_scores']
+        assert columns['analytics.songs'][:3] == ['msd_song_id', 'msd_song_name', 'msd_release']
+        assert 'year' in columns['analytics.songs']
+
+    def test_analytics_keys(self, columns):
+        """Assert that join keys are resolved to tables through aliases and CTEs, and computed columns are ignored"""
+        usage = key_usage(analytics_queries, columns)
+
+        assert list(usage['mapped.songs'].joins) == ['msd_song_id']
+        assert set(usage['spotify.songs'].joins) == {'id', 'album_id'}
+        assert usage['spotify.songs'].filters == {'id': usage['spotify.songs'].filters['id']}
+        assert list(usage['staging.msd_songs'].partitions) == ['id']
+        assert list(usage['analytics.songs'].filters) == ['msd_song_id']
+
+
+class TestProposeDesign():
+
+    columns = ['id', 'name', 'year']
+
+    def test_joined_table(self):
+        """Assert that joined tables are distributed and sorted on the join key, left uncompressed"""
+        usage = KeyUsage(joins={'id': 2, 'name': 1})
+        design = propose_design('msd.songs', self.columns, usage, {'id': 'zstd', 'year': 'az64'})
+
+        assert (design.diststyle, design.distkey, design.sortkey) == ('KEY', 'id', ['id'])
+        assert design.encodings == {'id': 'raw', 'year': 'az64'}
+        assert encoding_statements(design) == ["ALTER TABLE msd.songs ALTER COLUMN year ENCODE az64"]
+
+    def test_filtered_columns_lead_the_sort_key(self):
+        """Assert that filtered columns come first in the sort key"""
+        design = propose_design('msd.songs', self.columns, KeyUsage(joins={'id': 1}, filters={'year': 3}))
+        assert design.sortkey == ['year', 'id']
+
+    def test_small_and_unused_tables(self):
+        """Assert that small joined tables are copied to all nodes, and unused tables spread evenly"""
+        small = propose_design('msd.songs', self.columns, KeyUsage(joins={'id': 1}), rows=100, all_max_rows=1000)
+        unused = propose_design('msd.songs', self.columns)
+        staging = propose_design('staging.msd_songs', self.columns, KeyUsage(partitions={'id': 1}))
+
+        assert (small.diststyle, small.distkey) == ('ALL', None)
+        assert (unused.diststyle, unused.sortkey) == ('EVEN', [])
+        assert (staging.diststyle, staging.distkey, staging.sortkey) == ('KEY', 'id', [])
+
+
+class TestTunedDDL():
+
+    def test_column_list(self):
+        """Assert that the attributes of a CREATE TABLE are replaced, and encodings added to its columns"""
+        design = propose_design('staging.msd_songs', ['id', 'year'], KeyUsage(joins={'year': 1}), {'id': 'zstd'})
+        query = tuned_ddl(queries.StagingMsdQueries.create_table_songs, design)
+
+        assert 'id              VARCHAR(256) NOT NULL ENCODE zstd,' in query
+        assert 'DISTKEY(year)' in query and 'DISTKEY(id)' not in query
+        assert query.rstrip().endswith('COMPOUND SORTKEY(year)')
+        assert tuned_ddl(query, design) == query
+
+    @pytest.mark.parametrize('query', [
+        queries.AnalyticsQueries.create_table_msd_songs,
+        queries.AnalyticsQueries.create_table_analytics_songs,
+        queries.AnalyticsQueries.create_view_analytics_songs
+    ])
+    def test_create_as(self, query):
+        """Assert that attributes of CREATE TABLE AS and materialized views go before AS, and the query is unchanged"""
+        design = propose_design('msd.songs', ['id', 'msd_song_id'], KeyUsage(joins={'msd_song_id': 1}))
+        tuned = tuned_ddl(query, design)
+        head, body = tuned.split(' AS', 1)
+
+        assert 'DISTKEY(msd_song_id)' in head and 'COMPOUND SORTKEY(msd_song_id)' in head
+        assert body.strip() in query
+        assert tuned_ddl(tuned, design) == tuned
+
+    def test_ctas_select(self, tmp_path):
+        """Assert that the query of a tuned CREATE TABLE AS can refill the table it created"""
+        design = propose_design('msd.songs', ['id'], KeyUsage(joins={'id': 1}))
+        select = ctas_select(tuned_ddl(queries.AnalyticsQueries.create_table_msd_songs, design))
+        assert select.strip().startswith('with base as') and 'DISTKEY' not in select
+
+        redshift = LocalRedshiftClient(str(tmp_path))
+        redshift.execute_query(queries.StagingMsdQueries.create_table_songs)
+        redshift.execute_query(queries.AnalyticsQueries.create_table_msd_songs)
+        redshift.insert_records('staging.msd_songs', [{'id': 'SO1', 'name': 'Song'}, {'id': 'SO1', 'name': 'Song'}])
+        redshift.execute_query(queries.AnalyticsQueries.insert_select.format(table='msd.songs', select=select))
+        assert redshift.execute_query("SELECT id FROM msd.songs", return_result=True) == [('SO1',)]
+
+    def test_alter_statements(self):
+        """Assert that designs can be applied to existing tables"""
+        design = propose_design('msd.songs', ['id'], KeyUsage(joins={'id': 1}))
+        assert alter_statements(design) == [
+            "ALTER TABLE msd.songs ALTER DISTSTYLE KEY DISTKEY id",
+            "ALTER TABLE msd.songs ALTER COMPOUND SORTKEY (id)"
+        ]
+
+
+class TestPlan():
+
+    plan = [
+        "XN Hash Left Join DS_DIST_INNER  (cost=0.09..2000020.43 rows=3 width=1035)",
+        "  ->  XN Hash Join DS_BCAST_INNER  (cost=0.04..1000000.25 rows=3 width=520)",
+        "        ->  XN Seq Scan on songs spotify  (cost=0.00..0.03 rows=3 width=520)",
+        "  ->  XN Hash Left Join DS_DIST_NONE  (cost=0.04..0.08 rows=3 width=515)",
+    ]
+
+    def test_cost_and_redistributions(self):
+        """Assert that the total cost is the one of the top step, and collocated joins are not redistributions"""
+        assert plan_cost(self.plan) == 2000020.43
+        assert plan_redistributions(self.plan) == ['DS_DIST_INNER', 'DS_BCAST_INNER']
+        assert plan_cost(["SCAN mapped_songs"]) is None
+
+
+class TestTuner():
+
+    def test_local(self, tmp_path, definitions):
+        """Assert that the tuner proposes, applies and measures designs on the local database"""
+        redshift = LocalRedshiftClient(str(tmp_path))
+        for query in [queries.StagingMsdQueries.create_table_songs, queries.AnalyticsQueries.create_table_msd_songs]:
+            redshift.execute_query(query)
+
+        tuner = PhysicalDesignTuner(redshift, definitions, analytics_queries)
+        designs = tuner.propose()
+        tuner.apply({'msd.songs': designs['msd.songs']})
+        measures = tuner.measure({'msd': "SELECT * FROM msd.songs WHERE id = 'SO1'"})
+
+        assert designs['msd.songs'].encodings['year'] == 'az64'
+        assert designs['msd.songs'].encodings['id'] == 'raw'
+        assert measures['tables']['msd.songs']['tbl_rows'] == 0
+        assert 'staging.mapped_songs' not in measures['tables']
+        assert measures['queries']['msd']['plan'] != []
+        assert redshift.metrics.summary()
+        redshift.close()